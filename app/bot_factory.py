@@ -0,0 +1,19 @@
+from aiogram import Bot
+from aiogram.client.telegram import TelegramAPIServer
+from app.metrics import MetricsSession
+import logging
+import os
+
+# Адрес Bot API: пусто - api.telegram.org; локальный telegram-bot-api или app/fake_bot_api.py для нагрузочных тестов
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER', '')
+
+
+def create_bot(token, api_server=TELEGRAM_API_SERVER):
+    """
+    Создает Bot, обращающийся к api_server (если задан) вместо api.telegram.org.
+    Запросы к Bot API учитываются в метриках (время, ошибки, 429).
+    """
+    if not api_server:
+        return Bot(token=token, session=MetricsSession())
+    logging.info(f"[BOT] Bot API: {api_server}")
+    return Bot(token=token, session=MetricsSession(api=TelegramAPIServer.from_base(api_server.rstrip('/'))))
@@ -0,0 +1,44 @@
+from collections import OrderedDict
+import time
+
+
+class TTLCache:
+    """Простой кэш в памяти с временем жизни записей и ограничением размера (вытесняются самые старые записи)"""
+
+    def __init__(self, ttl, maxsize=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= self.clock():
+            del self._data[key]
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data.pop(key, None)
+        self._data[key] = (value, self.clock() + (self.ttl if ttl is None else ttl))
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+_MISSING = object()
@@ -1,9 +1,16 @@
-from celery import Celery
+from celery import Celery, group
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
 from datetime import datetime, timedelta
 import os
 from app.subscription_service import subscription_service
-from app.database import User, UserSubscription
-from aiogram import Bot
+from app.expiry_sweeper import expiry_sweeper
+from app.outbox import outbox_worker
+from app.reminders import reminder_sender, REMINDER_HOURS
+from app.leader import LEADER_BACKEND, RedisLease
+from app.message_dispatcher import message_dispatcher
+from app.database import reset_engine_after_fork, dispose_async_engine
+from app.bot_factory import create_bot
+from app.metrics import CELERY_METRICS_PORT, SWEEP_DURATION, BACKLOG, start_metrics_server, mark_process_dead
 import asyncio
 import logging
 
@@ -17,65 +24,108 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError('Не задан TELEGRAM_BOT_TOKEN в .env!')
 
+# Период запуска координатора (celery beat) и примерный размер диапазона подписок для одной задачи
+CELERY_SWEEP_INTERVAL = int(os.getenv('CELERY_SWEEP_INTERVAL', '60'))  # сек
+CELERY_SWEEP_CHUNK_SIZE = int(os.getenv('CELERY_SWEEP_CHUNK_SIZE', '5000'))
+
 celery = Celery('aiogram', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+celery.conf.update(
+    # Задача подтверждается после выполнения: при падении воркера диапазон будет обработан повторно
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    beat_schedule={
+        'sweep-subscriptions': {
+            'task': 'subscriptions.sweep_coordinator',
+            'schedule': CELERY_SWEEP_INTERVAL,
+            'options': {'expires': CELERY_SWEEP_INTERVAL},
+        },
+    },
+)
 
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+bot = create_bot(TELEGRAM_BOT_TOKEN)
+# Аренда фоновых циклов бота: пока её держит процесс бота, координатор Celery не запускает проход.
+# С LEADER_BACKEND=local аренда не видна другим процессам, и бот с Celery отзывали бы доступ одновременно
+if LEADER_BACKEND != 'redis':
+    raise ValueError('Celery требует LEADER_BACKEND=redis: иначе фоновые циклы бота и координатор Celery работают одновременно')
+leader_lease = RedisLease()
 subscription_service.set_bot(bot)
+message_dispatcher.set_bot(bot)
 
-@celery.task
-def monitor_subscriptions_task():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(monitor_subscriptions_coro())
+# Event loop процесса-воркера: живет всё время работы процесса вместе с пулом соединений и очередью отправки
+_loop = None
+
+
+def run_async(coro):
+    """Выполняет корутину в постоянном event loop текущего процесса"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop.run_until_complete(coro)
+
+
+@worker_init.connect
+def init_worker(**kwargs):
+    # Метрики дочерних процессов видны в эндпоинте только при заданном PROMETHEUS_MULTIPROC_DIR
+    start_metrics_server(CELERY_METRICS_PORT)
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    global _loop
+    # Дочерний процесс не должен использовать соединения пула, открытые до fork
+    reset_engine_after_fork()
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
 
-async def monitor_subscriptions_coro():
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    if _loop is None or _loop.is_closed():
+        return
+    async def close():
+        await message_dispatcher.stop()
+        await bot.session.close()
+        await dispose_async_engine()
+    try:
+        _loop.run_until_complete(close())
+    finally:
+        _loop.close()
+        mark_process_dead(os.getpid())
+
+
+@celery.task(name='subscriptions.sweep_coordinator', ignore_result=True)
+def monitor_subscriptions_task():
+    """
+    Координатор: делит подписки, которым нужно напоминание или отзыв доступа,
+    на диапазоны id и раздает их задачам sweep_subscription_range.
+    Чем больше воркеров, тем быстрее разбирается очередь диапазонов.
+    """
+    holder = run_async(leader_lease.holder())
+    if holder is not None:
+        logging.info(f"[CELERY] Фоновые циклы выполняет процесс бота {holder}, проход пропущен")
+        return 0
     now = datetime.utcnow()
-    # Напоминания за 24 часа до окончания
-    expiring = await subscription_service.get_expiring_subscriptions(hours=24)
-    for sub in expiring:
-        if not getattr(sub, 'reminder_sent', False):
-            user = subscription_service.session.query(User).filter(User.id == sub.user_id).first()
-            if user:
-                try:
-                    await bot.send_message(
-                        chat_id=user.telegram_user_id,
-                        text="⏰ Ваша подписка истекает через 24 часа! Продлите её, чтобы не потерять доступ к каналу."
-                    )
-                    sub.reminder_sent = True
-                    subscription_service.session.commit()
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке напоминания пользователю {user.telegram_user_id}: {e}")
-    # Отзыв доступа для истекших подписок
-    expired = subscription_service.session.query(UserSubscription).filter(
-        UserSubscription.is_active == True,
-        UserSubscription.end_date < now
-    ).all()
-    for sub in expired:
-        user = subscription_service.session.query(User).filter(User.id == sub.user_id).first()
-        try:
-            await subscription_service.remove_user_access(sub)
-            if user:
-                await bot.send_message(
-                    chat_id=user.telegram_user_id,
-                    text="❌ Ваша подписка истекла. Доступ к каналу отозван. Если вы не успели вступить — оформите новую подписку для получения новой ссылки."
-                )
-        except Exception as e:
-            logging.error(f"Ошибка при отзыве доступа у пользователя {getattr(user, 'telegram_user_id', '?')}: {e}")
-    # Проверяем подписки, которые истекли за последние 2 минуты (например, после перезапуска)
-    recently_expired = subscription_service.session.query(UserSubscription).filter(
-        UserSubscription.is_active == False,
-        UserSubscription.end_date >= now - timedelta(minutes=2),
-        UserSubscription.end_date < now
-    ).all()
-    for sub in recently_expired:
-        if not getattr(sub, 'reminder_sent', False):
-            user = subscription_service.session.query(User).filter(User.id == sub.user_id).first()
-            if user:
-                try:
-                    await bot.send_message(
-                        chat_id=user.telegram_user_id,
-                        text="❌ Ваша подписка истекла. Доступ к каналу отозван. Если вы не успели вступить — оформите новую подписку для получения новой ссылки."
-                    )
-                    sub.reminder_sent = True
-                    subscription_service.session.commit()
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке уведомления о завершении подписки пользователю {user.telegram_user_id}: {e}") 
\ No newline at end of file
+    ranges = run_async(expiry_sweeper.partition(CELERY_SWEEP_CHUNK_SIZE, horizon=now + timedelta(hours=REMINDER_HOURS)))
+    BACKLOG.labels('sweep_ranges').set(len(ranges))
+    if not ranges:
+        return 0
+    group(sweep_subscription_range.s(lo, hi, now.isoformat()) for lo, hi in ranges).apply_async()
+    logging.info(f"[CELERY] Поставлено задач по диапазонам подписок: {len(ranges)}")
+    return len(ranges)
+
+
+@celery.task(name='subscriptions.sweep_range', ignore_result=True)
+def sweep_subscription_range(lo, hi, now_iso):
+    """Отзыв доступа и напоминания для подписок с id в диапазоне [lo, hi]"""
+    return run_async(sweep_range_coro((lo, hi), datetime.fromisoformat(now_iso)))
+
+
+async def sweep_range_coro(id_range, now):
+    with SWEEP_DURATION.labels('celery_range').time():
+        stats = await expiry_sweeper.sweep(now, id_range=id_range)
+        stats['reminded'] = (await reminder_sender.send_due(now, id_range=id_range))['sent']
+        # Действия по истекшим подпискам выполняются из outbox; воркеры забирают разные пачки (SKIP LOCKED)
+        while await outbox_worker.drain() >= outbox_worker.batch_size:
+            pass
+    return stats
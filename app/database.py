@@ -1,8 +1,15 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, Date, DateTime, Text, JSON, Index, text, inspect
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import declarative_base, relationship
+from app.metrics import instrument_engine, record_pool_wait
+from app.query_log import install_query_log
 from datetime import datetime
+import logging
 import os
+import re
+import time
 
 # Создаем базовый класс для наших моделей
 Base = declarative_base()
@@ -57,9 +64,36 @@ class UserSubscription(Base):
     user = relationship("User", back_populates="subscriptions")
     plan = relationship("SubscriptionPlan", back_populates="subscriptions")
     
+    # Индексы под горячие запросы (см. async_ensure_indexes для создания на существующей базе)
+    __table_args__ = (
+        # Напоминания и отзыв доступа: активные подписки по дате окончания
+        Index('ix_user_subscriptions_active_end_date', 'end_date', postgresql_where=text('is_active')),
+        # Недавно истекшие подписки: фильтр по is_active и диапазону end_date
+        Index('ix_user_subscriptions_is_active_end_date', 'is_active', 'end_date'),
+        # Активная подписка пользователя
+        Index('ix_user_subscriptions_user_id_is_active', 'user_id', 'is_active'),
+        # Проверка запросов на вступление по ссылке-приглашению
+        Index('ix_user_subscriptions_invite_link', 'invite_link', postgresql_where=text('invite_link IS NOT NULL')),
+        # Один платеж - одна подписка
+        Index('uq_user_subscriptions_provider_payment_charge_id', 'provider_payment_charge_id', unique=True,
+              postgresql_where=text('provider_payment_charge_id IS NOT NULL')),
+    )
+    
     def __repr__(self):
         return f"<UserSubscription(id={self.id}, user_id={self.user_id}, plan_id={self.plan_id}, active={self.is_active})>"
 
+# Все обработанные платежи: по уникальному ID транзакции повторная доставка распознается и после продлений
+class PaymentCharge(Base):
+    __tablename__ = 'payment_charges'
+    
+    id = Column(Integer, primary_key=True)
+    provider_payment_charge_id = Column(String, nullable=False, unique=True)  # ID транзакции у платежного провайдера
+    subscription_id = Column(Integer, ForeignKey('user_subscriptions.id'), nullable=False)  # Созданная или продленная подписка
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<PaymentCharge(id={self.id}, charge_id='{self.provider_payment_charge_id}', subscription_id={self.subscription_id})>"
+
 # Модель для хранения информации об ошибочных платежах
 class PaymentError(Base):
     __tablename__ = 'payment_errors'
@@ -79,29 +113,253 @@ class PaymentError(Base):
     resolution_notes = Column(Text, nullable=True)  # Заметки о решении проблемы
     resolution_time = Column(DateTime, nullable=True)  # Когда проблема была решена
     
+    __table_args__ = (
+        # Постраничный просмотр неразрешенных ошибок (keyset по id)
+        Index('ix_payment_errors_unresolved_id', 'id', postgresql_where=text('is_resolved = false')),
+    )
+    
     def __repr__(self):
         return f"<PaymentError(id={self.id}, user_id='{self.telegram_user_id}', charge_id='{self.provider_payment_charge_id}', resolved={self.is_resolved})>"
 
+# Заранее созданные ссылки-приглашения, которые выдаются при оплате без обращения к Bot API
+class InviteLinkPoolEntry(Base):
+    __tablename__ = 'invite_link_pool'
+    
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(String, nullable=False)
+    invite_link = Column(String, nullable=False, unique=True)
+    expires_at = Column(DateTime, nullable=False)  # Срок действия ссылки в Telegram
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Выдача ссылки канала с наибольшим запасом по сроку и поиск устаревших ссылок
+        Index('ix_invite_link_pool_channel_id_expires_at', 'channel_id', 'expires_at'),
+    )
+    
+    def __repr__(self):
+        return f"<InviteLinkPoolEntry(id={self.id}, channel_id='{self.channel_id}', expires_at={self.expires_at})>"
+
+# Исходящие действия в Telegram (бан, отзыв ссылки, уведомление), записанные в транзакции вместе с изменением данных
+class OutboxMessage(Base):
+    __tablename__ = 'outbox'
+    
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # ban, revoke_link, notify
+    payload = Column(JSON, nullable=False)
+    dedupe_key = Column(String, nullable=True, unique=True)  # Повторная запись того же действия игнорируется
+    status = Column(String, nullable=False, default='pending')  # pending, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # Не раньше этого времени выполняется следующая попытка
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    
+    __table_args__ = (
+        # Выборка готовых к выполнению действий
+        Index('ix_outbox_pending_available_at', 'available_at', postgresql_where=text("status = 'pending'")),
+    )
+    
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, kind='{self.kind}', status='{self.status}', attempts={self.attempts})>"
+
+# Fencing token текущего ведущего: записи фоновых циклов проходят, только пока токен в строке совпадает с их токеном
+class LeaderFence(Base):
+    __tablename__ = 'leader_fence'
+
+    name = Column(String, primary_key=True)  # Имя аренды (LEADER_NAME)
+    token = Column(BigInteger, nullable=False)  # Наибольший выданный токен; меньший токен не может его заменить
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<LeaderFence(name='{self.name}', token={self.token})>"
+
+# Дневная сводка по подпискам для /stats: счетчики увеличиваются в тех же транзакциях, что меняют подписки
+class SubscriptionStats(Base):
+    __tablename__ = 'subscription_stats_daily'
+    
+    day = Column(Date, primary_key=True)
+    plan_id = Column(Integer, primary_key=True)  # 0 - тариф неизвестен (ошибки платежей без плана)
+    slot = Column(Integer, primary_key=True, default=0)  # Строки одного дня и тарифа делятся на слоты, чтобы платежи не ждали блокировку одной строки
+    new_subscriptions = Column(Integer, nullable=False, default=0)
+    renewals = Column(Integer, nullable=False, default=0)
+    cancellations = Column(Integer, nullable=False, default=0)
+    expirations = Column(Integer, nullable=False, default=0)
+    active_delta = Column(Integer, nullable=False, default=0)  # Изменение числа активных подписок за день
+    revenue = Column(BigInteger, nullable=False, default=0)  # Оплаты в копейках
+    payment_errors = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<SubscriptionStats(day={self.day}, plan_id={self.plan_id}, slot={self.slot})>"
+
 # Асинхронное подключение к PostgreSQL
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("Не задана переменная окружения DATABASE_URL. Укажите её в .env!")
 
+# Настройки пула соединений. Один процесс бота держит не более DB_POOL_SIZE + DB_MAX_OVERFLOW соединений
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '5'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))  # Сколько ждать свободное соединение, сек
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # Пересоздавать соединения старше, сек
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True').lower() in ('true', '1', 't')
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))  # Кэш prepared statements asyncpg, 0 для pgbouncer
+DB_ECHO = os.getenv('DB_ECHO', 'False').lower() in ('true', '1', 't')  # Логирование всех SQL-запросов
+DB_SCHEMA = os.getenv('DB_SCHEMA', '')  # Схема таблиц (search_path), по умолчанию схема сервера
+
+
+class PoolStats:
+    """Счетчики выдачи соединений из пула и времени ожидания свободного соединения"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, wait, timed_out=False):
+        if timed_out:
+            self.timeouts += 1
+        else:
+            self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        record_pool_wait(wait, timed_out)
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул соединений, замеряющий время ожидания соединения"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - started)
+        return connection
+
+
+# Реестр движка: один движок и один пул соединений на процесс
+_engine = None
+_session_maker = None
+
+def _connect_args():
+    connect_args = {
+        'statement_cache_size': DB_STATEMENT_CACHE_SIZE,
+        'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE,
+    }
+    if DB_SCHEMA:
+        connect_args['server_settings'] = {'search_path': DB_SCHEMA}
+    return connect_args
+
 def get_async_engine():
-    return create_async_engine(DATABASE_URL, echo=True)
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(
+            DATABASE_URL,
+            echo=DB_ECHO,
+            poolclass=TimedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+            connect_args=_connect_args(),
+        )
+        instrument_engine(_engine)
+        install_query_log(_engine)
+        logging.info(f"[DB] Создан движок: pool_size={DB_POOL_SIZE}, max_overflow={DB_MAX_OVERFLOW}, echo={DB_ECHO}")
+    return _engine
 
 def get_async_session_maker(engine=None):
+    global _session_maker
     if engine is None:
-        engine = get_async_engine()
+        if _session_maker is None:
+            _session_maker = async_sessionmaker(get_async_engine(), expire_on_commit=False, class_=AsyncSession)
+        return _session_maker
     return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+def get_pool_stats():
+    """Текущее состояние пула соединений и накопленная статистика ожидания"""
+    pool = get_async_engine().pool
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': pool.overflow(),
+        'max_connections': DB_POOL_SIZE + DB_MAX_OVERFLOW,
+        'checkouts': pool_stats.checkouts,
+        'timeouts': pool_stats.timeouts,
+        'avg_wait': pool_stats.total_wait / pool_stats.checkouts if pool_stats.checkouts else 0.0,
+        'max_wait': pool_stats.max_wait,
+    }
+
+async def dispose_async_engine():
+    """Закрывает все соединения пула. Движок остается пригодным: пул будет создан заново"""
+    if _engine is not None:
+        await _engine.dispose()
+
+def reset_engine_after_fork():
+    """Сбрасывает унаследованные от родительского процесса соединения (вызывать в дочернем процессе)"""
+    if _engine is not None:
+        _engine.sync_engine.dispose(close=False)
+
 # Асинхронная инициализация базы данных
 async def async_init_db():
     engine = get_async_engine()
     async with engine.begin() as conn:
+        has_charges = await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table(PaymentCharge.__tablename__))
         await conn.run_sync(Base.metadata.create_all)
+        if not has_charges:
+            # Таблица платежей появилась позже подписок: переносим в нее уже обработанные платежи
+            await conn.execute(text(
+                "INSERT INTO payment_charges (provider_payment_charge_id, subscription_id, created_at) "
+                "SELECT provider_payment_charge_id, id, start_date FROM user_subscriptions "
+                "WHERE provider_payment_charge_id IS NOT NULL "
+                "ON CONFLICT DO NOTHING"
+            ))
+    await async_ensure_indexes(engine)
     return engine
 
+async def async_ensure_indexes(engine):
+    """
+    Создает недостающие индексы на уже существующих таблицах без блокировки записи.
+    
+    create_all не трогает существующие таблицы, поэтому индексы, добавленные в модели позже,
+    создаются здесь через CREATE INDEX CONCURRENTLY (вне транзакции).
+    Невалидные индексы, оставшиеся после прерванного построения, пересоздаются.
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                result = await conn.execute(
+                    text(
+                        "SELECT i.indisvalid FROM pg_index i "
+                        "JOIN pg_class c ON c.oid = i.indexrelid "
+                        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                        "WHERE c.relname = :name AND n.nspname = current_schema()"
+                    ),
+                    {"name": index.name}
+                )
+                is_valid = result.scalar_one_or_none()
+                if is_valid:
+                    continue
+                if is_valid is False:
+                    logging.warning(f"[DB] Индекс {index.name} невалиден, пересоздаем")
+                    await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+                ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+                ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', ddl)
+                try:
+                    await conn.execute(text(ddl))
+                    logging.info(f"[DB] Создан индекс {index.name}")
+                except Exception as e:
+                    logging.error(f"[DB] Не удалось создать индекс {index.name}: {e}")
+
 
 
 
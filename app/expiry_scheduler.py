@@ -0,0 +1,222 @@
+from app.database import get_async_session_maker, UserSubscription
+from datetime import datetime, timedelta
+from sqlalchemy import select, func
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+
+# Горизонт, на который сроки окончания подписок загружаются в память, и период сверочного прохода по базе
+EXPIRY_WINDOW_HOURS = float(os.getenv('EXPIRY_WINDOW_HOURS', '24'))
+EXPIRY_RECONCILE_INTERVAL = int(os.getenv('EXPIRY_RECONCILE_INTERVAL', '900'))  # сек
+# Задержка первого повтора после ошибки загрузки окна или прохода (удваивается до EXPIRY_RECONCILE_INTERVAL), сек
+EXPIRY_RETRY_DELAY = float(os.getenv('EXPIRY_RETRY_DELAY', '5'))
+
+# Канал Postgres, в который отправляется NOTIFY при изменении срока окончания подписки
+EXPIRY_NOTIFY_CHANNEL = 'subscription_expiry_changed'
+
+
+async def notify_expiry_changed(session, changes):
+    """
+    Сообщает ведущему процессу новые сроки окончания подписок одним NOTIFY (доставляется после коммита).
+    changes - пары (subscription_id, end_date), end_date=None убирает подписку из расписания.
+    """
+    if not changes:
+        return
+    payload = json.dumps([[subscription_id, end_date.isoformat() if end_date else None] for subscription_id, end_date in changes])
+    await session.execute(select(func.pg_notify(EXPIRY_NOTIFY_CHANNEL, payload)))
+
+
+class ExpiryScheduler:
+    """
+    Планировщик окончания подписок на min-heap по UserSubscription.end_date.
+
+    При старте загружает подписки, истекающие в ближайшие EXPIRY_WINDOW_HOURS, и спит ровно
+    до ближайшего срока. Куча есть только в ведущем процессе: сервис подписок в любом процессе
+    сообщает об изменениях через notify_expiry_changed() в своей транзакции, ведущий получает их
+    по LISTEN (listen_for_changes) и вызывает schedule()/cancel().
+    Раз в EXPIRY_RECONCILE_INTERVAL выполняется сверочный проход и окно перезагружается -
+    это страховка от изменений без уведомления (например, из SubscriptionManager).
+    """
+
+    def __init__(self, async_session_maker=None, window_hours=EXPIRY_WINDOW_HOURS, reconcile_interval=EXPIRY_RECONCILE_INTERVAL,
+                 retry_delay=EXPIRY_RETRY_DELAY):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.window = timedelta(hours=window_hours)
+        self.reconcile_interval = reconcile_interval
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._deadlines = {}
+        self._horizon = None
+        self._wakeup = asyncio.Event()
+        self._reload = False
+        self._loading = None
+
+    def schedule(self, subscription_id, end_date):
+        """Запланировать (или перенести) окончание подписки"""
+        if self._loading is not None:
+            # Окно перезагружается: изменение применится поверх загруженного
+            self._loading.append((subscription_id, end_date))
+        if self._horizon is not None and end_date > self._horizon:
+            # За пределами окна: подписка попадет в кучу при следующей загрузке окна
+            self._deadlines.pop(subscription_id, None)
+            return
+        self._deadlines[subscription_id] = end_date
+        heapq.heappush(self._heap, (end_date, subscription_id))
+        if self._heap[0] == (end_date, subscription_id):
+            self._wakeup.set()
+
+    def __len__(self):
+        """Количество подписок в расписании"""
+        return len(self._deadlines)
+
+    def cancel(self, subscription_id):
+        """Убрать подписку из расписания (запись в куче удаляется лениво)"""
+        if self._loading is not None:
+            self._loading.append((subscription_id, None))
+        self._deadlines.pop(subscription_id, None)
+
+    def apply_notification(self, payload):
+        """Применяет уведомление notify_expiry_changed"""
+        for subscription_id, end_date in json.loads(payload):
+            if end_date is None:
+                self.cancel(subscription_id)
+            else:
+                self.schedule(subscription_id, datetime.fromisoformat(end_date))
+
+    def request_reload(self):
+        """Перезагрузить окно при следующей итерации цикла (уведомления могли быть потеряны)"""
+        self._reload = True
+        self._wakeup.set()
+
+    def next_deadline(self):
+        """Ближайший актуальный срок окончания или None"""
+        while self._heap:
+            end_date, subscription_id = self._heap[0]
+            if self._deadlines.get(subscription_id) == end_date:
+                return end_date
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        """Извлекает ID подписок, срок которых наступил"""
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                return due
+            _, subscription_id = heapq.heappop(self._heap)
+            del self._deadlines[subscription_id]
+            due.append(subscription_id)
+
+    async def load_window(self, now=None):
+        """Перезагружает кучу из базы: активные подписки, истекающие до now + окно"""
+        now = now or datetime.utcnow()
+        horizon = now + self.window
+        self._loading = []
+        try:
+            async with self.async_session_maker() as session:
+                result = await session.execute(
+                    select(UserSubscription.id, UserSubscription.end_date)
+                    .where(UserSubscription.is_active == True, UserSubscription.end_date <= horizon)
+                )
+                rows = result.all()
+            self._deadlines = {row.id: row.end_date for row in rows}
+            self._heap = [(end_date, subscription_id) for subscription_id, end_date in self._deadlines.items()]
+            heapq.heapify(self._heap)
+            self._horizon = horizon
+            # Уведомления, пришедшие во время запроса, могли не попасть в его снимок
+            changes, self._loading = self._loading, None
+        finally:
+            self._loading = None
+        for subscription_id, end_date in changes:
+            if end_date is None:
+                self.cancel(subscription_id)
+            else:
+                self.schedule(subscription_id, end_date)
+        logging.info(f"[EXPIRY] Загружено сроков окончания подписок: {len(rows)} (до {horizon:%d.%m.%Y %H:%M})")
+
+    async def run(self, on_due):
+        """
+        Основной цикл: вызывает on_due(now) при наступлении срока любой подписки
+        и при каждом сверочном проходе.
+        """
+        loaded = False
+        last_reconcile = time.monotonic()
+        retry_delay = self.retry_delay
+        while True:
+            try:
+                if not loaded:
+                    await self.load_window()
+                    loaded = True
+                    last_reconcile = time.monotonic()
+                now = datetime.utcnow()
+                due = self.pop_due(now)
+                if due:
+                    logging.info(f"[EXPIRY] Наступил срок окончания подписок: {len(due)}")
+                    await on_due(now)
+                if self._reload:
+                    await on_due(now)
+                    await self.load_window()
+                    self._reload = False
+                elif time.monotonic() - last_reconcile >= self.reconcile_interval:
+                    await on_due(now)
+                    await self.load_window()
+                    last_reconcile = time.monotonic()
+                retry_delay = self.retry_delay
+            except Exception as e:
+                # Загрузка окна (первая или повторная) и проход повторяются с растущей задержкой
+                logging.error(f"[EXPIRY] Ошибка в планировщике окончания подписок: {e}, повтор через {retry_delay} сек")
+                if loaded:
+                    self._reload = True
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, self.reconcile_interval)
+                continue
+            timeout = self.reconcile_interval - (time.monotonic() - last_reconcile)
+            deadline = self.next_deadline()
+            if deadline is not None:
+                # Небольшой запас, чтобы end_date < now уже выполнялось при проверке
+                timeout = min(timeout, (deadline - datetime.utcnow()).total_seconds() + 0.05)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+    async def listen_for_changes(self, engine):
+        """
+        Держит отдельное соединение с LISTEN на канал сроков окончания (только в ведущем процессе).
+        При обрыве соединения подписка восстанавливается, а окно перезагружается,
+        так как уведомления за время простоя могли быть потеряны.
+        """
+        def on_notify(connection, pid, channel, payload):
+            try:
+                self.apply_notification(payload)
+            except Exception as e:
+                logging.error(f"[EXPIRY] Некорректное уведомление о сроке окончания {payload!r}: {e}")
+
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    raw_connection = await conn.get_raw_connection()
+                    driver_connection = raw_connection.driver_connection
+                    await driver_connection.add_listener(EXPIRY_NOTIFY_CHANNEL, on_notify)
+                    logging.info(f"[EXPIRY] Подписка на канал {EXPIRY_NOTIFY_CHANNEL} установлена")
+                    try:
+                        while not driver_connection.is_closed():
+                            await asyncio.sleep(30)
+                    finally:
+                        if not driver_connection.is_closed():
+                            await driver_connection.remove_listener(EXPIRY_NOTIFY_CHANNEL, on_notify)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"[EXPIRY] Ошибка подписки на изменения сроков окончания: {e}")
+            self.request_reload()
+            await asyncio.sleep(5)
+
+
+# Глобальный экземпляр планировщика окончания подписок
+expiry_scheduler = ExpiryScheduler()
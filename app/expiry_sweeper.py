@@ -0,0 +1,171 @@
+from app.database import User, SubscriptionPlan, UserSubscription
+from app.subscription_service import subscription_service
+from app.outbox import outbox_worker, enqueue, ban_intent, revoke_link_intent, notify_intent
+from app.leader import leader_fence
+from app.subscription_info import notify_subscription_info_changed
+from app.metrics import SWEEP_DURATION, SWEEP_PROCESSED
+from app.stats import StatsDelta, record_stats
+from datetime import datetime
+from sqlalchemy import select, update, func
+import logging
+import os
+import time
+
+# Сколько истекших подписок забирается из базы за раз
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', '500'))
+
+
+def id_range_filter(column, id_range):
+    """Условия отбора по диапазону id (lo, hi) включительно; None - без границы"""
+    if id_range is None:
+        return []
+    lo, hi = id_range
+    conditions = []
+    if lo is not None:
+        conditions.append(column >= lo)
+    if hi is not None:
+        conditions.append(column <= hi)
+    return conditions
+
+
+def ranges_from_boundaries(boundaries):
+    """Превращает отсортированные начала диапазонов в список (lo, hi); последний диапазон открыт сверху"""
+    return [
+        (lo, boundaries[index + 1] - 1 if index + 1 < len(boundaries) else None)
+        for index, lo in enumerate(boundaries)
+    ]
+
+
+EXPIRED_TEXT = "❌ Ваша подписка истекла. Доступ к каналу отозван. Оформите новую подписку для восстановления доступа."
+
+
+def expiry_intents(row):
+    """Действия в Telegram по истекшей подписке: удаление из канала, отзыв ссылки, уведомление"""
+    # Ключ включает end_date: после продления и нового окончания действия выполняются снова
+    key = f"{row.id}:{row.end_date:%Y%m%d%H%M%S}"
+    intents = []
+    if row.channel_id:
+        intents.append(ban_intent(row.channel_id, row.telegram_user_id, dedupe_key=f"ban:{key}"))
+        if row.invite_link:
+            intents.append(revoke_link_intent(row.channel_id, row.invite_link))
+    intents.append(notify_intent(row.telegram_user_id, EXPIRED_TEXT, dedupe_key=f"expired:{key}"))
+    return intents
+
+
+class ExpirySweeper:
+    """
+    Массовый отзыв доступа по истекшим подпискам.
+
+    Истекшие подписки забираются пачками одним UPDATE ... RETURNING с join на users и subscription_plans:
+    подписка сразу деактивируется, и в той же транзакции в outbox записываются удаление из канала,
+    отзыв ссылки и уведомление. Вызовы Bot API выполняет outbox_worker, поэтому проход по базе
+    не зависит от скорости Telegram.
+    """
+
+    def __init__(self, service, outbox=outbox_worker, batch_size=SWEEP_BATCH_SIZE):
+        self.service = service
+        self.outbox = outbox
+        self.batch_size = batch_size
+
+    async def partition(self, chunk_size, horizon):
+        """
+        Делит активные подписки с end_date <= horizon на диапазоны id примерно по chunk_size подписок.
+        Возвращает список (lo, hi) для параллельной обработки несколькими воркерами.
+        """
+        numbered = (
+            select(UserSubscription.id, func.row_number().over(order_by=UserSubscription.id).label('rn'))
+            .where(UserSubscription.is_active == True, UserSubscription.end_date <= horizon)
+            .subquery()
+        )
+        # Из базы возвращаются только границы диапазонов, а не все id
+        stmt = select(numbered.c.id).where((numbered.c.rn - 1) % chunk_size == 0).order_by(numbered.c.id)
+        async with self.service.async_session_maker() as session:
+            result = await session.execute(stmt)
+            return ranges_from_boundaries(result.scalars().all())
+
+    async def claim_expired(self, limit, now=None, id_range=None):
+        """
+        Деактивирует до limit истекших подписок, записывает действия по ним в outbox
+        и возвращает их строки (id, user_id, end_date, telegram_user_id, channel_id, invite_link, plan_id)
+        """
+        now = now or datetime.utcnow()
+        # FOR UPDATE SKIP LOCKED позволяет нескольким процессам забирать разные пачки
+        due = (
+            select(UserSubscription.id, UserSubscription.invite_link)
+            .where(
+                UserSubscription.is_active == True,
+                UserSubscription.end_date < now,
+                *id_range_filter(UserSubscription.id, id_range)
+            )
+            .order_by(UserSubscription.end_date)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .cte('due')
+        )
+        stmt = (
+            update(UserSubscription)
+            .where(
+                UserSubscription.id == due.c.id,
+                User.id == UserSubscription.user_id,
+                SubscriptionPlan.id == UserSubscription.plan_id,
+                *leader_fence()
+            )
+            .values(is_active=False, invite_link=None)
+            .returning(
+                UserSubscription.id,
+                UserSubscription.user_id,
+                UserSubscription.end_date,
+                User.telegram_user_id,
+                SubscriptionPlan.channel_id,
+                due.c.invite_link,
+                UserSubscription.plan_id
+            )
+            .execution_options(synchronize_session=False)
+        )
+        async with self.service.async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(stmt)
+                rows = result.all()
+                await enqueue(session, [intent for row in rows for intent in expiry_intents(row)], now=now)
+                delta = StatsDelta()
+                for row in rows:
+                    delta.add(row.end_date, row.plan_id, expirations=1, active_delta=-1)
+                await record_stats(session, delta)
+                await notify_subscription_info_changed(session, [row.telegram_user_id for row in rows])
+                return rows
+
+    async def sweep(self, now=None, id_range=None):
+        """
+        Обрабатывает все истекшие на момент now подписки (в диапазоне id_range, если задан)
+        и возвращает статистику прохода.
+        """
+        now = now or datetime.utcnow()
+        started = time.monotonic()
+        claimed = 0
+        while True:
+            rows = await self.claim_expired(self.batch_size, now=now, id_range=id_range)
+            if not rows:
+                break
+            claimed += len(rows)
+            for row in rows:
+                self.service.invalidate_subscription_info(row.telegram_user_id)
+                if row.invite_link:
+                    await self.service.invite_link_index.evict(row.invite_link)
+            self.outbox.wake()
+            if len(rows) < self.batch_size:
+                break
+        elapsed = time.monotonic() - started
+        SWEEP_DURATION.labels('expiry').observe(elapsed)
+        SWEEP_PROCESSED.labels('expiry').inc(claimed)
+        stats = {
+            'claimed': claimed,
+            'elapsed': elapsed,
+            'per_second': claimed / elapsed if elapsed > 0 else 0.0,
+        }
+        if claimed:
+            logging.info(f"[SWEEP] Деактивировано истекших подписок: {claimed} за {elapsed:.1f} сек, {stats['per_second']:.1f} подписок/сек")
+        return stats
+
+
+# Глобальный экземпляр обработчика истекших подписок
+expiry_sweeper = ExpirySweeper(subscription_service)
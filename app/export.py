@@ -0,0 +1,230 @@
+from app.database import get_async_session_maker, User, UserSubscription, SubscriptionPlan, PaymentError
+from datetime import datetime, date, timedelta
+from sqlalchemy import select
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+
+# Сколько строк читается с серверного курсора и записывается за раз
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+# Сколько выгрузок по запросу администраторов выполняется одновременно
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', '1'))
+# Лимит размера файла, отправляемого ботом (Bot API принимает документы до 50 МБ)
+EXPORT_MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
+def _subscriptions_query():
+    return (
+        select(
+            UserSubscription.id,
+            User.telegram_user_id,
+            UserSubscription.plan_id,
+            SubscriptionPlan.name.label('plan_name'),
+            SubscriptionPlan.price,
+            UserSubscription.start_date,
+            UserSubscription.end_date,
+            UserSubscription.is_active,
+            UserSubscription.provider_payment_charge_id,
+        )
+        .join(User, User.id == UserSubscription.user_id)
+        .join(SubscriptionPlan, SubscriptionPlan.id == UserSubscription.plan_id)
+        .order_by(UserSubscription.id)
+    ), UserSubscription.start_date, UserSubscription.plan_id
+
+
+def _payment_errors_query():
+    # payment_info и stack_trace в выгрузку не входят: бухгалтерии нужны суммы и ID транзакций
+    return (
+        select(
+            PaymentError.id,
+            PaymentError.telegram_user_id,
+            PaymentError.plan_id,
+            PaymentError.provider_payment_charge_id,
+            PaymentError.payment_amount,
+            PaymentError.payment_currency,
+            PaymentError.payment_time,
+            PaymentError.invoice_payload,
+            PaymentError.error_message,
+            PaymentError.is_resolved,
+            PaymentError.resolution_notes,
+            PaymentError.resolution_time,
+        )
+        .order_by(PaymentError.id)
+    ), PaymentError.payment_time, PaymentError.plan_id
+
+
+def _users_query():
+    return select(User.id, User.telegram_user_id, User.is_active, User.email).order_by(User.id), None, None
+
+
+# Набор данных -> (запрос, колонка для фильтра по датам, колонка тарифа)
+DATASETS = {
+    'subscriptions': _subscriptions_query,
+    'payment_errors': _payment_errors_query,
+    'users': _users_query,
+}
+
+
+def export_query(dataset, since=None, until=None, plan_id=None):
+    """Запрос выгрузки; since включительно, until - не включительно"""
+    if dataset not in DATASETS:
+        raise ValueError(f"Неизвестный набор данных: {dataset} (доступны: {', '.join(DATASETS)})")
+    query, date_column, plan_column = DATASETS[dataset]()
+    if (since or until) and date_column is None:
+        raise ValueError(f"Набор {dataset} не фильтруется по датам")
+    if plan_id is not None and plan_column is None:
+        raise ValueError(f"Набор {dataset} не фильтруется по тарифу")
+    if since:
+        query = query.where(date_column >= since)
+    if until:
+        query = query.where(date_column < until)
+    if plan_id is not None:
+        query = query.where(plan_column == plan_id)
+    return query
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+class RowWriter:
+    """Построчная запись CSV или JSONL (опционально gzip) в бинарный файл"""
+
+    def __init__(self, fileobj, fmt='csv', compress=False):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+        self.fmt = fmt
+        self._gzip = gzip.GzipFile(fileobj=fileobj, mode='wb') if compress else None
+        self._raw = self._gzip or fileobj
+        self._buffer = io.StringIO()
+        self._csv = csv.writer(self._buffer)
+        self.header_written = False
+
+    def write_rows(self, columns, rows):
+        if self.fmt == 'csv':
+            if not self.header_written:
+                self._csv.writerow(columns)
+            self._csv.writerows([[_value(value) for value in row] for row in rows])
+        else:
+            for row in rows:
+                self._buffer.write(json.dumps(dict(zip(columns, map(_value, row))), ensure_ascii=False) + '\n')
+        self.header_written = True
+        self._raw.write(self._buffer.getvalue().encode())
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def close(self):
+        if self._gzip is not None:
+            self._gzip.close()
+
+
+class Exporter:
+    """
+    Потоковая выгрузка таблиц для бухгалтерии.
+
+    Строки читаются с серверного курсора (session.stream с yield_per) пачками по chunk_size и сразу
+    записываются в файл, поэтому память не зависит от размера таблицы. Запись и сжатие пачки
+    выполняются в отдельном потоке, чтобы не задерживать event loop бота.
+    """
+
+    def __init__(self, async_session_maker=None, chunk_size=EXPORT_CHUNK_SIZE):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.chunk_size = chunk_size
+
+    async def export(self, fileobj, dataset, fmt='csv', compress=False, since=None, until=None, plan_id=None):
+        """Пишет выгрузку в бинарный файл fileobj. Возвращает число строк"""
+        query = export_query(dataset, since, until, plan_id).execution_options(yield_per=self.chunk_size)
+        writer = RowWriter(fileobj, fmt, compress)
+        count = 0
+        async with self.async_session_maker() as session:
+            result = await session.stream(query)
+            columns = list(result.keys())
+            async for rows in result.partitions():
+                await asyncio.to_thread(writer.write_rows, columns, rows)
+                count += len(rows)
+        if not writer.header_written:
+            await asyncio.to_thread(writer.write_rows, columns, [])
+        await asyncio.to_thread(writer.close)
+        return count
+
+    async def export_to_file(self, dataset, fmt='csv', compress=False, directory=None, **filters):
+        """Выгрузка во временный файл. Возвращает (путь, число строк); файл удаляет вызывающий"""
+        suffix = f".{fmt}{'.gz' if compress else ''}"
+        handle, path = tempfile.mkstemp(prefix=f"{dataset}_{datetime.utcnow():%Y%m%d_%H%M%S}_", suffix=suffix, dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as fileobj:
+                count = await self.export(fileobj, dataset, fmt, compress, **filters)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path, count
+
+
+def parse_export_args(args):
+    """
+    Аргументы команды /export: <набор> [csv|jsonl] [gzip] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [plan=N].
+    Возвращает kwargs для Exporter.export_to_file; дата окончания включительно
+    """
+    if not args:
+        raise ValueError(f"Укажите набор данных: {', '.join(DATASETS)}")
+    options = {'dataset': args[0], 'fmt': 'csv', 'compress': False, 'since': None, 'until': None, 'plan_id': None}
+    dates = []
+    for arg in args[1:]:
+        if arg in EXPORT_FORMATS:
+            options['fmt'] = arg
+        elif arg == 'gzip':
+            options['compress'] = True
+        elif arg.startswith('plan='):
+            options['plan_id'] = int(arg[len('plan='):])
+        else:
+            dates.append(datetime.strptime(arg, '%Y-%m-%d'))
+    if len(dates) > 2:
+        raise ValueError("Укажите не больше двух дат: начало и конец периода")
+    if dates:
+        options['since'] = dates[0]
+    if len(dates) == 2:
+        options['until'] = dates[1] + timedelta(days=1)
+    # Проверка набора и применимости фильтров до запуска выгрузки
+    export_query(options['dataset'], options['since'], options['until'], options['plan_id'])
+    return options
+
+
+# Глобальный экземпляр выгрузки и ограничение одновременных выгрузок из бота
+exporter = Exporter()
+export_semaphore = asyncio.Semaphore(EXPORT_CONCURRENCY)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description='Потоковая выгрузка подписок, пользователей и ошибок платежей')
+    parser.add_argument('dataset', choices=list(DATASETS))
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='начало периода (включительно)')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='конец периода (не включительно)')
+    parser.add_argument('--plan', type=int)
+    parser.add_argument('-o', '--output', default='-', help="файл выгрузки ('-' - stdout)")
+    args = parser.parse_args()
+    filters = dict(since=args.since, until=args.until, plan_id=args.plan)
+    if args.output == '-':
+        count = await exporter.export(sys.stdout.buffer, args.dataset, args.format, args.gzip, **filters)
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.output, 'wb') as fileobj:
+            count = await exporter.export(fileobj, args.dataset, args.format, args.gzip, **filters)
+    logging.info(f"[EXPORT] Выгружено строк: {count}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    asyncio.run(_main())
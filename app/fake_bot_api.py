@@ -0,0 +1,328 @@
+"""
+Локальная замена Telegram Bot API для нагрузочного тестирования бота без сети.
+
+Сервер отвечает на методы, которые использует бот (sendMessage, sendInvoice, createChatInviteLink,
+revokeChatInviteLink, approve/declineChatJoinRequest, ban/unbanChatMember, answerPreCheckoutQuery,
+getUpdates), с настраиваемой задержкой и долей ошибок, возвращает 429 с retry_after при превышении
+лимитов Telegram и генерирует поток синтетических обновлений (оплаты, запросы на вступление, нажатия меню).
+
+Запуск:
+    python -m app.fake_bot_api --port 8081 --updates-per-second 50 --mix payment=1,join=1,menu=3
+    TELEGRAM_API_SERVER=http://127.0.0.1:8081 python app/main.py
+"""
+from app.message_dispatcher import TokenBucket
+from aiohttp import web
+from collections import Counter
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import re
+import time
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 в секунду на чат
+DEFAULT_GLOBAL_RATE = 30
+DEFAULT_CHAT_RATE = 1
+# Методы, на которые распространяются лимиты отправки
+RATE_LIMITED_METHODS = {'sendmessage', 'sendinvoice'}
+INVITE_LINK_RE = re.compile(r'https://t\.me/\+\S+')
+
+
+class FakeBotAPI:
+    """
+    Состояние и обработчики фейкового Bot API.
+
+    latency и jitter задают задержку ответа (сек), error_rate - долю ответов 500,
+    global_rate и chat_rate - лимиты отправки, при превышении которых возвращается 429 с retry_after.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, global_rate=DEFAULT_GLOBAL_RATE,
+                 chat_rate=DEFAULT_CHAT_RATE, bot_id=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.bot_id = bot_id
+        self.random = random.Random(seed)
+        self._global_bucket = TokenBucket(global_rate) if global_rate else None
+        self._chat_buckets = {}
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        # Ссылки-приглашения, отправленные пользователям: ссылка -> (chat_id пользователя, канал)
+        self.links = {}
+        self._channel_links = {}
+        self.calls = Counter()
+        self.rate_limited = 0
+        self.errors = 0
+
+    # --- обновления ---
+
+    def push_update(self, update):
+        """Кладет обновление в очередь getUpdates, update_id назначается автоматически"""
+        update = dict(update, update_id=next(self._update_ids))
+        self._updates.append(update)
+        self._new_updates.set()
+        return update
+
+    async def get_updates(self, offset=None, limit=100, timeout=0):
+        if offset:
+            # Как в Telegram: offset подтверждает получение всех обновлений с меньшим update_id
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    # --- лимиты и ошибки ---
+
+    def _check_rate(self, method, chat_id):
+        """Возвращает retry_after (сек), если запрос превышает лимиты, иначе 0"""
+        if method not in RATE_LIMITED_METHODS:
+            return 0
+        buckets = []
+        if self._global_bucket:
+            buckets.append(self._global_bucket)
+        if self.chat_rate and chat_id is not None:
+            buckets.append(self._chat_buckets.setdefault(str(chat_id), TokenBucket(self.chat_rate)))
+        waits = [bucket.reserve() for bucket in buckets]
+        if not any(waits):
+            return 0
+        # Отклоненный запрос токен не расходует
+        for bucket in buckets:
+            bucket.tokens += 1
+        return max(1, math.ceil(max(waits)))
+
+    async def _delay(self):
+        delay = self.latency + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # --- методы Bot API ---
+
+    def _bot_user(self):
+        return {'id': self.bot_id, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+    def _message(self, chat_id, **fields):
+        return {'message_id': next(self._ids), 'date': int(time.time()), 'chat': {'id': int(chat_id), 'type': 'private'},
+                'from': self._bot_user(), **fields}
+
+    def _send_message(self, params):
+        text = params.get('text', '')
+        # Запоминаем выданные пользователю ссылки, чтобы генерировать по ним запросы на вступление
+        for link in INVITE_LINK_RE.findall(text):
+            channel_id = self._channel_links.get(link)
+            if channel_id is not None:
+                self.links[link] = (int(params['chat_id']), channel_id)
+        return self._message(params['chat_id'], text=text)
+
+    def _send_invoice(self, params):
+        return self._message(params['chat_id'], invoice={
+            'title': params.get('title', ''), 'description': params.get('description', ''),
+            'start_parameter': params.get('start_parameter', ''), 'currency': params.get('currency', 'RUB'),
+            'total_amount': sum(price['amount'] for price in params.get('prices', []))
+        })
+
+    def _create_chat_invite_link(self, params):
+        link = f'https://t.me/+fake{next(self._ids)}'
+        self._channel_links[link] = int(params['chat_id'])
+        return {'invite_link': link, 'creator': self._bot_user(), 'creates_join_request': bool(params.get('creates_join_request')),
+                'is_primary': False, 'is_revoked': False, 'name': params.get('name'),
+                'expire_date': params.get('expire_date'), 'member_limit': params.get('member_limit')}
+
+    def _revoke_chat_invite_link(self, params):
+        link = params['invite_link']
+        self._channel_links.pop(link, None)
+        self.links.pop(link, None)
+        return {'invite_link': link, 'creator': self._bot_user(), 'creates_join_request': True,
+                'is_primary': False, 'is_revoked': True}
+
+    async def call(self, method, params):
+        """Выполняет метод Bot API. Возвращает (HTTP-статус, тело ответа)"""
+        method = method.lower()
+        self.calls[method] += 1
+        await self._delay()
+        retry_after = self._check_rate(method, params.get('chat_id'))
+        if retry_after:
+            self.rate_limited += 1
+            return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                         'parameters': {'retry_after': retry_after}}
+        if method != 'getupdates' and self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+        handlers = {
+            'getme': lambda p: self._bot_user(),
+            'sendmessage': self._send_message,
+            'sendinvoice': self._send_invoice,
+            'createchatinvitelink': self._create_chat_invite_link,
+            'revokechatinvitelink': self._revoke_chat_invite_link,
+        }
+        if method == 'getupdates':
+            result = await self.get_updates(int(params.get('offset') or 0), int(params.get('limit') or 100),
+                                            float(params.get('timeout') or 0))
+        elif method in handlers:
+            result = handlers[method](params)
+        elif method in ('approvechatjoinrequest', 'declinechatjoinrequest', 'banchatmember', 'unbanchatmember',
+                        'answerprecheckoutquery', 'answercallbackquery', 'setwebhook', 'deletewebhook'):
+            result = True
+        else:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+        return 200, {'ok': True, 'result': result}
+
+    async def handle(self, request):
+        params = {}
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            # aiogram передает вложенные объекты строками JSON
+            for key, value in (await request.post()).items():
+                try:
+                    params[key] = json.loads(value)
+                except (TypeError, ValueError):
+                    params[key] = value
+        status, body = await self.call(request.match_info['method'], params)
+        return web.json_response(body, status=status)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.get_stats())
+
+    def get_stats(self):
+        return {'calls': dict(self.calls), 'rate_limited': self.rate_limited, 'errors': self.errors,
+                'pending_updates': len(self._updates)}
+
+
+class UpdateGenerator:
+    """
+    Поток синтетических обновлений: оплаты (pre_checkout_query и successful_payment),
+    запросы на вступление по выданным ботом ссылкам и нажатия кнопок меню.
+    """
+
+    def __init__(self, api, plan_ids=(1,), users=100000, mix=None, first_user_id=10 ** 9):
+        self.api = api
+        self.plan_ids = list(plan_ids)
+        self.users = users
+        self.first_user_id = first_user_id
+        self.mix = mix or {'payment': 1, 'join': 1, 'menu': 3}
+        self._charges = itertools.count(1)
+
+    def _user(self):
+        user_id = self.first_user_id + self.api.random.randrange(self.users)
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def _private_message(self, user, **fields):
+        return {'message_id': next(self.api._ids), 'date': int(time.time()), 'chat': {'id': user['id'], 'type': 'private'},
+                'from': user, **fields}
+
+    def payment(self):
+        user = self._user()
+        payload = f'plan_{self.api.random.choice(self.plan_ids)}'
+        charge = next(self._charges)
+        self.api.push_update({'pre_checkout_query': {
+            'id': str(charge), 'from': user, 'currency': 'RUB', 'total_amount': 10000, 'invoice_payload': payload
+        }})
+        self.api.push_update({'message': self._private_message(user, successful_payment={
+            'currency': 'RUB', 'total_amount': 10000, 'invoice_payload': payload,
+            'telegram_payment_charge_id': f'fake_tg_{charge}', 'provider_payment_charge_id': f'fake_{charge}'
+        })})
+
+    def join(self):
+        if not self.api.links:
+            # Ссылок еще не выдано - запрос без ссылки, бот его отклонит
+            user, channel_id, link = self._user(), None, None
+        else:
+            link, (user_id, channel_id) = self.api.random.choice(list(self.api.links.items()))
+            user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+        request = {'chat': {'id': channel_id or -100, 'type': 'channel', 'title': 'Channel'}, 'from': user,
+                   'user_chat_id': user['id'], 'date': int(time.time())}
+        if link:
+            request['invite_link'] = {'invite_link': link, 'creator': self.api._bot_user(), 'creates_join_request': True,
+                                      'is_primary': False, 'is_revoked': False}
+        self.api.push_update({'chat_join_request': request})
+
+    def menu(self):
+        user = self._user()
+        if self.api.random.random() < 0.5:
+            self.api.push_update({'message': self._private_message(user, text='Управление подпиской')})
+        else:
+            self.api.push_update({'callback_query': {
+                'id': str(next(self.api._ids)), 'from': user, 'chat_instance': str(user['id']), 'data': 'buy_subscription',
+                'message': self._private_message(user, text='Выберите действие:', **{'from': self.api._bot_user()})
+            }})
+
+    def emit(self):
+        kinds = list(self.mix)
+        kind = self.api.random.choices(kinds, weights=[self.mix[k] for k in kinds])[0]
+        getattr(self, kind)()
+
+    async def run(self, rate, duration=None):
+        """Генерирует rate обновлений в секунду (duration сек или бесконечно)"""
+        started = time.monotonic()
+        emitted = 0
+        while duration is None or time.monotonic() - started < duration:
+            self.emit()
+            emitted += 1
+            await asyncio.sleep(max(0.0, started + emitted / rate - time.monotonic()))
+        return emitted
+
+
+def create_fake_bot_api_app(api):
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', api.handle)
+    app.router.add_get('/bot{token}/{method}', api.handle)
+    app.router.add_get('/stats', api.handle_stats)
+    return app
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('payment', 'join', 'menu'):
+            raise ValueError(f"Неизвестный вид обновлений: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+async def serve(args):
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                     global_rate=args.global_rate, chat_rate=args.chat_rate, seed=args.seed)
+    runner = web.AppRunner(create_fake_bot_api_app(api))
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logging.info(f"[FAKE_API] Фейковый Bot API слушает http://{args.host}:{args.port}")
+    try:
+        if args.updates_per_second:
+            generator = UpdateGenerator(api, plan_ids=[int(p) for p in args.plan_ids.split(',')], users=args.users,
+                                        mix=parse_mix(args.mix))
+            await generator.run(args.updates_per_second, args.duration)
+            logging.info(f"[FAKE_API] Генерация обновлений завершена: {api.get_stats()}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Фейковый Telegram Bot API для нагрузочного тестирования')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help='Задержка ответа, сек')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Разброс задержки, сек')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 500')
+    parser.add_argument('--global-rate', type=float, default=DEFAULT_GLOBAL_RATE, help='Лимит сообщений в секунду на бота (0 - без лимита)')
+    parser.add_argument('--chat-rate', type=float, default=DEFAULT_CHAT_RATE, help='Лимит сообщений в секунду на чат (0 - без лимита)')
+    parser.add_argument('--updates-per-second', type=float, default=0, help='Скорость генерации обновлений')
+    parser.add_argument('--duration', type=float, default=None, help='Длительность генерации, сек')
+    parser.add_argument('--mix', default='payment=1,join=1,menu=3', help='Доли видов обновлений')
+    parser.add_argument('--plan-ids', default='1,2', help='ID тарифов для оплат')
+    parser.add_argument('--users', type=int, default=100000, help='Количество различных пользователей')
+    parser.add_argument('--seed', type=int, default=None)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,372 @@
+from app.database import get_async_session_maker, UserSubscription, SubscriptionPlan, User
+from app.plan_catalog import PlanCatalog
+from app.invite_link_pool import invite_link_pool
+from app.outbox import enqueue, notify_intent, revoke_link_intent
+from app.stats import StatsDelta, record_stats
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+from sqlalchemy import select, text
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+
+# Сколько записей загружается в базу одной транзакцией (COPY во временную таблицу + два INSERT ... SELECT)
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '5000'))
+# Сколько импортированных подписок получает ссылки-приглашения за одну транзакцию и пауза, когда пул ссылок пуст
+IMPORT_LINK_BATCH_SIZE = int(os.getenv('IMPORT_LINK_BATCH_SIZE', '50'))
+IMPORT_LINK_RETRY_INTERVAL = float(os.getenv('IMPORT_LINK_RETRY_INTERVAL', '10'))
+
+# Импортированные подписки помечаются ключом в provider_payment_charge_id: повторная загрузка той же записи ничего не меняет
+IMPORT_KEY_PREFIX = 'import:'
+
+IMPORT_LINK_TEXT = (
+    "Ваша подписка перенесена и действует до {end_date:%d.%m.%Y}.\n"
+    "Ссылка для вступления в канал: {invite_link}\n"
+    "⚠️ Перейдя по ссылке, нажмите 'Запросить вступление'. Ваш запрос будет автоматически одобрен."
+)
+
+_STAGING_COLUMNS = ['telegram_user_id', 'email', 'plan_id', 'start_date', 'end_date', 'import_key']
+
+_CREATE_STAGING = """
+CREATE TEMP TABLE import_staging (
+    telegram_user_id text NOT NULL,
+    email text,
+    plan_id integer NOT NULL,
+    start_date timestamp NOT NULL,
+    end_date timestamp NOT NULL,
+    import_key text NOT NULL
+) ON COMMIT DROP
+"""
+
+_UPSERT_USERS = """
+INSERT INTO users (telegram_user_id, is_active, email)
+SELECT DISTINCT ON (telegram_user_id) telegram_user_id, true, email
+FROM import_staging
+WHERE end_date > :now
+ORDER BY telegram_user_id, end_date DESC
+ON CONFLICT (telegram_user_id) DO UPDATE SET is_active = true, email = coalesce(excluded.email, users.email)
+"""
+
+# Более поздняя запись того же пользователя (из другой пачки или повторного файла) продлевает уже импортированную подписку.
+# Если новый тариф в другом канале, ссылка старого канала снимается с подписки (и отзывается через outbox),
+# а новую выдаст issue_invite_links
+_EXTEND_SUBSCRIPTIONS = """
+WITH latest AS (
+    SELECT DISTINCT ON (telegram_user_id) telegram_user_id, plan_id, end_date, import_key
+    FROM import_staging
+    WHERE end_date > :now
+    ORDER BY telegram_user_id, end_date DESC
+), target AS (
+    SELECT a.id, a.plan_id AS old_plan_id, a.invite_link AS old_invite_link, po.channel_id AS old_channel_id,
+           pn.channel_id IS DISTINCT FROM po.channel_id AS channel_changed, l.plan_id, l.end_date, l.import_key
+    FROM latest l
+    JOIN users u ON u.telegram_user_id = l.telegram_user_id
+    JOIN user_subscriptions a ON a.user_id = u.id AND a.is_active AND a.provider_payment_charge_id LIKE 'import:%'
+    JOIN subscription_plans po ON po.id = a.plan_id
+    JOIN subscription_plans pn ON pn.id = l.plan_id
+    WHERE l.end_date > a.end_date
+    FOR UPDATE OF a
+)
+UPDATE user_subscriptions a
+SET end_date = t.end_date, plan_id = t.plan_id, provider_payment_charge_id = t.import_key, reminder_sent = false,
+    invite_link = CASE WHEN t.channel_changed THEN NULL ELSE a.invite_link END
+FROM target t
+WHERE a.id = t.id
+RETURNING t.old_plan_id, a.plan_id, t.old_channel_id, CASE WHEN t.channel_changed THEN t.old_invite_link END AS revoked_link
+"""
+
+# Одна подписка на пользователя (с самой поздней датой окончания); пользователи с активной подпиской в боте пропускаются
+_INSERT_SUBSCRIPTIONS = """
+INSERT INTO user_subscriptions (user_id, plan_id, start_date, end_date, is_active, reminder_sent, provider_payment_charge_id)
+SELECT DISTINCT ON (u.id) u.id, s.plan_id, s.start_date, s.end_date, true, false, s.import_key
+FROM import_staging s
+JOIN users u ON u.telegram_user_id = s.telegram_user_id
+WHERE s.end_date > :now
+  AND NOT EXISTS (
+      SELECT 1 FROM user_subscriptions a
+      WHERE a.user_id = u.id AND a.is_active AND a.provider_payment_charge_id IS DISTINCT FROM s.import_key
+  )
+ORDER BY u.id, s.end_date DESC
+ON CONFLICT (provider_payment_charge_id) WHERE provider_payment_charge_id IS NOT NULL DO NOTHING
+RETURNING plan_id, start_date
+"""
+
+# Записи пачки, которые не создали и не продлили подписку (ключ записи не попал в user_subscriptions), с причиной
+_SKIPPED_RECORDS = """
+SELECT s.import_key, CASE
+    WHEN s.end_date <= :now THEN 'подписка уже закончилась'
+    WHEN EXISTS (
+        SELECT 1 FROM user_subscriptions a JOIN users u ON u.id = a.user_id
+        WHERE u.telegram_user_id = s.telegram_user_id AND a.is_active AND a.provider_payment_charge_id LIKE 'import:%'
+    ) THEN 'у пользователя уже импортирована подписка с более поздним окончанием'
+    ELSE 'у пользователя есть активная подписка в боте'
+END AS reason
+FROM import_staging s
+WHERE NOT EXISTS (SELECT 1 FROM user_subscriptions x WHERE x.provider_payment_charge_id = s.import_key)
+"""
+
+
+class UnreadableRecord(NamedTuple):
+    """Строка JSONL, которую не удалось разобрать: попадает в файл отклоненных, импорт продолжается"""
+    line: str
+    error: str
+
+
+def read_records(path, fmt=None):
+    """Записи файла CSV или JSONL по одной (формат определяется по расширению, если не указан)"""
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+    with open(path, newline='', encoding='utf-8') as fileobj:
+        if fmt == 'csv':
+            yield from csv.DictReader(fileobj)
+        else:
+            for line in fileobj:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield UnreadableRecord(line.rstrip('\n'), str(e))
+                    continue
+                if isinstance(record, dict):
+                    yield record
+                else:
+                    yield UnreadableRecord(line.rstrip('\n'), 'запись не является объектом JSON')
+
+
+def _parse_date(value):
+    """Дата ISO 8601; даты с часовым поясом приводятся к UTC без пояса, как в остальных таблицах"""
+    if not value:
+        return None
+    value = datetime.fromisoformat(value) if isinstance(value, str) else value
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class SubscriptionImporter:
+    """
+    Массовый перенос подписчиков из другой системы.
+
+    Записи (telegram_user_id, plan - ID или название тарифа, start_date, end_date, email, id) читаются из файла
+    по одной и загружаются пачками: COPY во временную таблицу, upsert пользователей и вставка подписок
+    запросами INSERT ... SELECT в одной транзакции. Более поздняя запись пользователя продлевает его
+    импортированную подписку, в том числе из другой пачки; записи, не создавшие и не продлившие подписку,
+    попадают в файл отклоненных с причиной. После каждой пачки сохраняется контрольная точка,
+    поэтому прерванный импорт продолжается с места остановки; повтор уже загруженной пачки ничего не меняет
+    благодаря ключу записи в provider_payment_charge_id. Ссылки-приглашения при импорте не создаются,
+    их выдает issue_invite_links из пула ссылок.
+    """
+
+    def __init__(self, async_session_maker=None, batch_size=IMPORT_BATCH_SIZE):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.plan_catalog = PlanCatalog(self.async_session_maker)
+        self.batch_size = batch_size
+        self._plans_by_name = {}
+        self._plans_by_id = {}
+
+    async def load_plans(self):
+        plans = await self.plan_catalog.get_plans()
+        self._plans_by_id = {plan.id: plan for plan in plans}
+        self._plans_by_name = {plan.name.strip().lower(): plan for plan in plans}
+
+    def resolve_plan(self, value):
+        """Тариф по ID или названию (без учета регистра) или None"""
+        value = str(value or '').strip()
+        if value.isdigit() and int(value) in self._plans_by_id:
+            return self._plans_by_id[int(value)]
+        return self._plans_by_name.get(value.lower())
+
+    def prepare(self, record, number, source):
+        """Строка для временной таблицы или ValueError с причиной отказа (в том числе от неверной даты)"""
+        telegram_user_id = str(record.get('telegram_user_id') or '').strip()
+        if not telegram_user_id:
+            raise ValueError('нет telegram_user_id')
+        plan = self.resolve_plan(record.get('plan_id') or record.get('plan'))
+        if plan is None:
+            raise ValueError(f"неизвестный тариф: {record.get('plan_id') or record.get('plan')}")
+        start_date = _parse_date(record.get('start_date')) or datetime.utcnow()
+        end_date = _parse_date(record.get('end_date')) or start_date + timedelta(days=plan.duration_days)
+        external_id = record.get('id') or number
+        return (telegram_user_id, record.get('email') or None, plan.id, start_date, end_date,
+                f"{IMPORT_KEY_PREFIX}{source}:{external_id}")
+
+    async def load_batch(self, rows, now=None):
+        """
+        Загружает пачку строк одной транзакцией.
+        Возвращает (создано подписок, продлено подписок, [(ключ записи, причина пропуска)])
+        """
+        now = now or datetime.utcnow()
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                await session.execute(text(_CREATE_STAGING))
+                connection = await session.connection()
+                raw = await connection.get_raw_connection()
+                await raw.driver_connection.copy_records_to_table('import_staging', records=rows, columns=_STAGING_COLUMNS)
+                await session.execute(text(_UPSERT_USERS), {'now': now})
+                result = await session.execute(text(_EXTEND_SUBSCRIPTIONS), {'now': now})
+                extended = result.all()
+                result = await session.execute(text(_INSERT_SUBSCRIPTIONS), {'now': now})
+                created = result.all()
+                result = await session.execute(text(_SKIPPED_RECORDS), {'now': now})
+                skipped = [(row.import_key, row.reason) for row in result]
+                delta = StatsDelta()
+                for row in created:
+                    delta.add(row.start_date, row.plan_id, new_subscriptions=1, active_delta=1)
+                for row in extended:
+                    if row.old_plan_id != row.plan_id:
+                        delta.add(now, row.old_plan_id, active_delta=-1).add(now, row.plan_id, active_delta=1)
+                await record_stats(session, delta)
+                await enqueue(session, [revoke_link_intent(row.old_channel_id, row.revoked_link) for row in extended if row.revoked_link])
+        return len(created), len(extended), skipped
+
+    async def run(self, path, fmt=None, source=None, checkpoint_path=None, rejects_path=None):
+        """Импортирует файл, продолжая с контрольной точки, если она есть. Возвращает статистику"""
+        source = source or os.path.splitext(os.path.basename(path))[0]
+        checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+        rejects_path = rejects_path or f"{path}.rejects.jsonl"
+        state = {'offset': 0, 'created': 0, 'extended': 0, 'rejected': 0, 'skipped': 0, 'loaded': 0}
+        state.update(load_checkpoint(checkpoint_path) or {})
+        if state['offset']:
+            logging.info(f"[IMPORT] Продолжение импорта {path} с записи {state['offset']}")
+        await self.load_plans()
+        batch, records, rejected = [], {}, []
+        offset = 0
+        with open(rejects_path, 'a', encoding='utf-8') as rejects:
+            for offset, record in enumerate(read_records(path, fmt), start=1):
+                if offset <= state['offset']:
+                    continue
+                if isinstance(record, UnreadableRecord):
+                    rejected.append({'record': offset, 'reason': f"некорректная строка JSONL: {record.error}", 'data': record.line})
+                    continue
+                try:
+                    row = self.prepare(record, offset, source)
+                except ValueError as e:
+                    rejected.append({'record': offset, 'reason': str(e), 'data': record})
+                else:
+                    batch.append(row)
+                    records[row[-1]] = (offset, record)
+                if len(batch) >= self.batch_size:
+                    await self._commit_batch(batch, records, rejected, offset, state, checkpoint_path, rejects)
+                    batch, records, rejected = [], {}, []
+            await self._commit_batch(batch, records, rejected, offset, state, checkpoint_path, rejects)
+        logging.info(
+            f"[IMPORT] Импорт {path} завершен: записей {state['offset']}, загружено {state['loaded']}, "
+            f"создано подписок {state['created']}, продлено {state['extended']}, "
+            f"отклонено {state['rejected']}, пропущено {state['skipped']}"
+        )
+        return state
+
+    async def _commit_batch(self, batch, records, rejected, offset, state, checkpoint_path, rejects):
+        """Загружает пачку, затем записывает отклоненные записи и контрольную точку (при повторе пачки они не дублируются)"""
+        skipped = []
+        if batch:
+            created, extended, skipped = await self.load_batch(batch)
+            state['created'] += created
+            state['extended'] += extended
+            state['loaded'] += len(batch)
+        for import_key, reason in skipped:
+            number, record = records[import_key]
+            rejected.append({'record': number, 'reason': reason, 'data': record, 'skipped': True})
+        rejected.sort(key=lambda reject: reject['record'])
+        for reject in rejected:
+            rejects.write(json.dumps(reject, ensure_ascii=False, default=str) + '\n')
+        rejects.flush()
+        state['rejected'] += len(rejected) - len(skipped)
+        state['skipped'] += len(skipped)
+        state['offset'] = max(state['offset'], offset)
+        save_checkpoint(checkpoint_path, state)
+        if batch:
+            logging.info(f"[IMPORT] Записей обработано: {state['offset']}, создано подписок: {state['created']}")
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as fileobj:
+            return json.load(fileobj)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, state):
+    # Запись через временный файл: контрольная точка не бывает записана наполовину
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as fileobj:
+        json.dump(state, fileobj)
+    os.replace(tmp_path, path)
+
+
+async def issue_invite_links(async_session_maker=None, pool=invite_link_pool, batch_size=IMPORT_LINK_BATCH_SIZE,
+                             retry_interval=IMPORT_LINK_RETRY_INTERVAL):
+    """
+    Выдает ссылки-приглашения импортированным активным подпискам и отправляет их пользователям через outbox.
+
+    Ссылки берутся только из пула, поэтому скорость ограничена пополнением пула ботом
+    (INVITE_POOL_REFILL_RATE), а сообщения - лимитами очереди отправки. Когда пул канала пуст,
+    проход ждет retry_interval секунд. Возвращает число выданных ссылок.
+    """
+    async_session_maker = async_session_maker or get_async_session_maker()
+    issued = 0
+    while True:
+        async with async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(
+                    select(UserSubscription.id, UserSubscription.end_date, User.telegram_user_id, SubscriptionPlan.channel_id)
+                    .join(User, User.id == UserSubscription.user_id)
+                    .join(SubscriptionPlan, SubscriptionPlan.id == UserSubscription.plan_id)
+                    .where(
+                        UserSubscription.provider_payment_charge_id.startswith(IMPORT_KEY_PREFIX),
+                        UserSubscription.is_active == True,
+                        UserSubscription.invite_link.is_(None),
+                        SubscriptionPlan.channel_id.isnot(None)
+                    )
+                    .order_by(UserSubscription.id)
+                    .limit(batch_size)
+                    .with_for_update(of=UserSubscription, skip_locked=True)
+                )
+                rows = result.all()
+                intents = []
+                for row in rows:
+                    invite_link = await pool.attach(session, row.id, row.channel_id)
+                    if invite_link is None:
+                        break
+                    intents.append(notify_intent(
+                        row.telegram_user_id,
+                        IMPORT_LINK_TEXT.format(end_date=row.end_date, invite_link=invite_link),
+                        dedupe_key=f"import_link:{row.id}"
+                    ))
+                await enqueue(session, intents)
+        # Сообщения отправляет outbox_worker бота; индекс ссылок не заполняется - при промахе бот проверяет ссылку по базе
+        issued += len(intents)
+        if intents:
+            logging.info(f"[IMPORT] Выдано ссылок-приглашений: {issued}")
+        if not rows:
+            return issued
+        if len(intents) < len(rows):
+            logging.info(f"[IMPORT] Пул ссылок пуст, повтор через {retry_interval} сек")
+            await asyncio.sleep(retry_interval)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description='Массовый импорт подписчиков из другой системы')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    load_parser = subparsers.add_parser('load', help='загрузить пользователей и подписки из CSV/JSONL')
+    load_parser.add_argument('path')
+    load_parser.add_argument('--format', choices=['csv', 'jsonl'])
+    load_parser.add_argument('--source', help='имя источника в ключе импорта (по умолчанию - имя файла)')
+    load_parser.add_argument('--checkpoint', help='файл контрольной точки (по умолчанию <path>.checkpoint)')
+    load_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    subparsers.add_parser('links', help='выдать ссылки-приглашения импортированным подпискам из пула')
+    args = parser.parse_args()
+    if args.command == 'load':
+        importer = SubscriptionImporter(batch_size=args.batch_size)
+        await importer.run(args.path, fmt=args.format, source=args.source, checkpoint_path=args.checkpoint)
+    else:
+        await issue_invite_links()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
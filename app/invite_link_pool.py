@@ -0,0 +1,169 @@
+from app.database import get_async_session_maker, InviteLinkPoolEntry, UserSubscription
+from app.message_dispatcher import message_dispatcher, PRIORITY_BULK
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update, delete, func
+import asyncio
+import logging
+import os
+
+# Сколько свободных ссылок держать на каждый канал и с какой скоростью их создавать (ссылок в секунду)
+INVITE_POOL_SIZE = int(os.getenv('INVITE_POOL_SIZE', '20'))
+INVITE_POOL_REFILL_RATE = float(os.getenv('INVITE_POOL_REFILL_RATE', '1'))
+INVITE_POOL_REFILL_INTERVAL = float(os.getenv('INVITE_POOL_REFILL_INTERVAL', '10'))  # сек
+# Срок действия ссылок пула и минимальный остаток срока, с которым ссылка еще выдается пользователю
+INVITE_POOL_LINK_TTL_DAYS = float(os.getenv('INVITE_POOL_LINK_TTL_DAYS', '7'))
+INVITE_POOL_MIN_REMAINING_HOURS = float(os.getenv('INVITE_POOL_MIN_REMAINING_HOURS', '24'))
+
+
+class InviteLinkPool:
+    """
+    Пул заранее созданных ссылок-приглашений (creates_join_request, member_limit=1) для каждого канала.
+
+    Фоновый цикл run() держит в таблице invite_link_pool по INVITE_POOL_SIZE свободных ссылок на канал,
+    создавая недостающие не быстрее INVITE_POOL_REFILL_RATE в секунду, и отзывает ссылки, срок которых
+    подходит к концу. При оплате ссылка забирается из пула одним запросом внутри транзакции
+    (FOR UPDATE SKIP LOCKED), без обращения к Bot API.
+    """
+
+    def __init__(self, async_session_maker=None, dispatcher=message_dispatcher, size=INVITE_POOL_SIZE,
+                 refill_rate=INVITE_POOL_REFILL_RATE, refill_interval=INVITE_POOL_REFILL_INTERVAL,
+                 link_ttl_days=INVITE_POOL_LINK_TTL_DAYS, min_remaining_hours=INVITE_POOL_MIN_REMAINING_HOURS):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.dispatcher = dispatcher
+        self.size = size
+        self.refill_rate = refill_rate
+        self.refill_interval = refill_interval
+        self.link_ttl = timedelta(days=link_ttl_days)
+        self.min_remaining = timedelta(hours=min_remaining_hours)
+
+    async def attach(self, session, subscription_id, channel_id, now=None):
+        """
+        Забирает свободную ссылку канала и записывает её в подписку одним запросом в транзакции session.
+        Возвращает ссылку или None, если пул канала пуст.
+        """
+        now = now or datetime.utcnow()
+        # Ссылка забирается из пула, только если подписка существует: DELETE в CTE выполняется независимо от UPDATE
+        subscription_exists = select(UserSubscription.id).where(UserSubscription.id == subscription_id).exists()
+        candidate = (
+            select(InviteLinkPoolEntry.id)
+            .where(
+                InviteLinkPoolEntry.channel_id == str(channel_id),
+                InviteLinkPoolEntry.expires_at > now + self.min_remaining,
+                subscription_exists
+            )
+            .order_by(InviteLinkPoolEntry.expires_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        claimed = (
+            delete(InviteLinkPoolEntry)
+            .where(InviteLinkPoolEntry.id == candidate)
+            .returning(InviteLinkPoolEntry.invite_link)
+            .cte('claimed')
+        )
+        claimed_link = select(claimed.c.invite_link).scalar_subquery()
+        result = await session.execute(
+            update(UserSubscription)
+            .where(UserSubscription.id == subscription_id, claimed_link.isnot(None))
+            .values(invite_link=claimed_link)
+            .returning(UserSubscription.id, UserSubscription.invite_link)
+            .execution_options(synchronize_session=False)
+        )
+        row = result.first()
+        if row is None:
+            return None
+        if row.id != subscription_id or not row.invite_link:
+            raise RuntimeError(f"Ссылка пула не записана в подписку {subscription_id}")
+        return row.invite_link
+
+    async def available(self, now=None):
+        """Количество выдаваемых ссылок по каналам"""
+        now = now or datetime.utcnow()
+        async with self.async_session_maker() as session:
+            result = await session.execute(
+                select(InviteLinkPoolEntry.channel_id, func.count())
+                .where(InviteLinkPoolEntry.expires_at > now + self.min_remaining)
+                .group_by(InviteLinkPoolEntry.channel_id)
+            )
+            return dict(result.all())
+
+    async def recycle(self, now=None):
+        """Удаляет из пула ссылки с истекающим сроком и отзывает их. Возвращает количество"""
+        now = now or datetime.utcnow()
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(
+                    delete(InviteLinkPoolEntry)
+                    .where(InviteLinkPoolEntry.expires_at <= now + self.min_remaining)
+                    .returning(InviteLinkPoolEntry.channel_id, InviteLinkPoolEntry.invite_link)
+                )
+                rows = result.all()
+        if rows:
+            results = await asyncio.gather(*(
+                self.dispatcher.call('revoke_chat_invite_link', chat_id=row.channel_id, priority=PRIORITY_BULK, invite_link=row.invite_link)
+                for row in rows
+            ), return_exceptions=True)
+            errors = sum(isinstance(result, Exception) for result in results)
+            logging.info(f"[INVITE_POOL] Отозвано устаревших ссылок пула: {len(rows)} (ошибок: {errors})")
+        return len(rows)
+
+    async def _mint(self, channel_id, count, now):
+        links = []
+        for index in range(count):
+            if index:
+                await asyncio.sleep(1 / self.refill_rate)
+            try:
+                invite_link_obj = await self.dispatcher.call(
+                    'create_chat_invite_link',
+                    chat_id=channel_id,
+                    priority=PRIORITY_BULK,
+                    name='Subscription',
+                    creates_join_request=True,
+                    # Naive datetime aiogram переводит в timestamp по локальному времени сервера, поэтому передаем UTC явно
+                    expire_date=(now + self.link_ttl).replace(tzinfo=timezone.utc),
+                    member_limit=1  # ссылка одноразовая
+                )
+            except Exception as e:
+                logging.error(f"[INVITE_POOL] Ошибка при создании ссылки для канала {channel_id}: {e}")
+                break
+            links.append(invite_link_obj.invite_link)
+        return links
+
+    async def refill(self, channel_ids, now=None):
+        """Досоздает ссылки до size для каждого канала. Возвращает количество созданных ссылок"""
+        now = now or datetime.utcnow()
+        available = await self.available(now)
+        created = 0
+        for channel_id in channel_ids:
+            missing = self.size - available.get(str(channel_id), 0)
+            if missing <= 0:
+                continue
+            links = await self._mint(channel_id, missing, now)
+            if not links:
+                continue
+            async with self.async_session_maker() as session:
+                async with session.begin():
+                    session.add_all([
+                        InviteLinkPoolEntry(channel_id=str(channel_id), invite_link=link, expires_at=now + self.link_ttl)
+                        for link in links
+                    ])
+            created += len(links)
+            logging.info(f"[INVITE_POOL] Канал {channel_id}: создано ссылок {len(links)}, свободно {available.get(str(channel_id), 0) + len(links)}")
+        return created
+
+    async def run(self, plan_catalog):
+        """Фоновое пополнение пула для каналов всех тарифов каталога"""
+        while True:
+            try:
+                plans = await plan_catalog.get_plans()
+                channel_ids = sorted({str(plan.channel_id) for plan in plans if plan.channel_id})
+                await self.recycle()
+                await self.refill(channel_ids)
+            except Exception as e:
+                logging.error(f"[INVITE_POOL] Ошибка при пополнении пула ссылок: {e}")
+            await asyncio.sleep(self.refill_interval)
+
+
+# Глобальный экземпляр пула ссылок-приглашений
+invite_link_pool = InviteLinkPool()
@@ -0,0 +1,209 @@
+from app.database import get_async_session_maker, UserSubscription
+from app.cache import TTLCache
+from app.outbox import outbox_worker, enqueue, revoke_link_intent
+from app.subscription_info import notify_subscription_info_changed
+from app.storage import REDIS_URL
+from datetime import datetime
+from typing import NamedTuple, Optional
+from sqlalchemy import update, any_, literal, String
+from sqlalchemy.dialects.postgresql import ARRAY
+import redis.asyncio as aioredis
+import asyncio
+import json
+import logging
+import os
+
+# Где хранится индекс ссылок-приглашений: memory (один процесс) или redis (несколько реплик бота)
+INVITE_INDEX_BACKEND = os.getenv('INVITE_INDEX_BACKEND', 'memory').lower()
+INVITE_INDEX_TTL = int(os.getenv('INVITE_INDEX_TTL', str(7 * 24 * 3600)))  # Не дольше срока жизни ссылки, сек
+# Сколько хранится запись, прочитанная из базы при промахе индекса: такие записи не видят отзыв в другом процессе
+INVITE_INDEX_FALLBACK_TTL = int(os.getenv('INVITE_INDEX_FALLBACK_TTL', '300'))  # сек
+# Ссылки на отзыв копятся в буфере (память процесса или Redis, как индекс) и записываются в базу пачками
+INVITE_REVOKE_FLUSH_INTERVAL = float(os.getenv('INVITE_REVOKE_FLUSH_INTERVAL', '0.5'))  # сек
+INVITE_REVOKE_BATCH_SIZE = int(os.getenv('INVITE_REVOKE_BATCH_SIZE', '500'))
+
+
+class InviteLinkEntry(NamedTuple):
+    """Кому выдана ссылка-приглашение и до какого момента она действительна"""
+    telegram_user_id: str
+    subscription_id: int
+    channel_id: Optional[str]
+    expires_at: datetime
+
+    def allows(self, user_id, chat_id=None, now=None):
+        """Можно ли одобрить запрос на вступление от user_id (в канал chat_id) по этой ссылке"""
+        now = now or datetime.utcnow()
+        if chat_id is not None and self.channel_id is not None and str(self.channel_id) != str(chat_id):
+            return False
+        return self.telegram_user_id == str(user_id) and self.expires_at > now
+
+
+def _ttl_for(entry, ttl=None):
+    seconds = int((entry.expires_at - datetime.utcnow()).total_seconds())
+    return max(1, min(ttl or INVITE_INDEX_TTL, seconds))
+
+
+class InviteLinkIndex:
+    """Индекс invite_link -> InviteLinkEntry в памяти процесса"""
+
+    def __init__(self, maxsize=100000):
+        self._cache = TTLCache(INVITE_INDEX_TTL, maxsize=maxsize)
+
+    async def get(self, invite_link):
+        return self._cache.get(invite_link)
+
+    async def put(self, invite_link, entry, ttl=None):
+        self._cache.set(invite_link, entry, ttl=_ttl_for(entry, ttl))
+
+    async def evict(self, invite_link):
+        self._cache.pop(invite_link)
+
+
+class RedisInviteLinkIndex:
+    """Индекс invite_link -> InviteLinkEntry в Redis, общий для всех реплик бота"""
+
+    def __init__(self, url=REDIS_URL, prefix='invite_link:'):
+        self.redis = aioredis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, invite_link):
+        raw = await self.redis.get(self.prefix + invite_link)
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return InviteLinkEntry(
+            telegram_user_id=data['telegram_user_id'],
+            subscription_id=data['subscription_id'],
+            channel_id=data['channel_id'],
+            expires_at=datetime.fromisoformat(data['expires_at'])
+        )
+
+    async def put(self, invite_link, entry, ttl=None):
+        data = entry._asdict()
+        data['expires_at'] = entry.expires_at.isoformat()
+        await self.redis.set(self.prefix + invite_link, json.dumps(data), ex=_ttl_for(entry, ttl))
+
+    async def evict(self, invite_link):
+        await self.redis.delete(self.prefix + invite_link)
+
+
+def create_invite_link_index():
+    if INVITE_INDEX_BACKEND == 'redis':
+        return RedisInviteLinkIndex()
+    return InviteLinkIndex()
+
+
+class RevokeBuffer:
+    """Ссылки, ожидающие отзыва, в памяти процесса: invite_link -> (channel_id, telegram_user_id)"""
+
+    def __init__(self):
+        self._pending = {}
+
+    async def push(self, invite_link, channel_id, telegram_user_id=None):
+        self._pending[invite_link] = (channel_id, telegram_user_id)
+
+    async def take(self, limit):
+        items = [(invite_link, *value) for invite_link, value in list(self._pending.items())[:limit]]
+        for invite_link, _, _ in items:
+            del self._pending[invite_link]
+        return items
+
+    async def put_back(self, items):
+        for invite_link, channel_id, telegram_user_id in items:
+            self._pending.setdefault(invite_link, (channel_id, telegram_user_id))
+
+
+class RedisRevokeBuffer:
+    """Ссылки, ожидающие отзыва, в списке Redis: общий для всех реплик и не теряется при перезапуске процесса"""
+
+    def __init__(self, url=REDIS_URL, key='invite_link:revoke'):
+        self.redis = aioredis.from_url(url)
+        self.key = key
+
+    async def push(self, invite_link, channel_id, telegram_user_id=None):
+        await self.redis.rpush(self.key, json.dumps([invite_link, channel_id, telegram_user_id]))
+
+    async def take(self, limit):
+        values = await self.redis.lpop(self.key, limit)
+        return [tuple(json.loads(value)) for value in values or []]
+
+    async def put_back(self, items):
+        if items:
+            await self.redis.rpush(self.key, *(json.dumps(list(item)) for item in items))
+
+
+def create_revoke_buffer():
+    if INVITE_INDEX_BACKEND == 'redis':
+        return RedisRevokeBuffer()
+    return RevokeBuffer()
+
+
+class InviteLinkRevoker:
+    """
+    Отзыв ссылок-приглашений пачками через outbox.
+
+    schedule() удаляет ссылку из индекса и кладет её в буфер, не обращаясь к базе.
+    Цикл run() раз в INVITE_REVOKE_FLUSH_INTERVAL забирает из буфера до INVITE_REVOKE_BATCH_SIZE ссылок
+    и одной транзакцией очищает invite_link (UPDATE ... WHERE invite_link = ANY(:links)) и записывает
+    отзывы в outbox одним INSERT; revoke_chat_invite_link выполняет outbox_worker с повторами.
+    Буфер в памяти дописывается при остановке процесса (flush_all), буфер в Redis переживает и падение.
+    """
+
+    def __init__(self, index, async_session_maker=None, worker=outbox_worker, buffer=None,
+                 flush_interval=INVITE_REVOKE_FLUSH_INTERVAL, batch_size=INVITE_REVOKE_BATCH_SIZE):
+        self.index = index
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.worker = worker
+        self.buffer = buffer or create_revoke_buffer()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.on_revoked = None  # Вызывается с telegram_user_id после записи в базу
+
+    async def schedule(self, invite_link, channel_id, telegram_user_id=None):
+        await self.index.evict(invite_link)
+        await self.buffer.push(invite_link, str(channel_id), telegram_user_id)
+
+    async def flush(self):
+        """Записывает пачку ссылок из буфера в базу и outbox. Возвращает количество ссылок"""
+        items = await self.buffer.take(self.batch_size)
+        if not items:
+            return 0
+        try:
+            async with self.async_session_maker() as session:
+                async with session.begin():
+                    await session.execute(
+                        update(UserSubscription)
+                        .where(UserSubscription.invite_link == any_(literal([item[0] for item in items], ARRAY(String))))
+                        .values(invite_link=None)
+                        .execution_options(synchronize_session=False)
+                    )
+                    await enqueue(session, [revoke_link_intent(channel_id, invite_link) for invite_link, channel_id, _ in items])
+                    await notify_subscription_info_changed(session, [telegram_user_id for _, _, telegram_user_id in items])
+        except Exception:
+            # Вернем ссылки в буфер, чтобы записать их при следующем проходе
+            await self.buffer.put_back(items)
+            raise
+        self.worker.wake()
+        if self.on_revoked:
+            for _, _, telegram_user_id in items:
+                if telegram_user_id is not None:
+                    self.on_revoked(telegram_user_id)
+        logging.info(f"[INVITE] Отзыв ссылок записан в outbox пачкой: {len(items)}")
+        return len(items)
+
+    async def flush_all(self):
+        while await self.flush() >= self.batch_size:
+            pass
+
+    async def run(self):
+        while True:
+            try:
+                await self.flush_all()
+            except Exception as e:
+                logging.error(f"[INVITE] Ошибка при записи отзыва ссылок: {e}")
+            await asyncio.sleep(self.flush_interval)
+
+
+# Глобальные экземпляры индекса ссылок и отзыва ссылок
+invite_link_index = create_invite_link_index()
+invite_link_revoker = InviteLinkRevoker(invite_link_index)
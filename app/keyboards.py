@@ -1,73 +1,154 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from pydantic import ConfigDict, field_serializer
+import aiogram.types
+import functools
 
+# Сколько вариантов параметризованной клавиатуры хранится в кэше
+KEYBOARD_CACHE_SIZE = 256
 
-async def get_reply_keyboard(keyboard_type: str):
-    match keyboard_type:
-        case 'start':
-            reply_keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text='Управление подпиской')]
-                ],
-                resize_keyboard=True
-            )
-        case _:
-            raise ValueError(f"Неизвестный тип клавиатуры: {keyboard_type}")
-    return reply_keyboard
 
+# Общие клавиатуры отдаются всем хэндлерам одним объектом, поэтому хранятся в неизменяемом виде:
+# модели aiogram по умолчанию изменяемые, здесь модели frozen, а ряды кнопок - кортежи
+class FrozenKeyboardButton(KeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenInlineKeyboardButton(InlineKeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    model_config = ConfigDict(frozen=True)
+    keyboard: tuple[tuple[FrozenKeyboardButton, ...], ...]
+
+    @field_serializer('keyboard')
+    def _serialize_rows(self, rows):
+        # Bot API ожидает массивы; aiogram обходит при отправке только списки
+        return [list(row) for row in rows]
+
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    model_config = ConfigDict(frozen=True)
+    inline_keyboard: tuple[tuple[FrozenInlineKeyboardButton, ...], ...]
+
+    @field_serializer('inline_keyboard')
+    def _serialize_rows(self, rows):
+        return [list(row) for row in rows]
+
+
+_FROZEN_MARKUPS = {
+    ReplyKeyboardMarkup: FrozenReplyKeyboardMarkup,
+    InlineKeyboardMarkup: FrozenInlineKeyboardMarkup,
+}
+for _model in (FrozenKeyboardButton, FrozenInlineKeyboardButton, *_FROZEN_MARKUPS.values()):
+    _model.model_rebuild(_types_namespace=vars(aiogram.types))
+
+
+def freeze(markup):
+    """Неизменяемая копия ReplyKeyboardMarkup/InlineKeyboardMarkup (уже неизменяемая возвращается как есть)"""
+    if type(markup) in _FROZEN_MARKUPS.values():
+        return markup
+    frozen = _FROZEN_MARKUPS.get(type(markup))
+    if frozen is None:
+        raise TypeError(f"Неподдерживаемый тип клавиатуры: {type(markup).__name__}")
+    return frozen.model_validate(markup.model_dump(exclude_none=True))
 
-async def get_inline_keyboard(keyboard_type: str):
-    match keyboard_type:
-        case 'manage_subscription':
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text='Купить подписку', callback_data='buy_subscription'),
-                     InlineKeyboardButton(text='Вернуться назад', callback_data='back_to_start')]
-                ]
-            )
-            
-        case 'manage_existing_subscription':
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text='Продлить подписку', callback_data='extend_subscription')],
-                    [InlineKeyboardButton(text='Сменить тариф', callback_data='change_subscription')],
-                    [InlineKeyboardButton(text='Отменить подписку', callback_data='cancel_subscription')],
-                    [InlineKeyboardButton(text='Вернуться назад', callback_data='back_to_start')]
-                ]
-            )
-            
-        case 'choose_subscription_type':
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text='Базовый', callback_data='basic_subscription'),
-                     InlineKeyboardButton(text='Премиум', callback_data='premium_subscription')]
-                ]
-            )
-        
-        case 'choose_subscription_duration':
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text='30 дней', callback_data='30_days')]
-                ]
-            )
-        
-        case 'confirm_payment':
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text='Подтвердить оплату', callback_data='confirm_payment')],
-                    [InlineKeyboardButton(text='Отменить', callback_data='cancel_payment')]
-                ]
-            )
-            
-        case 'confirm_cancel_subscription':
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text='Подтвердить отмену', callback_data='confirm_cancel_subscription')],
-                    [InlineKeyboardButton(text='Отмена', callback_data='back_to_start')]
-                ]
-            )
-            
-        case _:
-            raise ValueError(f"Неизвестный тип клавиатуры: {keyboard_type}")
-    return inline_keyboard
 
+# Статические клавиатуры строятся один раз при импорте
+REPLY_KEYBOARDS = {
+    'start': ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text='Управление подпиской')]
+        ],
+        resize_keyboard=True
+    ),
+}
+REPLY_KEYBOARDS = {name: freeze(markup) for name, markup in REPLY_KEYBOARDS.items()}
 
+INLINE_KEYBOARDS = {
+    'manage_subscription': InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text='Купить подписку', callback_data='buy_subscription'),
+             InlineKeyboardButton(text='Вернуться назад', callback_data='back_to_start')]
+        ]
+    ),
+    'manage_existing_subscription': InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text='Продлить подписку', callback_data='extend_subscription')],
+            [InlineKeyboardButton(text='Сменить тариф', callback_data='change_subscription')],
+            [InlineKeyboardButton(text='Отменить подписку', callback_data='cancel_subscription')],
+            [InlineKeyboardButton(text='Вернуться назад', callback_data='back_to_start')]
+        ]
+    ),
+    'choose_subscription_type': InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text='Базовый', callback_data='basic_subscription'),
+             InlineKeyboardButton(text='Премиум', callback_data='premium_subscription')]
+        ]
+    ),
+    'choose_subscription_duration': InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text='30 дней', callback_data='30_days')]
+        ]
+    ),
+    'confirm_payment': InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text='Подтвердить оплату', callback_data='confirm_payment')],
+            [InlineKeyboardButton(text='Отменить', callback_data='cancel_payment')]
+        ]
+    ),
+    'confirm_cancel_subscription': InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text='Подтвердить отмену', callback_data='confirm_cancel_subscription')],
+            [InlineKeyboardButton(text='Отмена', callback_data='back_to_start')]
+        ]
+    ),
+    # Клавиатура только для инвойса
+    'invoice': InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text='Оплатить', pay=True)],
+            [InlineKeyboardButton(text='↩️ Назад к выбору тарифа', callback_data='back_to_plan_selection')]
+        ]
+    ),
+}
+INLINE_KEYBOARDS = {name: freeze(markup) for name, markup in INLINE_KEYBOARDS.items()}
+
+
+def reply_keyboard(keyboard_type: str):
+    """Готовая reply-клавиатура по имени"""
+    try:
+        return REPLY_KEYBOARDS[keyboard_type]
+    except KeyError:
+        raise ValueError(f"Неизвестный тип клавиатуры: {keyboard_type}") from None
+
+
+def inline_keyboard(keyboard_type: str):
+    """Готовая inline-клавиатура по имени"""
+    try:
+        return INLINE_KEYBOARDS[keyboard_type]
+    except KeyError:
+        raise ValueError(f"Неизвестный тип клавиатуры: {keyboard_type}") from None
+
+
+def keyboard_cache(func=None, maxsize=KEYBOARD_CACHE_SIZE):
+    """
+    Декоратор функции, строящей клавиатуру по параметрам: одинаковые параметры возвращают один и тот же
+    неизменяемый объект (см. freeze). Параметры должны быть хэшируемыми; статистика кэша - func.cache_info()
+    """
+    if func is None:
+        return functools.partial(keyboard_cache, maxsize=maxsize)
+
+    @functools.lru_cache(maxsize=maxsize)
+    @functools.wraps(func)
+    def cached(*args, **kwargs):
+        return freeze(func(*args, **kwargs))
+    return cached
+
+
+# Асинхронные обертки для совместимости со старым кодом
+async def get_reply_keyboard(keyboard_type: str):
+    return reply_keyboard(keyboard_type)
+
+
+async def get_inline_keyboard(keyboard_type: str):
+    return inline_keyboard(keyboard_type)
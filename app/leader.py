@@ -0,0 +1,254 @@
+from app.storage import REDIS_URL
+from app.metrics import LEADER
+from app.database import get_async_session_maker, LeaderFence
+from contextvars import ContextVar
+from datetime import datetime
+from sqlalchemy import exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import redis.asyncio as aioredis
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+# Где выбирается ведущий процесс для фоновых циклов:
+# local - процесс с индексом 0 (один хост), redis - аренда в Redis (несколько реплик бота)
+LEADER_BACKEND = os.getenv('LEADER_BACKEND', 'local').lower()
+LEADER_NAME = os.getenv('LEADER_NAME', 'background')
+# Срок аренды и период продления, сек: при падении ведущего другой процесс перенимает циклы через LEADER_TTL
+LEADER_TTL = float(os.getenv('LEADER_TTL', '10'))
+LEADER_HEARTBEAT = float(os.getenv('LEADER_HEARTBEAT', '3'))
+
+# (имя аренды, токен) ведущего, от имени которого выполняется цикл; задачи циклов наследуют значение при создании
+_current_fence = ContextVar('leader_fence', default=None)
+
+# Захват аренды и выдача нового fencing token одной операцией
+_ACQUIRE = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    local token = redis.call('INCR', KEYS[2])
+    redis.call('SET', KEYS[3], token, 'PX', ARGV[2])
+    return token
+end
+return 0
+"""
+# Продление только своей аренды с актуальным токеном
+_RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] and redis.call('GET', KEYS[3]) == ARGV[3] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    redis.call('PEXPIRE', KEYS[3], ARGV[2])
+    return 1
+end
+return 0
+"""
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[3])
+    return 1
+end
+return 0
+"""
+
+
+def node_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class RedisLease:
+    """
+    Аренда лидерства в Redis: SET NX PX с монотонно растущим fencing token (INCR при каждом захвате).
+    Продление проверяет и владельца, и токен, поэтому смещенный ведущий не может продлить чужую аренду.
+    """
+
+    def __init__(self, name=LEADER_NAME, url=REDIS_URL, ttl=LEADER_TTL, owner=None):
+        self.redis = aioredis.from_url(url)
+        self.keys = [f'leader:{name}', f'leader:{name}:fence', f'leader:{name}:token']
+        self.ttl = ttl
+        self.owner = owner or node_id()
+        self.token = None
+        self.fenced = True
+
+    async def acquire(self):
+        """Возвращает fencing token или None, если аренда занята"""
+        token = await self.redis.eval(_ACQUIRE, 3, *self.keys, self.owner, int(self.ttl * 1000))
+        self.token = int(token) or None
+        return self.token
+
+    async def renew(self):
+        if self.token is None:
+            return False
+        return bool(await self.redis.eval(_RENEW, 3, *self.keys, self.owner, int(self.ttl * 1000), self.token))
+
+    async def release(self):
+        if self.token is not None:
+            await self.redis.eval(_RELEASE, 3, *self.keys, self.owner)
+        self.token = None
+
+    async def holder(self):
+        """Текущий владелец аренды или None"""
+        value = await self.redis.get(self.keys[0])
+        return value.decode() if value is not None else None
+
+
+class LocalLease:
+    """Лидерство без внешнего хранилища: ведущим всегда является процесс с индексом 0"""
+
+    def __init__(self, is_leader=True, ttl=LEADER_TTL):
+        self.is_leader = is_leader
+        self.ttl = ttl
+        self.token = None
+        # Аренда не истекает, смещенного ведущего не бывает
+        self.fenced = False
+
+    async def acquire(self):
+        self.token = 1 if self.is_leader else None
+        return self.token
+
+    async def renew(self):
+        return self.is_leader
+
+    async def release(self):
+        self.token = None
+
+    async def holder(self):
+        return None
+
+
+def leader_fence():
+    """
+    Условия WHERE для записей фоновых циклов: пока цикл выполняется от имени ведущего с fencing token,
+    запись проходит только если в leader_fence его токен. Вне ведущего (Celery) условий нет
+    """
+    fence = _current_fence.get()
+    if fence is None:
+        return []
+    name, token = fence
+    return [exists().where(LeaderFence.name == name, LeaderFence.token == token)]
+
+
+def create_lease(worker_index=0):
+    if LEADER_BACKEND == 'redis':
+        return RedisLease()
+    if LEADER_BACKEND == 'local':
+        return LocalLease(is_leader=worker_index == 0)
+    raise ValueError(f"Неизвестный LEADER_BACKEND: {LEADER_BACKEND} (ожидается local или redis)")
+
+
+class LeaderElection:
+    """
+    Запуск фоновых циклов только в ведущем процессе.
+
+    Процесс пытается захватить аренду раз в heartbeat; ведущий продлевает её с тем же периодом.
+    Если аренда потеряна или не продлена за ttl - heartbeat (Redis недоступен), циклы отменяются
+    до истечения аренды, чтобы два процесса не выполняли их одновременно.
+    Для аренды с fencing token (lease.fenced) токен записывается в leader_fence, а записи циклов
+    (outbox, отзыв доступа, напоминания) проверяют его через leader_fence(): смещенный ведущий,
+    не успевший остановиться, ничего не изменит. Упавший цикл перезапускается через heartbeat.
+    """
+
+    def __init__(self, lease, name=LEADER_NAME, heartbeat=LEADER_HEARTBEAT, async_session_maker=None):
+        self.lease = lease
+        self.name = name
+        self.heartbeat = heartbeat
+        self.async_session_maker = async_session_maker
+        self.fencing_token = None
+
+    @property
+    def is_leader(self):
+        return self.fencing_token is not None
+
+    async def _acquire(self):
+        try:
+            return await self.lease.acquire()
+        except Exception as e:
+            logging.error(f"[LEADER] Ошибка при захвате аренды {self.name}: {e}")
+            return None
+
+    async def _publish_fence(self, token):
+        """Записывает токен в leader_fence, если он больше записанного. False - появился ведущий с большим токеном"""
+        if not getattr(self.lease, 'fenced', False):
+            return True
+        if self.async_session_maker is None:
+            self.async_session_maker = get_async_session_maker()
+        stmt = pg_insert(LeaderFence).values(name=self.name, token=token, updated_at=datetime.utcnow())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[LeaderFence.name],
+            set_={'token': stmt.excluded.token, 'updated_at': stmt.excluded.updated_at},
+            where=LeaderFence.token < stmt.excluded.token
+        ).returning(LeaderFence.token)
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(stmt)
+                return result.scalar() is not None
+
+    async def _hold(self):
+        """Продлевает аренду, пока это удается. Возвращает управление при потере лидерства"""
+        renewed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                renewed = await self.lease.renew()
+            except Exception as e:
+                logging.error(f"[LEADER] Ошибка при продлении аренды {self.name}: {e}")
+                renewed = None
+            if renewed:
+                renewed_at = time.monotonic()
+            elif renewed is False:
+                logging.warning(f"[LEADER] Аренда {self.name} перехвачена другим процессом")
+                return
+            elif time.monotonic() - renewed_at >= self.lease.ttl - self.heartbeat:
+                logging.warning(f"[LEADER] Аренда {self.name} не продлена вовремя, фоновые циклы останавливаются")
+                return
+
+    async def _supervise(self, name, factory):
+        """Выполняет цикл, перезапуская его через heartbeat после ошибки или неожиданного завершения"""
+        while True:
+            try:
+                await factory()
+                logging.error(f"[LEADER] Цикл {name} завершился, перезапуск через {self.heartbeat} сек")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f"[LEADER] Цикл {name} упал, перезапуск через {self.heartbeat} сек")
+            await asyncio.sleep(self.heartbeat)
+
+    async def _release(self):
+        try:
+            await self.lease.release()
+        except Exception as e:
+            logging.error(f"[LEADER] Ошибка при освобождении аренды {self.name}: {e}")
+
+    async def run(self, loops):
+        """loops - {имя: функция без аргументов, возвращающая корутину цикла}"""
+        while True:
+            token = await self._acquire()
+            if token is None:
+                await asyncio.sleep(self.heartbeat)
+                continue
+            try:
+                fenced = await self._publish_fence(token)
+            except Exception as e:
+                logging.error(f"[LEADER] Ошибка при записи fencing token {self.name}: {e}")
+                fenced = False
+            if not fenced:
+                await self._release()
+                await asyncio.sleep(self.heartbeat)
+                continue
+            self.fencing_token = token
+            LEADER.labels(self.name).set(1)
+            logging.info(f"[LEADER] Процесс стал ведущим ({self.name}, token={token}), запуск циклов: {', '.join(loops)}")
+            fence = _current_fence.set((self.name, token))
+            try:
+                tasks = [asyncio.create_task(self._supervise(name, factory), name=f'leader:{name}') for name, factory in loops.items()]
+            finally:
+                _current_fence.reset(fence)
+            try:
+                await self._hold()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self.fencing_token = None
+                LEADER.labels(self.name).set(0)
+                await self._release()
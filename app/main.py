@@ -3,21 +3,36 @@ from aiogram import Bot, Dispatcher, types
 from aiogram import Router, types, F
 from aiogram.filters import Command
 import os
-from keyboards import get_reply_keyboard, get_inline_keyboard
+from app.keyboards import reply_keyboard, inline_keyboard
 import logging
 from dotenv import load_dotenv
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from app.subscription_service import subscription_service, CHANNEL_IDS
-from app.database import User, UserSubscription, SubscriptionPlan, PaymentError, async_init_db
+from app.database import User, UserSubscription, SubscriptionPlan, PaymentError, async_init_db, dispose_async_engine, get_async_engine, reset_engine_after_fork
 from aiogram.types import LabeledPrice
 from aiogram.types.message import ContentType
-from aiogram.types import ChatJoinRequest
+from aiogram.types import ChatJoinRequest, FSInputFile
+from aiogram.exceptions import TelegramBadRequest
 import traceback
 from datetime import datetime, timedelta
 from sqlalchemy import select
-from app.subscription_service import SubscriptionManager
+from app.expiry_sweeper import expiry_sweeper
+from app.expiry_scheduler import expiry_scheduler
+from app.message_dispatcher import message_dispatcher, PRIORITY_HIGH, PRIORITY_NAMES
+from app.invite_links import invite_link_revoker
+from app.invite_link_pool import invite_link_pool
+from app.outbox import outbox_worker
+from app.reminders import reminder_sender
+from app.stats import subscription_stats, StatsDelta, record_stats, format_report
+from app.export import exporter, export_semaphore, parse_export_args, EXPORT_MAX_DOCUMENT_SIZE
+from app.payment_errors import payment_error_console, is_payment_error_callback, parse_callback, format_page, page_keyboard, format_summary, summary_keyboard, format_details, details_keyboard
+from app.leader import LeaderElection, create_lease
+from app.storage import create_fsm_storage, check_fsm_storage
+from app.bot_factory import create_bot
+from app.query_log import setup_query_budget
+from app.metrics import METRICS_PORT, METRICS_MULTIPROC, setup_handler_metrics, start_metrics_server, register_backlog, report_backlog
+from app.webhook import BOT_MODE, WEBHOOK_WORKERS, check_webhook_secret, serve_webhook, run_worker_processes
 import json
 
 load_dotenv()
@@ -40,19 +55,38 @@ class SubscriptionStates(StatesGroup):
     confirming_payment = State()
 
 
-# Хранилище состояний в памяти
-storage = MemoryStorage()
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Хранилище состояний: в памяти или в Redis (FSM_STORAGE), общее для нескольких процессов бота
+storage = create_fsm_storage()
+bot = create_bot(TELEGRAM_BOT_TOKEN)
 dp = Dispatcher(storage=storage)
 
-# Устанавливаем экземпляр бота в сервис подписок
+# Устанавливаем экземпляр бота в сервис подписок и очередь исходящих сообщений
 subscription_service.set_bot(bot)
+message_dispatcher.set_bot(bot)
+
+# Время и ошибки всех хэндлеров
+setup_handler_metrics(dp)
+
+# Сколько запросов к базе допустимо при обработке одного обновления (остальные хэндлеры - DB_QUERY_BUDGET)
+HANDLER_QUERY_BUDGETS = {
+    'manage_subscription': 2,
+    'process_join_request': 1,
+    'process_pre_checkout_query': 0,
+    'process_successful_payment': 11,
+    'show_payment_errors': 1,
+    'browse_payment_errors': 1,
+    'show_stats': 2,
+}
+setup_query_budget(dp, HANDLER_QUERY_BUDGETS)
 
 # Загрузка списка администраторов из .env
 ADMIN_USER_IDS = os.getenv('ADMIN_USER_IDS', '').split(',')
 if not ADMIN_USER_IDS[0]:
     logging.warning("Не заданы ID администраторов (ADMIN_USER_IDS) в .env!")
 
+# Как часто проверять подписки, которым пора отправить напоминание, сек
+REMINDER_CHECK_INTERVAL = int(os.getenv('REMINDER_CHECK_INTERVAL', '300'))
+
 @dp.message(Command('start'))
 async def start_command(message: types.Message, state: FSMContext):
     # При старте сбрасываем состояние
@@ -63,7 +97,7 @@ async def start_command(message: types.Message, state: FSMContext):
         f"Этот бот предоставляет подписку на телеграм-каналы с кэшбеком на WB.\n"
         f"Для информации о тарифных планах нажмите кнопку \"Управление подпиской\" внизу."
     )
-    await message.answer(text, reply_markup=await get_reply_keyboard(keyboard_type='start'))
+    await message.answer(text, reply_markup=reply_keyboard('start'))
 
 @dp.message(F.text == 'Управление подпиской')
 async def manage_subscription(message: types.Message, state: FSMContext):
@@ -72,22 +106,22 @@ async def manage_subscription(message: types.Message, state: FSMContext):
     
     if subscription_info:
         # Если подписка есть, показываем информацию о ней
-        days_left = subscription_info['days_left']
+        days_left = subscription_info.days_left
         message_text = (
-            f"Ваша текущая подписка: {subscription_info['plan_name']}\n"
-            f"Действует до: {subscription_info['end_date'].strftime('%d.%m.%Y')}\n"
+            f"Ваша текущая подписка: {subscription_info.plan_name}\n"
+            f"Действует до: {subscription_info.end_date.strftime('%d.%m.%Y')}\n"
             f"Осталось дней: {days_left}"
         )
         
         # Если есть ссылка-приглашение, показываем её
-        if subscription_info.get('invite_link'):
-            message_text += f"\n\nСсылка для входа в канал: {subscription_info['invite_link']}"
+        if subscription_info.invite_link:
+            message_text += f"\n\nСсылка для входа в канал: {subscription_info.invite_link}"
             message_text += "\n\n⚠️ Эта ссылка доступна только вам. При переходе по ссылке вам нужно будет отправить запрос на вступление, который будет автоматически одобрен."
         
-        await message.answer(message_text, reply_markup=await get_inline_keyboard(keyboard_type='manage_existing_subscription'))
+        await message.answer(message_text, reply_markup=inline_keyboard('manage_existing_subscription'))
     else:
         # Если подписки нет, предлагаем купить
-        await message.answer('Выберите действие:', reply_markup=await get_inline_keyboard(keyboard_type='manage_subscription'))
+        await message.answer('Выберите действие:', reply_markup=inline_keyboard('manage_subscription'))
 
 
 # Обработчик запросов на вступление в канал
@@ -108,36 +142,31 @@ async def process_join_request(join_request: ChatJoinRequest):
     # Если нет ссылки-приглашения, отклоняем запрос
     if not invite_link:
         logging.warning(f"Запрос без ссылки-приглашения от пользователя {user_id}")
-        await bot.decline_chat_join_request(chat_id=chat_id, user_id=user_id)
+        await message_dispatcher.call('decline_chat_join_request', chat_id=chat_id, priority=PRIORITY_HIGH, user_id=user_id)
         return
     
-    # Проверяем, что запрос идет от правильного пользователя
-    is_valid = await subscription_service.is_valid_join_request(invite_link, user_id)
+    # Проверяем, что запрос идет от правильного пользователя (по индексу ссылок, без запроса к базе)
+    entry = await subscription_service.get_invite_link_entry(invite_link)
+    is_valid = entry is not None and entry.allows(user_id, chat_id)
     if is_valid:
         # Одобряем запрос
         try:
-            await bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
+            await message_dispatcher.call('approve_chat_join_request', chat_id=chat_id, priority=PRIORITY_HIGH, user_id=user_id)
             logging.info(f"Одобрен запрос на вступление для пользователя {user_id}")
             
-            # Отзываем ссылку сразу после одобрения
+            # Ставим ссылку в буфер на отзыв сразу после одобрения (в базу и outbox она записывается пачкой)
             try:
-                async with subscription_service.async_session_maker() as session:
-                    link_result = await session.execute(select(UserSubscription).where(UserSubscription.invite_link == invite_link))
-                    sub = link_result.scalar_one_or_none()
-                    if sub and sub.invite_link:
-                        await bot.revoke_chat_invite_link(chat_id=chat_id, invite_link=sub.invite_link)
-                        sub.invite_link = None
-                        session.add(sub)
-                        await session.commit()
-                        logging.info(f"Ссылка {invite_link} отозвана после успешного вступления пользователя {user_id}")
+                await invite_link_revoker.schedule(invite_link, chat_id, user_id)
+                logging.info(f"Ссылка {invite_link} поставлена на отзыв после успешного вступления пользователя {user_id}")
             except Exception as e:
                 logging.error(f"Ошибка при отзыве ссылки после вступления: {str(e)}")
             
             # Оповещаем пользователя об успешном вступлении
             try:
-                await bot.send_message(
-                    chat_id=user_id, 
-                    text=f"✅ Ваш запрос на вступление в канал был автоматически одобрен. Добро пожаловать!"
+                await message_dispatcher.send_message(
+                    user_id,
+                    "✅ Ваш запрос на вступление в канал был автоматически одобрен. Добро пожаловать!",
+                    priority=PRIORITY_HIGH
                 )
             except Exception as e:
                 logging.error(f"Ошибка при отправке уведомления пользователю: {str(e)}")
@@ -146,14 +175,15 @@ async def process_join_request(join_request: ChatJoinRequest):
     else:
         # Отклоняем запрос, если пользователь не соответствует ссылке
         try:
-            await bot.decline_chat_join_request(chat_id=chat_id, user_id=user_id)
+            await message_dispatcher.call('decline_chat_join_request', chat_id=chat_id, priority=PRIORITY_HIGH, user_id=user_id)
             logging.warning(f"Отклонен запрос на вступление для пользователя {user_id} - неправильный пользователь для ссылки")
             
             # Оповещаем пользователя об отклонении
             try:
-                await bot.send_message(
-                    chat_id=user_id, 
-                    text="❌ Ваш запрос на вступление в канал был отклонен. Эта ссылка-приглашение предназначена для другого пользователя."
+                await message_dispatcher.send_message(
+                    user_id,
+                    "❌ Ваш запрос на вступление в канал был отклонен. Эта ссылка-приглашение предназначена для другого пользователя.",
+                    priority=PRIORITY_HIGH
                 )
             except Exception as e:
                 logging.error(f"Ошибка при отправке уведомления пользователю: {str(e)}")
@@ -165,30 +195,22 @@ async def process_join_request(join_request: ChatJoinRequest):
 async def buy_subscription(callback: types.CallbackQuery, state: FSMContext):
     # Переходим в состояние выбора типа подписки
     await state.set_state(SubscriptionStates.choosing_type)
-    # Получаем все тарифы из базы
-    async with subscription_service.async_session_maker() as session:
-        result = await session.execute(select(SubscriptionPlan))
-        plans = result.scalars().all()
-    # Формируем клавиатуру с вариантами тарифов
-    keyboard = types.InlineKeyboardMarkup(
-        inline_keyboard=[
-            [types.InlineKeyboardButton(text=plan.name, callback_data=f'plan_{plan.id}')]
-            for plan in plans
-        ]
-    )
+    # Клавиатура с вариантами тарифов берется из каталога
+    keyboard = await subscription_service.plan_catalog.get_plan_keyboard()
     try:
         await callback.message.edit_text('Выберите тип подписки:', reply_markup=keyboard)
     except Exception as e:
         await callback.message.answer('Выберите тип подписки:', reply_markup=keyboard)
 
-async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=False):
-    preview_text = (
-        f"Вы выбрали {'продление подписки' if is_extension else 'подписку'}: {plan.name}\n"
-        f"Описание: {plan.description or '-'}\n"
-        f"Длительность: {plan.duration_days} дней\n"
-        f"Стоимость: {plan.price/100:.2f} руб.\n\n"
-        f"Нажмите кнопку ниже для оплаты:"
-    )
+
+async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=False, subscription_id=None):
+    # Текст превью и параметры инвойса заранее собраны в каталоге тарифов
+    invoice_params = await subscription_service.plan_catalog.get_invoice_params(plan.id, is_extension)
+    payload = invoice_params['payload']
+    if is_extension and subscription_id is not None:
+        # ID продлеваемой подписки передается в payload, чтобы оплату мог обработать любой процесс бота
+        payload = f"{payload}_{subscription_id}"
+    preview_text = invoice_params['preview_text']
     try:
         if edit:
             await callback.message.edit_text(preview_text)
@@ -198,45 +220,16 @@ async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=
         logging.error(f"Ошибка при отправке превью подписки: {str(e)}\nTRACEBACK: {traceback.format_exc()}")
         await callback.message.answer(preview_text)
     try:
-        # Подготавливаем данные для чека (provider_data)
-        provider_data = {
-            "receipt": {
-                "items": [
-                    {
-                        "description": f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name} на {plan.duration_days} дней",
-                        "quantity": 1.0,
-                        "amount": {
-                            "value": plan.price / 100,  # В рублях, а не копейках
-                            "currency": "RUB"
-                        },
-                        "vat_code": 1,  # НДС 20%
-                        "payment_mode": "full_payment",
-                        "payment_subject": "service"  # Услуга
-                    }
-                ],
-                "tax_system_code": 1  # Общая система налогообложения
-            }
-        }
-        provider_data_json = json.dumps(provider_data)
-        # Клавиатура только для инвойса
-        invoice_keyboard = types.InlineKeyboardMarkup(
-            inline_keyboard=[
-                [types.InlineKeyboardButton(text="Оплатить", pay=True)],
-                [types.InlineKeyboardButton(text="↩️ Назад к выбору тарифа", callback_data="back_to_plan_selection")]
-            ]
-        )
-        
-        # Формируем payload в зависимости от типа операции (новая подписка или продление)
-        payload = f"extend_{plan.id}" if is_extension else f"plan_{plan.id}"
-        
-        invoice_message = await bot.send_invoice(
+        invoice_message = await message_dispatcher.call(
+            'send_invoice',
             chat_id=callback.from_user.id,
-            title=f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name}",
-            description=f"Оплата {'продления доступа' if is_extension else 'доступа'} к тарифу {plan.name}, продолжительность - {plan.duration_days} дней",
+            priority=PRIORITY_HIGH,
+            title=invoice_params['title'],
+            description=invoice_params['description'],
             payload=payload,
             provider_token=TELEGRAM_PAYMENT_TOKEN,
-            currency="RUB",
-            prices=[LabeledPrice(label=plan.name, amount=plan.price)],
+            currency=invoice_params['currency'],
+            prices=invoice_params['prices'],
             start_parameter="subscription_payment",
             need_name=False,
             need_phone_number=False,
@@ -245,8 +238,8 @@ async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=
             need_shipping_address=False,
             is_flexible=False,
             protect_content=True,
-            provider_data=provider_data_json,
-            reply_markup=invoice_keyboard
+            provider_data=invoice_params['provider_data'],
+            reply_markup=inline_keyboard('invoice')
         )
         # Сохраняем id сообщений для удаления
         await state.update_data(preview_msg_id=callback.message.message_id, invoice_msg_id=invoice_message.message_id)
@@ -256,17 +249,15 @@ async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=
         logging.error(f"[INVOICE][ERROR] Параметры платежа при ошибке: chat_id={callback.from_user.id}, title={plan.name}, description=Оплата доступа к тарифу {plan.name}, продолжительность - {plan.duration_days} дней, payload=plan_{plan.id}, provider_token={TELEGRAM_PAYMENT_TOKEN}, currency=RUB, price={plan.price}, need_email=True, send_email_to_provider=True")
         await callback.message.answer(
             f"Произошла ошибка при создании платежа: {str(e)}",
-            reply_markup=await get_reply_keyboard(keyboard_type='start')
+            reply_markup=reply_keyboard('start')
         )
         await state.clear()
 
 @dp.callback_query(SubscriptionStates.choosing_type, lambda c: c.data.startswith('plan_'))
 async def process_subscription_plan(callback: types.CallbackQuery, state: FSMContext):
     plan_id = int(callback.data.replace('plan_', ''))
-    # Получаем тариф из базы
-    async with subscription_service.async_session_maker() as session:
-        result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == plan_id))
-        plan = result.scalar_one_or_none()
+    # Получаем тариф из каталога
+    plan = await subscription_service.plan_catalog.get_plan(plan_id)
     if not plan:
         await callback.message.answer('Ошибка: выбранный тариф не найден.')
         return
@@ -277,19 +268,19 @@ async def process_subscription_plan(callback: types.CallbackQuery, state: FSMCon
 @dp.callback_query(F.data == 'cancel_payment')
 async def cancel_payment(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.answer('Оплата отменена. Вы можете вернуться в главное меню', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+    await callback.message.answer('Оплата отменена. Вы можете вернуться в главное меню', reply_markup=reply_keyboard('start'))
 
 @dp.callback_query(F.data == 'back_to_start')
 async def back_to_start(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.answer('Вы вернулись в главное меню', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+    await callback.message.answer('Вы вернулись в главное меню', reply_markup=reply_keyboard('start'))
 
 @dp.callback_query(F.data == 'cancel_subscription')
 async def cancel_subscription_request(callback: types.CallbackQuery, state: FSMContext):
     """Запрос на отмену подписки - показывает подтверждение"""
     await callback.message.answer(
         "⚠️ Вы уверены, что хотите отменить подписку? Доступ к каналу будет отозван, деньги за неиспользованный период не возвращаются.",
-        reply_markup=await get_inline_keyboard(keyboard_type='confirm_cancel_subscription')
+        reply_markup=inline_keyboard('confirm_cancel_subscription')
     )
     await callback.answer()
 
@@ -302,24 +293,16 @@ async def extend_subscription(callback: types.CallbackQuery, state: FSMContext):
         result = await session.execute(select(UserSubscription).where(UserSubscription.user_id == user.id, UserSubscription.is_active == True))
         active_subs = result.scalars().all()
     if not active_subs:
-        await callback.message.answer('У вас нет активной подписки для продления.', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+        await callback.message.answer('У вас нет активной подписки для продления.', reply_markup=reply_keyboard('start'))
         return
     subscription = active_subs[0]
-    async with subscription_service.async_session_maker() as session:
-        result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == subscription.plan_id))
-        plan = result.scalar_one_or_none()
+    plan = await subscription_service.plan_catalog.get_plan(subscription.plan_id)
     if not plan:
-        await callback.message.answer('Ошибка: тариф не найден.', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+        await callback.message.answer('Ошибка: тариф не найден.', reply_markup=reply_keyboard('start'))
         return
     
-    # Сохраняем информацию о текущей подписке в состоянии для использования после оплаты
-    await state.update_data(
-        extend_subscription_id=subscription.id,
-        plan_id=plan.id,
-    )
-    
-    # Отправляем инвойс для оплаты продления
-    await send_invoice_for_plan(callback, state, plan, edit=False, is_extension=True)
+    # Отправляем инвойс для оплаты продления (ID подписки передается в payload, а не в состоянии)
+    await send_invoice_for_plan(callback, state, plan, edit=False, is_extension=True, subscription_id=subscription.id)
 
 @dp.callback_query(F.data == 'confirm_cancel_subscription')
 async def confirm_cancel_subscription(callback: types.CallbackQuery, state: FSMContext):
@@ -332,25 +315,21 @@ async def confirm_cancel_subscription(callback: types.CallbackQuery, state: FSMC
         active_subs = result.scalars().all()
     if not active_subs:
         logging.warning(f"[CANCEL] Нет активной подписки для пользователя {user_id}")
-        await callback.message.answer('У вас нет активной подписки для отмены.', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+        await callback.message.answer('У вас нет активной подписки для отмены.', reply_markup=reply_keyboard('start'))
         return
     subscription = active_subs[0]
     
     # Получаем информацию о плане подписки, чтобы знать channel_id
-    async with subscription_service.async_session_maker() as session:
-        result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == subscription.plan_id))
-        plan = result.scalar_one_or_none()
+    plan = await subscription_service.plan_catalog.get_plan(subscription.plan_id)
     
     if not plan:
         logging.error(f"[CANCEL] Не найден тариф для подписки {subscription.id}")
-        await callback.message.answer('Ошибка: не удалось найти тариф для вашей подписки.', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+        await callback.message.answer('Ошибка: не удалось найти тариф для вашей подписки.', reply_markup=reply_keyboard('start'))
         return
     
-    # Устанавливаем channel_id из плана в подписку для метода remove_user_access
-    subscription.channel_id = plan.channel_id
-    logging.info(f"[CANCEL] Передаю подписку {subscription.id} с channel_id={subscription.channel_id} в remove_user_access")
+    logging.info(f"[CANCEL] Отмена подписки {subscription.id}, канал {plan.channel_id}")
     
-    # Отзываем доступ
+    # Отзываем доступ (удаление из канала выполняет outbox_worker)
     success = await subscription_service.remove_user_access(subscription)
     
     # Проверяем статус подписки после отмены
@@ -360,9 +339,9 @@ async def confirm_cancel_subscription(callback: types.CallbackQuery, state: FSMC
         logging.info(f"[CANCEL] Статус подписки после отмены: is_active={getattr(updated_sub, 'is_active', None)}, invite_link={getattr(updated_sub, 'invite_link', None)}")
     
     if success:
-        await callback.message.answer('Ваша подписка отменена. Доступ к каналу отозван. Деньги за неиспользованный период не возвращаются.', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+        await callback.message.answer('Ваша подписка отменена. Доступ к каналу отозван. Деньги за неиспользованный период не возвращаются.', reply_markup=reply_keyboard('start'))
     else:
-        await callback.message.answer('Произошла ошибка при отмене подписки. Пожалуйста, попробуйте позже или обратитесь в поддержку.', reply_markup=await get_reply_keyboard(keyboard_type='start'))
+        await callback.message.answer('Произошла ошибка при отмене подписки. Пожалуйста, попробуйте позже или обратитесь в поддержку.', reply_markup=reply_keyboard('start'))
     
     await callback.answer()
 
@@ -400,51 +379,20 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
             # Создание новой подписки
             plan_id = int(payload.replace('plan_', ''))
             try:
-                # КРИТИЧЕСКАЯ ОПЕРАЦИЯ: создание подписки
+                # КРИТИЧЕСКАЯ ОПЕРАЦИЯ: создание подписки (одна транзакция, повтор платежа ничего не меняет)
                 logging.info(f"[PAYMENT] Начинаем создание подписки для пользователя {message.from_user.id}, план {plan_id}")
-                subscription_id = await subscription_service.create_subscription(
-                    message.from_user.id, 
-                    plan_id=plan_id
-                )
-                logging.info(f"[PAYMENT] Подписка успешно создана с ID={subscription_id}")
+                result = await subscription_service.fulfill_payment(message.from_user.id, plan_id, provider_payment_charge_id)
+                logging.info(f"[PAYMENT] Подписка ID={result.subscription_id} активирована (повторная доставка платежа: {result.duplicate})")
                 
-                # Сохраняем provider_payment_charge_id в подписке в новой сессии
-                async with subscription_service.async_session_maker() as session:
-                    result = await session.execute(select(UserSubscription).where(UserSubscription.id == subscription_id))
-                    sub = result.scalar_one_or_none()
-                    if sub:
-                        logging.info(f"[PAYMENT] Найдена подписка для сохранения charge_id: {sub}")
-                        sub.provider_payment_charge_id = provider_payment_charge_id
-                        session.add(sub)
-                        await session.commit()
-                        logging.info(f"[PAYMENT] Сохранён provider_payment_charge_id в подписке: {sub}")
-                    else:
-                        logging.error(f"[PAYMENT][ERROR] Не удалось найти подписку для сохранения charge_id")
-                # Получаем информацию о плане для формирования ответа
-                plan = None
-                subscription = None
-                async with subscription_service.async_session_maker() as session:
-                    result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == plan_id))
-                    plan = result.scalar_one_or_none()
-                if not plan:
-                    raise ValueError(f"План с ID {plan_id} не найден после оплаты")
-                # Получаем подписку для отображения даты окончания
-                async with subscription_service.async_session_maker() as session:
-                    result = await session.execute(select(UserSubscription).where(UserSubscription.id == subscription_id))
-                    subscription = result.scalar_one_or_none()
-                if not subscription:
-                    raise ValueError(f"Подписка с ID {subscription_id} не найдена после сохранения")
-                    
                 response_text = f"✅ Оплата успешно выполнена!\n\n"
-                response_text += f"Подписка: {plan.name}\n"
-                response_text += f"Срок действия: до {subscription.end_date.strftime('%d.%m.%Y')}\n\n"
-                if hasattr(subscription, 'invite_link') and subscription.invite_link:
-                    response_text += f"Ссылка для входа в канал: {subscription.invite_link}\n"
+                response_text += f"Подписка: {result.plan_name}\n"
+                response_text += f"Срок действия: до {result.end_date.strftime('%d.%m.%Y')}\n\n"
+                if result.invite_link:
+                    response_text += f"Ссылка для входа в канал: {result.invite_link}\n"
                     response_text += "⚠️ Перейдя по ссылке, нажмите 'Запросить вступление'. Ваш запрос будет автоматически одобрен."
-                await message.answer(response_text, reply_markup=await get_reply_keyboard(keyboard_type='start'))
+                await message_dispatcher.send_message(message.chat.id, response_text, priority=PRIORITY_HIGH,
+                                                      reply_markup=reply_keyboard('start'))
                 logging.info(f"[PAYMENT] Подписка успешно создана для пользователя {message.from_user.id}, план {plan_id}, charge_id={provider_payment_charge_id}")
-                # Логируем содержимое подписки из базы
-                logging.info(f"[PAYMENT] Итоговое состояние подписки в базе: {subscription}")
             except Exception as e:
                 stack_trace = traceback.format_exc()
                 logging.critical(f"[PAYMENT][CRITICAL_ERROR] Ошибка при создании подписки после оплаты: {str(e)}\nTRACEBACK: {stack_trace}")
@@ -464,6 +412,7 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                             stack_trace=stack_trace
                         )
                         session.add(payment_error)
+                        await record_stats(session, StatsDelta().add(datetime.utcnow(), payment_error.plan_id, payment_errors=1))
                         await session.commit()
                         logging.info(f"[PAYMENT][ERROR_SAVED] Информация об ошибке сохранена в базу данных с ID={payment_error.id}")
                 except Exception as db_error:
@@ -481,72 +430,46 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                 logging.critical(f"[PAYMENT][EMERGENCY] Данные платежа для ручного восстановления: {emergency_info}")
                 
                 await message.answer("⚠️ Платеж выполнен, но возникла техническая ошибка при активации подписки. Наши специалисты уже работают над этим и восстановят ваш доступ в ближайшее время. Пожалуйста, сохраните этот чат для подтверждения оплаты.", 
-                                   reply_markup=await get_reply_keyboard(keyboard_type='start'))
+                                   reply_markup=reply_keyboard('start'))
         
         elif payload.startswith('extend_'):
-            # Продление существующей подписки
-            plan_id = int(payload.replace('extend_', ''))
+            # Продление существующей подписки: payload вида extend_<plan_id>_<subscription_id>
+            parts = payload.replace('extend_', '').split('_')
+            plan_id = int(parts[0])
             
             try:
-                # Получаем данные из состояния
-                user_data = await state.get_data()
-                subscription_id = user_data.get('extend_subscription_id')
+                if len(parts) > 1:
+                    subscription_id = int(parts[1])
+                else:
+                    # Инвойсы старого формата: ID подписки хранился в состоянии
+                    user_data = await state.get_data()
+                    subscription_id = user_data.get('extend_subscription_id')
                 
                 if not subscription_id:
                     raise ValueError("Не найден ID подписки для продления")
                 
                 logging.info(f"[PAYMENT][EXTEND] Начинаем продление подписки ID={subscription_id}, план {plan_id}")
                 
-                # Получаем информацию о плане
-                async with subscription_service.async_session_maker() as session:
-                    result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == plan_id))
-                    plan = result.scalar_one_or_none()
-                
-                if not plan:
-                    raise ValueError(f"План с ID {plan_id} не найден для продления")
-                
-                days = plan.duration_days
-                
-                # Продляем подписку
-                async with subscription_service.async_session_maker() as session:
-                    manager = SubscriptionManager(session)
-                    subscription = await manager.extend_subscription(subscription_id, days, reminder_sent=False)
-                    
-                    # Сохраняем информацию о платеже
-                    subscription.provider_payment_charge_id = provider_payment_charge_id
-                    
-                    await session.commit()
-                
-                # Генерируем новую ссылку-приглашение
-                invite_link = None
-                user = await subscription_service.get_user_by_telegram_id(message.from_user.id)
-                
-                if plan.channel_id and subscription_service.bot:
-                    try:
-                        invite_link = await subscription_service.create_channel_invite(plan.channel_id, user.telegram_user_id)
-                        async with subscription_service.async_session_maker() as session:
-                            result = await session.execute(select(UserSubscription).where(UserSubscription.id == subscription.id))
-                            sub = result.scalar_one_or_none()
-                            if sub:
-                                sub.invite_link = invite_link
-                                session.add(sub)
-                                await session.commit()
-                    except Exception as e:
-                        logging.error(f"[PAYMENT][EXTEND] Ошибка при создании ссылки-приглашения: {str(e)}")
-                        invite_link = None
+                # Продление с проверкой владельца подписки и новой ссылкой-приглашением одной транзакцией
+                result = await subscription_service.fulfill_payment(
+                    message.from_user.id,
+                    plan_id,
+                    provider_payment_charge_id,
+                    subscription_id=subscription_id
+                )
                 
                 # Формируем ответ
-                end_date = subscription.end_date.strftime('%d.%m.%Y')
                 response_text = f"✅ Оплата успешно выполнена!\n\n"
-                response_text += f"Подписка продлена: {plan.name}\n"
-                response_text += f"Срок действия: до {end_date}\n\n"
+                response_text += f"Подписка продлена: {result.plan_name}\n"
+                response_text += f"Срок действия: до {result.end_date.strftime('%d.%m.%Y')}\n\n"
                 
-                if invite_link:
-                    response_text += f"Ваша новая ссылка для входа в канал: {invite_link}\n"
+                if result.invite_link:
+                    response_text += f"Ваша новая ссылка для входа в канал: {result.invite_link}\n"
                     response_text += "⚠️ Перейдя по ссылке, нажмите 'Запросить вступление'. Ваш запрос будет автоматически одобрен."
                 
-                await message.answer(response_text, reply_markup=await get_reply_keyboard(keyboard_type='start'))
-                logging.info(f"[PAYMENT][EXTEND] Подписка успешно продлена для пользователя {message.from_user.id}, ID={subscription.id}, план {plan_id}")
+                await message_dispatcher.send_message(message.chat.id, response_text, priority=PRIORITY_HIGH,
+                                                      reply_markup=reply_keyboard('start'))
+                logging.info(f"[PAYMENT][EXTEND] Подписка успешно продлена для пользователя {message.from_user.id}, ID={result.subscription_id}, план {plan_id}")
             
             except Exception as e:
                 stack_trace = traceback.format_exc()
@@ -567,18 +490,19 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                             stack_trace=stack_trace
                         )
                         session.add(payment_error)
+                        await record_stats(session, StatsDelta().add(datetime.utcnow(), payment_error.plan_id, payment_errors=1))
                         await session.commit()
                         logging.info(f"[PAYMENT][EXTEND][ERROR_SAVED] Информация об ошибке продления сохранена в БД с ID={payment_error.id}")
                 except Exception as db_error:
                     logging.critical(f"[PAYMENT][EXTEND][DB_ERROR] Не удалось сохранить информацию об ошибке в БД: {str(db_error)}")
                 
                 await message.answer("⚠️ Платеж выполнен, но возникла техническая ошибка при продлении подписки. Наши специалисты уже работают над этим и скоро восстановят ваш доступ.", 
-                                   reply_markup=await get_reply_keyboard(keyboard_type='start'))
+                                   reply_markup=reply_keyboard('start'))
         
         else:
             logging.error(f"[PAYMENT][ERROR] Некорректный формат payload после оплаты: {payload}")
             await message.answer("Произошла ошибка при обработке платежа. Пожалуйста, обратитесь в поддержку.", 
-                               reply_markup=await get_reply_keyboard(keyboard_type='start'))
+                               reply_markup=reply_keyboard('start'))
             return
             
     except Exception as e:
@@ -600,13 +524,14 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                         stack_trace=stack_trace
                     )
                     session.add(payment_error)
+                    await record_stats(session, StatsDelta().add(datetime.utcnow(), None, payment_errors=1))
                     await session.commit()
                     logging.info(f"[PAYMENT][ERROR_SAVED] Информация об общей ошибке сохранена в базу данных с ID={payment_error.id}")
         except Exception as db_error:
             logging.critical(f"[PAYMENT][DB_ERROR] Не удалось сохранить информацию об общей ошибке в базу данных: {str(db_error)}")
         
         await message.answer("Произошла ошибка при обработке платежа. Пожалуйста, обратитесь в поддержку.", 
-                           reply_markup=await get_reply_keyboard(keyboard_type='start'))
+                           reply_markup=reply_keyboard('start'))
     finally:
         await state.clear()
 
@@ -616,7 +541,8 @@ async def back_to_plan_selection(callback: types.CallbackQuery, state: FSMContex
     # Получаем id сообщений для удаления
     data = await state.get_data()
     preview_msg_id = data.get('preview_msg_id')
-    invoice_msg_id = data.get('invoice_msg_id')
+    # Кнопка находится на самом инвойсе, поэтому его можно удалить и без данных состояния
+    invoice_msg_id = data.get('invoice_msg_id') or callback.message.message_id
     # Удаляем оба сообщения, если они есть
     try:
         if invoice_msg_id:
@@ -627,43 +553,101 @@ async def back_to_plan_selection(callback: types.CallbackQuery, state: FSMContex
         logging.error(f"[BACK] Ошибка при удалении сообщений: {str(e)}\nTRACEBACK: {traceback.format_exc()}")
     # Переходим обратно к выбору тарифа
     await state.set_state(SubscriptionStates.choosing_type)
-    async with subscription_service.async_session_maker() as session:
-        result = await session.execute(select(SubscriptionPlan))
-        plans = result.scalars().all()
-    keyboard = types.InlineKeyboardMarkup(
-        inline_keyboard=[
-            [types.InlineKeyboardButton(text=plan.name, callback_data=f'plan_{plan.id}')]
-            for plan in plans
-        ]
-    )
+    keyboard = await subscription_service.plan_catalog.get_plan_keyboard()
     await callback.message.answer('Выберите тип подписки:', reply_markup=keyboard)
     await callback.answer()
 
 # Admin commands
 @dp.message(Command('payment_errors'), lambda msg: str(msg.from_user.id) in ADMIN_USER_IDS)
 async def show_payment_errors(message: types.Message, state: FSMContext):
-    """Показать неразрешенные ошибки платежей (только для админов)"""
-    async with subscription_service.async_session_maker() as session:
-        result = await session.execute(select(PaymentError).where(PaymentError.is_resolved == False))
-        errors = result.scalars().all()
-    
-    if not errors:
-        await message.answer("Нет неразрешенных ошибок платежей.")
+    """Первая страница неразрешенных ошибок платежей (только для админов)"""
+    page = await payment_error_console.get_page()
+    await message.answer(format_page(page), reply_markup=page_keyboard(page) if page.rows else None)
+
+@dp.callback_query(lambda c: is_payment_error_callback(c.data), lambda c: str(c.from_user.id) in ADMIN_USER_IDS)
+async def browse_payment_errors(callback: types.CallbackQuery):
+    """Листание, сводка и карточка ошибки платежа в одном сообщении (только для админов)"""
+    parsed = parse_callback(callback.data)
+    if parsed is None:
+        logging.warning(f"[PAYMENT_ERRORS] Некорректные данные кнопки: {callback.data!r}")
+        await callback.answer("Некорректная кнопка, откройте список заново: /payment_errors", show_alert=True)
         return
-    
-    for error in errors:
-        error_text = (
-            f"🚨 Ошибка платежа #{error.id}:\n"
-            f"Пользователь: {error.telegram_user_id}\n"
-            f"Время платежа: {error.payment_time.strftime('%d.%m.%Y %H:%M:%S')}\n"
-            f"ID транзакции: {error.provider_payment_charge_id}\n"
-            f"Сумма: {error.payment_amount/100 if error.payment_amount else 'N/A'} {error.payment_currency or 'N/A'}\n"
-            f"План: {error.plan_id or 'N/A'}\n"
-            f"Ошибка: {error.error_message}\n\n"
-            f"Для разрешения используйте команду:\n"
-            f"/resolve_payment_error {error.id} <причина решения>"
+    action, argument = parsed
+    try:
+        if action == 'open':
+            error = await payment_error_console.get_details(argument)
+            if error is None:
+                await callback.answer(f"Ошибка платежа с ID {argument} не найдена.", show_alert=True)
+                return
+            text, keyboard = format_details(error), details_keyboard(error.id)
+        elif action == 'summary':
+            rows = await payment_error_console.get_summary(argument)
+            text, keyboard = format_summary(rows, argument), summary_keyboard(argument)
+        else:
+            page = await payment_error_console.get_page(
+                older_than=argument if action == 'older' else None,
+                newer_than=argument if action == 'newer' else None
+            )
+            text, keyboard = format_page(page), page_keyboard(page)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Повторное нажатие той же кнопки: сообщение не изменилось
+        logging.info(f"[PAYMENT_ERRORS] Сообщение не обновлено: {e}")
+    await callback.answer()
+
+@dp.message(Command('stats'), lambda msg: str(msg.from_user.id) in ADMIN_USER_IDS)
+async def show_stats(message: types.Message, state: FSMContext):
+    """Подписчики, MRR, отток и продления по дневной сводке (только для админов)"""
+    report = await subscription_stats.get_report()
+    await message.answer(format_report(report))
+
+# Фоновые выгрузки: ссылки на задачи хранятся, чтобы их не собрал сборщик мусора
+_export_tasks = set()
+
+@dp.message(Command('export'), lambda msg: str(msg.from_user.id) in ADMIN_USER_IDS)
+async def export_data(message: types.Message, state: FSMContext):
+    """Выгрузка подписок, пользователей или ошибок платежей файлом (только для админов)"""
+    try:
+        options = parse_export_args(message.text.split()[1:])
+    except ValueError as e:
+        await message.answer(
+            f"{e}\nФормат: /export subscriptions|payment_errors|users [csv|jsonl] [gzip] "
+            f"[ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [plan=ID]"
+        )
+        return
+    await message.answer("⏳ Готовлю выгрузку, файл придет отдельным сообщением.")
+    # Выгрузка идет в фоне: хэндлер не ждет чтения таблицы и отправки файла
+    task = asyncio.create_task(send_export(message.chat.id, options))
+    _export_tasks.add(task)
+    task.add_done_callback(_export_tasks.discard)
+
+async def send_export(chat_id, options):
+    """Выгружает данные во временный файл и отправляет его документом"""
+    async with export_semaphore:
+        try:
+            path, count = await exporter.export_to_file(**options)
+        except Exception as e:
+            logging.error(f"[EXPORT] Ошибка при выгрузке {options['dataset']}: {e}\nTRACEBACK: {traceback.format_exc()}")
+            await message_dispatcher.send_message(chat_id, f"Не удалось выполнить выгрузку: {e}")
+            return
+    try:
+        if os.path.getsize(path) > EXPORT_MAX_DOCUMENT_SIZE:
+            await message_dispatcher.send_message(
+                chat_id, "Файл выгрузки больше 50 МБ. Добавьте gzip, сузьте период или используйте python -m app.export."
+            )
+            return
+        await message_dispatcher.call(
+            'send_document', chat_id=chat_id, document=FSInputFile(path), caption=f"{options['dataset']}: {count} строк"
         )
-        await message.answer(error_text)
+        logging.info(f"[EXPORT] Выгрузка {options['dataset']} отправлена в чат {chat_id}, строк: {count}")
+    except Exception as e:
+        logging.error(f"[EXPORT] Ошибка при отправке выгрузки {options['dataset']} в чат {chat_id}: {e}\nTRACEBACK: {traceback.format_exc()}")
+        try:
+            await message_dispatcher.send_message(chat_id, f"Выгрузка готова, но отправить файл не удалось: {e}")
+        except Exception as notify_error:
+            logging.error(f"[EXPORT] Не удалось сообщить администратору {chat_id} об ошибке выгрузки: {notify_error}")
+    finally:
+        os.unlink(path)
 
 @dp.message(lambda msg: msg.text and msg.text.startswith('/resolve_payment_error'), lambda msg: str(msg.from_user.id) in ADMIN_USER_IDS)
 async def resolve_payment_error(message: types.Message, state: FSMContext):
@@ -695,9 +679,9 @@ async def resolve_payment_error(message: types.Message, state: FSMContext):
         
         # Отправляем уведомление пользователю
         try:
-            await bot.send_message(
-                chat_id=error.telegram_user_id,
-                text="✅ Проблема с вашим платежом была разрешена администратором. Если у вас остались вопросы, пожалуйста, свяжитесь с поддержкой."
+            await message_dispatcher.send_message(
+                error.telegram_user_id,
+                "✅ Проблема с вашим платежом была разрешена администратором. Если у вас остались вопросы, пожалуйста, свяжитесь с поддержкой."
             )
         except Exception as e:
             logging.error(f"Не удалось отправить уведомление пользователю {error.telegram_user_id}: {str(e)}")
@@ -707,87 +691,101 @@ async def resolve_payment_error(message: types.Message, state: FSMContext):
     except Exception as e:
         await message.answer(f"Произошла ошибка: {str(e)}")
 
+async def remind_expiring_subscriptions():
+    """Один проход напоминаний об окончании подписки (пачки забираются с SKIP LOCKED, повторов нет)"""
+    return await reminder_sender.send_due()
+
 async def monitor_subscriptions():
-    """Фоновая задача для мониторинга подписок и отзыва доступа"""
-    last_check = datetime.utcnow()
+    """Фоновая задача для напоминаний об окончании подписок (отзыв доступа выполняет expiry_scheduler)"""
     while True:
         try:
-            now = datetime.utcnow()
-            # Напоминания за 24 часа до окончания
-            expiring = await subscription_service.get_expiring_subscriptions(hours=24)
-            for sub in expiring:
-                if not getattr(sub, 'reminder_sent', False):
-                    # Получаем пользователя асинхронно
-                    user = await subscription_service.get_user_by_telegram_id(sub.user_id)
-                    if user:
-                        try:
-                            await bot.send_message(
-                                chat_id=user.telegram_user_id,
-                                text="⏰ Ваша подписка истекает через 24 часа! Продлите её, чтобы не потерять доступ к каналу."
-                            )
-                            sub.reminder_sent = True
-                            # Сохраняем обновление через асинхронный сервис
-                            # (можно реализовать отдельный метод для этого)
-                        except Exception as e:
-                            logging.error(f"Ошибка при отправке напоминания пользователю {user.telegram_user_id}: {e}")
-            # Отзыв доступа для истекших подписок
-            expired = await subscription_service.get_expired_subscriptions()  # реализовать этот метод
-            for sub in expired:
-                user = await subscription_service.get_user_by_telegram_id(sub.user_id)
-                try:
-                    # Отзываем доступ и ссылку (invite_link будет очищен)
-                    logging.info(f"Отзыв доступа и ссылки для истекшей подписки {sub.id}, user_id={sub.user_id}")
-                    await subscription_service.remove_user_access(sub)
-                    if user:
-                        await bot.send_message(
-                            chat_id=user.telegram_user_id,
-                            text="❌ Ваша подписка истекла. Доступ к каналу отозван. Оформите новую подписку для восстановления доступа."
-                        )
-                except Exception as e:
-                    logging.error(f"Ошибка при отзыве доступа у пользователя {getattr(user, 'telegram_user_id', '?')}: {e}\n{traceback.format_exc()}")
-            # Проверяем подписки, которые истекли за последние 2 минуты
-            recently_expired = await subscription_service.get_recently_expired_subscriptions(last_check, now)  # реализовать этот метод
-            for sub in recently_expired:
-                if not getattr(sub, 'reminder_sent', False):
-                    user = await subscription_service.get_user_by_telegram_id(sub.user_id)
-                    if user:
-                        try:
-                            await bot.send_message(
-                                chat_id=user.telegram_user_id,
-                                text="❌ Ваша подписка истекла. Доступ к каналу отозван. Оформите новую подписку для восстановления доступа."
-                            )
-                            sub.reminder_sent = True
-                        except Exception as e:
-                            logging.error(f"Ошибка при отправке уведомления о завершении подписки пользователю {user.telegram_user_id}: {e}")
-            last_check = now
+            await remind_expiring_subscriptions()
         except Exception as e:
             logging.error(f"Ошибка в задаче мониторинга подписок: {e}\n{traceback.format_exc()}")
-        await asyncio.sleep(60)
+        await asyncio.sleep(REMINDER_CHECK_INTERVAL)
+
+async def prepare_database(dispose=False):
+    """Создание таблиц, индексов и тарифов до запуска процессов бота"""
+    engine = await async_init_db()  # Сначала создаём таблицы!
+    await subscription_service._init_subscription_plans()  # Потом инициализируем тарифы и каталог
+    if dispose:
+        await dispose_async_engine()
+    return engine
 
-async def main():
+async def main(worker_index=0, init_db=True, metrics_port=METRICS_PORT):
     """Запуск бота"""
     logging.basicConfig(level=logging.INFO)
-    logging.info("Starting bot")
+    logging.info(f"Starting bot (режим {BOT_MODE}, процесс {worker_index})")
+    start_metrics_server(metrics_port)
     logging.info(f"Платежный токен: {TELEGRAM_PAYMENT_TOKEN[:10]}... (Тестовый режим: {IS_TEST_MODE})")
     logging.info(f"Каналы: Базовый: {CHANNEL_IDS['basic_subscription']}, Премиум: {CHANNEL_IDS['premium_subscription']}")
 
-    await async_init_db()  # Сначала создаём таблицы!
-    await subscription_service._init_subscription_plans()  # Потом инициализируем тарифы
-
+    if init_db:
+        engine = await prepare_database()
+    else:
+        # База уже подготовлена родительским процессом
+        engine = get_async_engine()
+        await subscription_service.plan_catalog.load()
+
+    await message_dispatcher.start()
+    for priority, name in PRIORITY_NAMES.items():
+        register_backlog(f'dispatcher_{name}', lambda priority=priority: message_dispatcher.depth[priority])
+    register_backlog('expiry_scheduler', lambda: len(expiry_scheduler))
+    # Фоновые циклы выполняются только в ведущем процессе (LEADER_BACKEND: local - процесс 0, redis - одна реплика из всех)
+    leader_election = LeaderElection(create_lease(worker_index))
+    tasks = [
+        leader_election.run({
+            'reminders': monitor_subscriptions,
+            # Отзыв доступа точно в срок окончания подписки (пачками, с ограниченной параллельностью)
+            'expiry': lambda: expiry_scheduler.run(expiry_sweeper.sweep),
+            # Сроки окончания от всех процессов: сервис подписок отправляет NOTIFY в транзакции оплаты или отмены
+            'expiry_listener': lambda: expiry_scheduler.listen_for_changes(engine),
+            # Действия в Telegram, записанные в outbox (удаление из канала, отзыв ссылок, уведомления)
+            'outbox': outbox_worker.run,
+            # Пополнение пула ссылок-приглашений для выдачи при оплате без обращения к Bot API
+            'invite_pool': lambda: invite_link_pool.run(subscription_service.plan_catalog),
+        }),
+    ]
+    # Ссылки на отзыв копятся в буфере процесса (или в Redis) и записываются в базу пачками
+    tasks.append(invite_link_revoker.run())
+    # Изменения тарифов и сброс кэша информации о подписках нужно получать в каждом процессе
+    tasks.append(subscription_service.plan_catalog.listen_for_changes(engine))
+    tasks.append(subscription_service.listen_for_info_changes(engine))
+    tasks.append(report_backlog())
+    if BOT_MODE == 'webhook':
+        tasks.append(serve_webhook(dp, bot, worker_index))
+    else:
+        tasks.append(dp.start_polling(bot))
     try:
-        # Запускаем мониторинг подписок параллельно с polling'ом
-        await asyncio.gather(
-            monitor_subscriptions(),
-            dp.start_polling(bot)
-        )
+        await asyncio.gather(*tasks)
     finally:
-        # Закрываем соединение с базой данных при завершении работы
-        subscription_service.close()
+        # Останавливаем очередь отправки и закрываем соединения пула при завершении работы
+        await message_dispatcher.stop()
+        try:
+            await invite_link_revoker.flush_all()
+        except Exception as e:
+            logging.error(f"Ошибка при записи отзыва ссылок при остановке: {e}")
+        await dp.storage.close()
+        await bot.session.close()
+        await dispose_async_engine()
+
+def run_worker(worker_index):
+    """Точка входа процесса бота в режиме webhook"""
+    reset_engine_after_fork()
+    # Без общего каталога метрик каждый процесс отдает свои метрики на отдельном порту
+    metrics_port = 0 if METRICS_MULTIPROC else METRICS_PORT and METRICS_PORT + worker_index
+    asyncio.run(main(worker_index, init_db=False, metrics_port=metrics_port))
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
-
-
-
-
-
+    if BOT_MODE == 'webhook':
+        check_webhook_secret()
+    if BOT_MODE == 'webhook' and WEBHOOK_WORKERS > 1:
+        check_fsm_storage(WEBHOOK_WORKERS)
+        # Таблицы и тарифы создаются один раз, соединения закрываются до запуска дочерних процессов
+        asyncio.run(prepare_database(dispose=True))
+        if METRICS_MULTIPROC:
+            # Метрики всех процессов отдает родительский процесс
+            start_metrics_server()
+        run_worker_processes(run_worker)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,235 @@
+from aiogram.exceptions import TelegramRetryAfter
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+# Приоритеты очереди исходящих запросов (меньше - важнее)
+PRIORITY_HIGH = 0    # Подтверждения оплаты, ответы на запросы вступления
+PRIORITY_NORMAL = 1  # Обычные ответы пользователю
+PRIORITY_BULK = 2    # Напоминания и массовые уведомления
+
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal', PRIORITY_BULK: 'bulk'}
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 сообщения в секунду в один чат.
+# BOT_RATE_LIMIT - общий лимит бота; бакеты живут в памяти процесса, поэтому он делится поровну
+# между BOT_RATE_PROCESSES процессами, отправляющими от имени бота (все процессы всех реплик и воркеры Celery).
+# По умолчанию - число процессов webhook на этом хосте
+BOT_RATE_LIMIT = float(os.getenv('BOT_RATE_LIMIT', '30'))
+BOT_RATE_PROCESSES = max(1, int(os.getenv('BOT_RATE_PROCESSES', os.getenv('WEBHOOK_WORKERS', '1'))))
+# Лимит на чат соблюдается в пределах процесса: сообщения одному чату обычно отправляет один процесс
+CHAT_RATE_LIMIT = float(os.getenv('CHAT_RATE_LIMIT', '1'))
+DISPATCHER_WORKERS = int(os.getenv('DISPATCHER_WORKERS', '8'))
+DISPATCHER_MAX_RETRIES = int(os.getenv('DISPATCHER_MAX_RETRIES', '3'))
+
+
+class TokenBucket:
+    """Token bucket с резервированием: reserve() занимает токен и возвращает, сколько нужно подождать"""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def is_idle(self):
+        """Бакет полон - его можно удалить без потери информации"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    def __init__(self, method, kwargs, priority, chat_id, future):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class MessageDispatcher:
+    """
+    Центральная очередь исходящих запросов к Bot API.
+
+    Запросы выполняются пулом воркеров в порядке приоритета с соблюдением лимитов
+    на бота (доля процесса от BOT_RATE_LIMIT) и на отдельный чат. При TelegramRetryAfter отправка приостанавливается
+    на указанное Telegram время, а запрос возвращается в очередь.
+    """
+
+    def __init__(self, bot=None, rate=BOT_RATE_LIMIT / BOT_RATE_PROCESSES, chat_rate=CHAT_RATE_LIMIT, workers=DISPATCHER_WORKERS,
+                 max_retries=DISPATCHER_MAX_RETRIES):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.max_retries = max_retries
+        self._bot_bucket = TokenBucket(rate)
+        self._chat_buckets = {}
+        self._queue = None
+        self._tasks = []
+        self._counter = itertools.count()
+        self._paused_until = 0.0
+        self._in_flight = set()  # futures вызовов, запрос которых уже отправлен в Telegram
+        # Метрики
+        self.depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self.sent = {priority: 0 for priority in PRIORITY_NAMES}
+        self.failed = {priority: 0 for priority in PRIORITY_NAMES}
+        self.started = {priority: 0 for priority in PRIORITY_NAMES}
+        self.total_wait = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self.max_wait = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self.retry_after_count = 0
+
+    def set_bot(self, bot):
+        """Установка экземпляра бота, через который выполняются запросы"""
+        self.bot = bot
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"[DISPATCHER] Запущено воркеров отправки: {self.workers}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def call(self, method, chat_id=None, priority=PRIORITY_NORMAL, wait=True, **kwargs):
+        """
+        Ставит вызов метода бота в очередь.
+        При wait=True дожидается результата, иначе возвращает future.
+        """
+        if not self._tasks:
+            await self.start()
+        if chat_id is not None:
+            kwargs['chat_id'] = chat_id
+        job = _Job(method, kwargs, priority, chat_id, asyncio.get_running_loop().create_future())
+        self._put(job)
+        if wait:
+            return await job.future
+        return job.future
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, wait=True, **kwargs):
+        return await self.call('send_message', chat_id=chat_id, priority=priority, wait=wait, text=text, **kwargs)
+
+    def withdraw(self, futures):
+        """Отменяет ещё не начатые вызовы (wait=False). Возвращает futures вызовов, которые уже выполняются"""
+        in_flight = []
+        for future in futures:
+            if future in self._in_flight:
+                in_flight.append(future)
+            else:
+                future.cancel()
+        return in_flight
+
+    def _put(self, job):
+        self.depth[job.priority] += 1
+        self._queue.put_nowait((job.priority, next(self._counter), job))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Периодически выбрасываем бакеты неактивных чатов
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_idle()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    async def _throttle(self, job):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        if job.chat_id is not None and job.method.startswith('send_'):
+            delay = self._chat_bucket(job.chat_id).reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        delay = self._bot_bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            self.depth[job.priority] -= 1
+            try:
+                await self._execute(job)
+            except Exception as e:
+                logging.error(f"[DISPATCHER] Необработанная ошибка воркера: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _execute(self, job):
+        if job.future.done():
+            return
+        await self._throttle(job)
+        if job.future.done():
+            # Вызов отменен, пока ждал лимита
+            return
+        if job.attempts == 0:
+            wait = time.monotonic() - job.enqueued_at
+            self.started[job.priority] += 1
+            self.total_wait[job.priority] += wait
+            self.max_wait[job.priority] = max(self.max_wait[job.priority], wait)
+        job.attempts += 1
+        self._in_flight.add(job.future)
+        try:
+            result = await getattr(self.bot, job.method)(**job.kwargs)
+        except TelegramRetryAfter as e:
+            self.retry_after_count += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logging.warning(f"[DISPATCHER] Flood limit: пауза {e.retry_after} сек ({job.method}, chat_id={job.chat_id})")
+            if job.attempts <= self.max_retries:
+                self._put(job)
+            else:
+                self.failed[job.priority] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        except Exception as e:
+            self.failed[job.priority] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        finally:
+            self._in_flight.discard(job.future)
+        self.sent[job.priority] += 1
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def get_stats(self):
+        """Глубина очереди, время ожидания и счетчики по приоритетам"""
+        return {
+            'paused_for': max(0.0, self._paused_until - time.monotonic()),
+            'retry_after': self.retry_after_count,
+            'lanes': {
+                name: {
+                    'depth': self.depth[priority],
+                    'sent': self.sent[priority],
+                    'failed': self.failed[priority],
+                    'avg_wait': self.total_wait[priority] / self.started[priority] if self.started[priority] else 0.0,
+                    'max_wait': self.max_wait[priority],
+                }
+                for priority, name in PRIORITY_NAMES.items()
+            },
+        }
+
+
+# Глобальный экземпляр очереди исходящих запросов
+message_dispatcher = MessageDispatcher()
@@ -0,0 +1,183 @@
+from aiogram import BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, start_http_server, multiprocess
+from sqlalchemy import event
+from app.query_log import add_query_observer
+import asyncio
+import logging
+import os
+import re
+import time
+
+# Порт HTTP-эндпоинта /metrics (0 - не запускать). В режиме нескольких процессов процесс i слушает METRICS_PORT + i
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+CELERY_METRICS_PORT = int(os.getenv('CELERY_METRICS_PORT', '9200'))
+# Если задан, метрики процессов пишутся в общий каталог и отдаются одним эндпоинтом (prometheus_client multiprocess)
+METRICS_MULTIPROC = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+# Как часто процесс записывает размеры очередей в BACKLOG, сек
+METRICS_BACKLOG_INTERVAL = float(os.getenv('METRICS_BACKLOG_INTERVAL', '5'))
+
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', 'Время обработки обновления хэндлером', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Исключения в хэндлерах', ['handler', 'error'])
+
+DB_QUERY_LATENCY = Histogram(
+    'bot_db_query_duration_seconds', 'Время выполнения SQL-запроса', ['statement'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+DB_QUERY_ERRORS = Counter('bot_db_query_errors_total', 'Ошибки SQL-запросов', ['statement'])
+DB_POOL_WAIT = Histogram(
+    'bot_db_pool_checkout_wait_seconds', 'Ожидание свободного соединения пула',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+DB_POOL_TIMEOUTS = Counter('bot_db_pool_checkout_timeouts_total', 'Соединение пула не получено за DB_POOL_TIMEOUT')
+DB_POOL_CHECKED_OUT = Gauge('bot_db_pool_checked_out', 'Занятые соединения пула', multiprocess_mode='livesum')
+
+BOT_API_LATENCY = Histogram('bot_api_request_duration_seconds', 'Время запроса к Bot API', ['method'])
+BOT_API_ERRORS = Counter('bot_api_errors_total', 'Ошибки запросов к Bot API', ['method', 'error'])
+BOT_API_RETRY_AFTER = Counter('bot_api_retry_after_total', 'Ответы 429 (flood limit) от Bot API', ['method'])
+
+SWEEP_DURATION = Histogram(
+    'bot_sweep_duration_seconds', 'Длительность прохода фоновой задачи', ['task'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+)
+SWEEP_PROCESSED = Counter('bot_sweep_processed_total', 'Подписки, обработанные фоновыми задачами', ['task'])
+BACKLOG = Gauge('bot_backlog_size', 'Размер очередей фоновой работы', ['queue'], multiprocess_mode='livesum')
+LEADER = Gauge('bot_leader', 'Процесс выполняет фоновые циклы (1 - ведущий)', ['name'], multiprocess_mode='livesum')
+
+_STATEMENT_RE = re.compile(r'^\s*(?:WITH\b.*?\)\s*)?(SELECT|INSERT|UPDATE|DELETE)\b', re.IGNORECASE | re.DOTALL)
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+def statement_label(statement):
+    """Метка запроса вида 'SELECT user_subscriptions' (ограниченное число значений для Prometheus)"""
+    match = _STATEMENT_RE.match(statement)
+    if not match:
+        return statement.split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    verb = match.group(1).upper()
+    table = _TABLE_RE.search(statement, match.start(1))
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+def _observe_query(statement, elapsed):
+    DB_QUERY_LATENCY.labels(statement_label(statement)).observe(elapsed)
+
+
+def _handle_error(context):
+    DB_QUERY_ERRORS.labels(statement_label(context.statement or '')).inc()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+
+def instrument_engine(engine):
+    """
+    Подписывается на события движка: время каждого запроса, ошибки и занятость пула.
+    Время запроса берется из общего замера журнала запросов (install_query_log должен быть подключен к движку).
+    Gauge занятых соединений меняется при выдаче и возврате соединения: set_function не работает
+    в режиме нескольких процессов.
+    """
+    sync_engine = engine.sync_engine
+    add_query_observer(_observe_query)
+    event.listen(sync_engine, 'handle_error', _handle_error)
+    event.listen(sync_engine, 'checkout', _on_checkout)
+    event.listen(sync_engine, 'checkin', _on_checkin)
+
+
+def record_pool_wait(wait, timed_out=False):
+    if timed_out:
+        DB_POOL_TIMEOUTS.inc()
+    else:
+        DB_POOL_WAIT.observe(wait)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время выполнения и исключения хэндлеров aiogram"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+def setup_handler_metrics(dp):
+    """Подключает HandlerMetricsMiddleware ко всем типам обновлений диспетчера"""
+    middleware = HandlerMetricsMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(middleware)
+
+
+class MetricsSession(AiohttpSession):
+    """Сессия aiogram, замеряющая время запросов к Bot API и считающая ошибки и 429"""
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await super().make_request(bot, method, timeout=timeout)
+        except TelegramRetryAfter:
+            BOT_API_RETRY_AFTER.labels(name).inc()
+            raise
+        except Exception as e:
+            BOT_API_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            BOT_API_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+_backlog_sources = {}
+
+
+def register_backlog(queue, fn):
+    """Размер очереди fn() записывается в BACKLOG{queue} циклом report_backlog"""
+    _backlog_sources[queue] = fn
+
+
+def update_backlog():
+    """Записывает текущие размеры зарегистрированных очередей"""
+    for queue, fn in _backlog_sources.items():
+        try:
+            BACKLOG.labels(queue).set(fn())
+        except Exception as e:
+            logging.error(f"[METRICS] Не удалось получить размер очереди {queue}: {e}")
+
+
+async def report_backlog(interval=METRICS_BACKLOG_INTERVAL):
+    """
+    Периодически обновляет BACKLOG. Значения задаются явно, а не через set_function,
+    чтобы их видел MultiProcessCollector в режиме нескольких процессов
+    """
+    while True:
+        update_backlog()
+        await asyncio.sleep(interval)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Запускает HTTP-эндпоинт метрик в фоновом потоке. port=0 - не запускать"""
+    if not port:
+        return
+    registry = REGISTRY
+    if METRICS_MULTIPROC:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+    logging.info(f"[METRICS] Метрики доступны на порту {port}")
+
+
+def mark_process_dead(pid):
+    """Удаляет файлы метрик завершившегося процесса (только в режиме нескольких процессов)"""
+    if METRICS_MULTIPROC:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,227 @@
+from app.database import get_async_session_maker, OutboxMessage
+from app.leader import leader_fence
+from app.message_dispatcher import message_dispatcher, PRIORITY_NORMAL, PRIORITY_BULK
+from app.metrics import SWEEP_PROCESSED
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import asyncio
+import logging
+import os
+import random
+
+# Виды действий
+OUTBOX_BAN = 'ban'                  # Удалить пользователя из канала (ban + unban)
+OUTBOX_REVOKE_LINK = 'revoke_link'  # Отозвать ссылку-приглашение
+OUTBOX_NOTIFY = 'notify'            # Отправить сообщение пользователю
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '20'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1'))  # сек
+# Через сколько забранное, но не завершенное действие снова станет доступно (воркер упал), сек
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', '120'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))  # Сколько хранить выполненные действия
+
+
+def ban_intent(channel_id, telegram_user_id, dedupe_key=None):
+    return {'kind': OUTBOX_BAN, 'payload': {'channel_id': str(channel_id), 'user_id': str(telegram_user_id)}, 'dedupe_key': dedupe_key}
+
+
+def revoke_link_intent(channel_id, invite_link):
+    return {'kind': OUTBOX_REVOKE_LINK, 'payload': {'channel_id': str(channel_id), 'invite_link': invite_link}, 'dedupe_key': f'revoke:{invite_link}'}
+
+
+def notify_intent(chat_id, text, priority=PRIORITY_BULK, dedupe_key=None):
+    return {'kind': OUTBOX_NOTIFY, 'payload': {'chat_id': str(chat_id), 'text': text, 'priority': priority}, 'dedupe_key': dedupe_key}
+
+
+async def enqueue(session, intents, now=None):
+    """
+    Записывает действия в outbox в текущей транзакции session одним INSERT.
+    Действия с уже записанным dedupe_key пропускаются.
+    """
+    if not intents:
+        return
+    now = now or datetime.utcnow()
+    await session.execute(
+        pg_insert(OutboxMessage)
+        .values([
+            {
+                'kind': intent['kind'],
+                'payload': intent['payload'],
+                'dedupe_key': intent.get('dedupe_key'),
+                'status': 'pending',
+                'attempts': 0,
+                'available_at': now,
+                'created_at': now,
+            }
+            for intent in intents
+        ])
+        .on_conflict_do_nothing(index_elements=[OutboxMessage.dedupe_key])
+    )
+
+
+class OutboxWorker:
+    """
+    Выполнение действий из outbox через очередь исходящих запросов.
+
+    Пачка забирается коротким UPDATE ... FOR UPDATE SKIP LOCKED (несколько воркеров не мешают друг другу),
+    вызовы Bot API выполняются без открытой транзакции, результаты пачки записываются одной короткой транзакцией.
+    Временные ошибки повторяются с экспоненциальной задержкой до OUTBOX_MAX_ATTEMPTS раз,
+    ошибки Telegram 400/403 считаются окончательными.
+    """
+
+    def __init__(self, async_session_maker=None, dispatcher=message_dispatcher, batch_size=OUTBOX_BATCH_SIZE,
+                 concurrency=OUTBOX_CONCURRENCY, max_attempts=OUTBOX_MAX_ATTEMPTS, poll_interval=OUTBOX_POLL_INTERVAL,
+                 lease=OUTBOX_LEASE):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease)
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        """Сообщает воркеру о новых действиях (вызывать после commit)"""
+        self._wakeup.set()
+
+    async def claim(self, limit, now=None):
+        """Забирает до limit готовых действий и продлевает их аренду на OUTBOX_LEASE"""
+        now = now or datetime.utcnow()
+        due = (
+            select(OutboxMessage.id)
+            .where(OutboxMessage.status == 'pending', OutboxMessage.available_at <= now)
+            .order_by(OutboxMessage.available_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(OutboxMessage)
+                    .where(OutboxMessage.id.in_(due), *leader_fence())
+                    .values(attempts=OutboxMessage.attempts + 1, available_at=now + self.lease)
+                    .returning(OutboxMessage.id, OutboxMessage.kind, OutboxMessage.payload, OutboxMessage.attempts)
+                    .execution_options(synchronize_session=False)
+                )
+                return result.all()
+
+    async def _ban(self, payload):
+        try:
+            await self.dispatcher.call('ban_chat_member', chat_id=payload['channel_id'], priority=PRIORITY_NORMAL, user_id=int(payload['user_id']))
+            await self.dispatcher.call('unban_chat_member', chat_id=payload['channel_id'], priority=PRIORITY_NORMAL,
+                                       user_id=int(payload['user_id']), only_if_banned=True)
+        except TelegramBadRequest as e:
+            if 'USER_NOT_PARTICIPANT' in str(e) or 'user not found' in str(e).lower():
+                logging.info(f"[OUTBOX] Пользователь {payload['user_id']} уже не состоит в канале {payload['channel_id']}")
+                return
+            raise
+
+    async def _revoke_link(self, payload):
+        try:
+            await self.dispatcher.call('revoke_chat_invite_link', chat_id=payload['channel_id'], priority=PRIORITY_NORMAL,
+                                       invite_link=payload['invite_link'])
+        except TelegramBadRequest as e:
+            if 'INVITE_HASH_EXPIRED' in str(e) or 'not found' in str(e).lower():
+                logging.info(f"[OUTBOX] Ссылка уже неактивна или не найдена: {payload['invite_link']}")
+                return
+            raise
+
+    async def _notify(self, payload):
+        await self.dispatcher.send_message(payload['chat_id'], payload['text'], priority=payload.get('priority', PRIORITY_BULK))
+
+    async def _execute(self, row, semaphore):
+        """Возвращает None при успехе, иначе (текст ошибки, окончательная ли ошибка)"""
+        handler = {OUTBOX_BAN: self._ban, OUTBOX_REVOKE_LINK: self._revoke_link, OUTBOX_NOTIFY: self._notify}.get(row.kind)
+        if handler is None:
+            return f"Неизвестный вид действия {row.kind}", True
+        async with semaphore:
+            try:
+                await handler(row.payload)
+                return None
+            except (TelegramBadRequest, TelegramForbiddenError) as e:
+                return str(e), True
+            except Exception as e:
+                return str(e), row.attempts >= self.max_attempts
+
+    def _backoff(self, attempts):
+        return timedelta(seconds=min(3600, 5 * 2 ** (attempts - 1)) + random.uniform(0, 1))
+
+    async def drain(self, now=None):
+        """Выполняет одну пачку действий. Возвращает количество забранных действий"""
+        rows = await self.claim(self.batch_size, now=now)
+        if not rows:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._execute(row, semaphore) for row in rows))
+        now = datetime.utcnow()
+        done = [row.id for row, error in zip(rows, results) if error is None]
+        updates = []
+        for row, error in zip(rows, results):
+            if error is None:
+                continue
+            message, final = error
+            if final:
+                logging.error(f"[OUTBOX] Действие {row.kind} #{row.id} не выполнено: {message}")
+                updates.append({'id': row.id, 'status': 'failed', 'processed_at': now, 'last_error': message})
+            else:
+                logging.warning(f"[OUTBOX] Действие {row.kind} #{row.id} будет повторено (попытка {row.attempts}): {message}")
+                updates.append({'id': row.id, 'available_at': now + self._backoff(row.attempts), 'last_error': message})
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                if done:
+                    await session.execute(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id.in_(done))
+                        .values(status='done', processed_at=now)
+                        .execution_options(synchronize_session=False)
+                    )
+                for values in updates:
+                    await session.execute(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id == values.pop('id'))
+                        .values(**values)
+                        .execution_options(synchronize_session=False)
+                    )
+        SWEEP_PROCESSED.labels('outbox').inc(len(rows))
+        logging.info(f"[OUTBOX] Выполнено действий: {len(done)} из {len(rows)}")
+        return len(rows)
+
+    async def purge(self, now=None):
+        """Удаляет выполненные действия старше OUTBOX_RETENTION_DAYS"""
+        now = now or datetime.utcnow()
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(
+                    delete(OutboxMessage).where(
+                        OutboxMessage.status != 'pending',
+                        OutboxMessage.processed_at < now - timedelta(days=OUTBOX_RETENTION_DAYS)
+                    )
+                )
+                return result.rowcount
+
+    async def run(self):
+        last_purge = None
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.drain() >= self.batch_size:
+                    pass
+                if last_purge is None or datetime.utcnow() - last_purge > timedelta(hours=1):
+                    await self.purge()
+                    last_purge = datetime.utcnow()
+            except Exception as e:
+                logging.error(f"[OUTBOX] Ошибка при обработке outbox: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Глобальный экземпляр воркера outbox
+outbox_worker = OutboxWorker()
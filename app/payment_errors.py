@@ -0,0 +1,235 @@
+from app.database import get_async_session_maker, PaymentError, SubscriptionPlan
+from app.keyboards import keyboard_cache
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import select, func, literal_column
+import os
+
+# Сколько ошибок показывается на одной странице /payment_errors
+PAYMENT_ERRORS_PAGE_SIZE = int(os.getenv('PAYMENT_ERRORS_PAGE_SIZE', '10'))
+# Сколько групп показывает сводка и по скольким первым символам сообщения группируются ошибки
+SUMMARY_LIMIT = 15
+SUMMARY_KEY_LENGTH = 80
+# Ограничения длины тяжелых полей в карточке ошибки (лимит сообщения Telegram - 4096 символов)
+DETAILS_PAYMENT_INFO_LENGTH = 1000
+DETAILS_STACK_TRACE_LENGTH = 2000
+
+CALLBACK_PREFIX = 'perr'
+SUMMARY_GROUPS = {'error': 'сообщению об ошибке', 'plan': 'тарифу'}
+
+
+def format_amount(amount, currency):
+    return f"{amount / 100:.2f} {currency or ''}".strip() if amount is not None else 'N/A'
+
+
+def _message_key(column):
+    # Длина - литерал, а не параметр: выражение в SELECT и GROUP BY должно совпадать для PostgreSQL
+    return func.left(column, literal_column(str(SUMMARY_KEY_LENGTH)))
+
+
+def _truncate(value, length, tail=False):
+    if not value or len(value) <= length:
+        return value or '-'
+    return '…' + value[-length:] if tail else value[:length] + '…'
+
+
+# Действия с id ошибки в аргументе
+ID_ACTIONS = ('open', 'older', 'newer')
+
+
+def is_payment_error_callback(data):
+    return (data or '').startswith(CALLBACK_PREFIX + ':')
+
+
+def parse_callback(data):
+    """
+    'perr:<действие>:<аргумент>' -> (действие, аргумент): id ошибки (int) для open/older/newer,
+    группа из SUMMARY_GROUPS для summary, None для list. None для чужих или некорректных данных
+    """
+    parts = (data or '').split(':', 2)
+    if len(parts) != 3 or parts[0] != CALLBACK_PREFIX:
+        return None
+    action, argument = parts[1], parts[2]
+    if action in ID_ACTIONS:
+        if not argument.isdigit():
+            return None
+        return action, int(argument)
+    if action == 'summary':
+        return (action, argument) if argument in SUMMARY_GROUPS else None
+    if action == 'list':
+        return action, None
+    return None
+
+
+class PaymentErrorPage:
+    """Страница неразрешенных ошибок (от новых к старым) и признаки соседних страниц"""
+
+    def __init__(self, rows, has_newer, has_older):
+        self.rows = rows
+        self.has_newer = has_newer
+        self.has_older = has_older
+
+
+class PaymentErrorConsole:
+    """
+    Просмотр неразрешенных ошибок платежей для администраторов.
+
+    Список выбирается keyset-пагинацией по id (индекс ix_payment_errors_unresolved_id) и содержит только
+    легкие колонки; payment_info и stack_trace читаются лишь при открытии одной ошибки.
+    Сводка считает количество и сумму платежей по группам в базе.
+    """
+
+    def __init__(self, async_session_maker=None, page_size=PAYMENT_ERRORS_PAGE_SIZE):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.page_size = page_size
+
+    def page_query(self, older_than=None, newer_than=None):
+        """Запрос страницы: на одну строку больше размера страницы, чтобы узнать, есть ли следующая"""
+        query = select(
+            PaymentError.id,
+            PaymentError.telegram_user_id,
+            PaymentError.plan_id,
+            PaymentError.payment_amount,
+            PaymentError.payment_currency,
+            PaymentError.payment_time,
+            _message_key(PaymentError.error_message).label('error_message'),
+        ).where(PaymentError.is_resolved == False)
+        if newer_than is not None:
+            # Назад: ближайшие более новые ошибки, затем порядок разворачивается
+            query = query.where(PaymentError.id > newer_than).order_by(PaymentError.id.asc())
+        else:
+            if older_than is not None:
+                query = query.where(PaymentError.id < older_than)
+            query = query.order_by(PaymentError.id.desc())
+        return query.limit(self.page_size + 1)
+
+    async def get_page(self, older_than=None, newer_than=None):
+        async with self.async_session_maker() as session:
+            result = await session.execute(self.page_query(older_than, newer_than))
+            rows = result.all()
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if newer_than is not None:
+            return PaymentErrorPage(rows[::-1], has_newer=has_more, has_older=True)
+        return PaymentErrorPage(rows, has_newer=older_than is not None, has_older=has_more)
+
+    def summary_query(self, group_by='error'):
+        if group_by == 'plan':
+            key = SubscriptionPlan.name
+            query = select(key.label('key')).select_from(PaymentError).outerjoin(
+                SubscriptionPlan, SubscriptionPlan.id == PaymentError.plan_id
+            )
+        elif group_by == 'error':
+            key = _message_key(PaymentError.error_message)
+            query = select(key.label('key'))
+        else:
+            raise ValueError(f"Неизвестная группировка сводки: {group_by}")
+        count = func.count(PaymentError.id)
+        return (
+            query.add_columns(
+                PaymentError.payment_currency,
+                count.label('count'),
+                func.sum(PaymentError.payment_amount).label('amount'),
+                func.max(PaymentError.payment_time).label('last_time'),
+            )
+            .where(PaymentError.is_resolved == False)
+            .group_by(key, PaymentError.payment_currency)
+            .order_by(count.desc())
+            .limit(SUMMARY_LIMIT)
+        )
+
+    async def get_summary(self, group_by='error'):
+        async with self.async_session_maker() as session:
+            result = await session.execute(self.summary_query(group_by))
+            return result.all()
+
+    async def get_details(self, error_id):
+        """Полная запись об ошибке, включая payment_info и stack_trace"""
+        async with self.async_session_maker() as session:
+            result = await session.execute(select(PaymentError).where(PaymentError.id == error_id))
+            return result.scalar_one_or_none()
+
+
+def format_page(page):
+    if not page.rows:
+        return "Нет неразрешенных ошибок платежей."
+    lines = ["🚨 Неразрешенные ошибки платежей:\n"]
+    for row in page.rows:
+        lines.append(
+            f"#{row.id} {row.payment_time.strftime('%d.%m.%Y %H:%M')} | {row.telegram_user_id} | "
+            f"{format_amount(row.payment_amount, row.payment_currency)} | план {row.plan_id or 'N/A'}\n"
+            f"   {row.error_message}"
+        )
+    lines.append("\nОткройте ошибку кнопкой, чтобы увидеть подробности.")
+    return '\n'.join(lines)
+
+
+def page_keyboard(page):
+    rows = [
+        [InlineKeyboardButton(text=f'#{row.id}', callback_data=f'{CALLBACK_PREFIX}:open:{row.id}') for row in page.rows[i:i + 5]]
+        for i in range(0, len(page.rows), 5)
+    ]
+    navigation = []
+    if page.has_newer and page.rows:
+        navigation.append(InlineKeyboardButton(text='⬅️ Новее', callback_data=f'{CALLBACK_PREFIX}:newer:{page.rows[0].id}'))
+    if page.has_older and page.rows:
+        navigation.append(InlineKeyboardButton(text='Старше ➡️', callback_data=f'{CALLBACK_PREFIX}:older:{page.rows[-1].id}'))
+    if navigation:
+        rows.append(navigation)
+    rows.append([
+        InlineKeyboardButton(text=f'Сводка по {title}', callback_data=f'{CALLBACK_PREFIX}:summary:{group_by}')
+        for group_by, title in SUMMARY_GROUPS.items()
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def format_summary(rows, group_by):
+    if not rows:
+        return "Нет неразрешенных ошибок платежей."
+    lines = [f"📊 Неразрешенные ошибки по {SUMMARY_GROUPS[group_by]}:\n"]
+    for row in rows:
+        lines.append(
+            f"{row.count} шт. | {format_amount(row.amount, row.payment_currency)} | "
+            f"последняя {row.last_time.strftime('%d.%m.%Y %H:%M')}\n   {row.key or 'без тарифа'}"
+        )
+    return '\n'.join(lines)
+
+
+@keyboard_cache
+def summary_keyboard(group_by):
+    other = [
+        InlineKeyboardButton(text=f'По {title}', callback_data=f'{CALLBACK_PREFIX}:summary:{key}')
+        for key, title in SUMMARY_GROUPS.items() if key != group_by
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        other,
+        [InlineKeyboardButton(text='К списку', callback_data=f'{CALLBACK_PREFIX}:list:')]
+    ])
+
+
+def format_details(error):
+    return (
+        f"🚨 Ошибка платежа #{error.id}:\n"
+        f"Пользователь: {error.telegram_user_id}\n"
+        f"Время платежа: {error.payment_time.strftime('%d.%m.%Y %H:%M:%S')}\n"
+        f"ID транзакции: {error.provider_payment_charge_id}\n"
+        f"Сумма: {format_amount(error.payment_amount, error.payment_currency)}\n"
+        f"План: {error.plan_id or 'N/A'}\n"
+        f"Payload: {error.invoice_payload or '-'}\n"
+        f"Ошибка: {_truncate(error.error_message, 500)}\n\n"
+        f"Платеж:\n{_truncate(error.payment_info, DETAILS_PAYMENT_INFO_LENGTH)}\n\n"
+        f"Стек вызовов:\n{_truncate(error.stack_trace, DETAILS_STACK_TRACE_LENGTH, tail=True)}\n\n"
+        f"Для разрешения используйте команду:\n"
+        f"/resolve_payment_error {error.id} <причина решения>"
+    )
+
+
+@keyboard_cache
+def details_keyboard(error_id):
+    # Возврат на страницу, которая начинается с этой ошибки
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='К списку', callback_data=f'{CALLBACK_PREFIX}:older:{error_id + 1}')]
+    ])
+
+
+# Глобальный экземпляр консоли ошибок платежей
+payment_error_console = PaymentErrorConsole()
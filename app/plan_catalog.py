@@ -0,0 +1,169 @@
+from app.database import SubscriptionPlan
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
+from sqlalchemy import select, text
+import asyncio
+import json
+import logging
+
+# Канал Postgres, в который отправляется NOTIFY при изменении тарифов
+PLANS_NOTIFY_CHANNEL = 'subscription_plans_changed'
+
+
+async def notify_plans_changed(session):
+    """Отправляет NOTIFY об изменении тарифов (доставляется после коммита транзакции)"""
+    await session.execute(text(f"NOTIFY {PLANS_NOTIFY_CHANNEL}"))
+
+
+class PlanCatalog:
+    """
+    Кэш каталога тарифных планов в памяти процесса.
+
+    Все тарифы загружаются одним запросом и хранятся до тех пор, пока не изменится версия каталога.
+    Версия повышается вызовом invalidate() или по LISTEN/NOTIFY из Postgres.
+    Вместе с тарифами хранятся готовая клавиатура выбора тарифа и параметры инвойсов,
+    чтобы не собирать их заново на каждый запрос.
+    """
+
+    def __init__(self, async_session_maker):
+        self.async_session_maker = async_session_maker
+        self.version = 0
+        self._loaded_version = None
+        self._lock = asyncio.Lock()
+        self._plans = []
+        self._plans_by_id = {}
+        self._plans_by_name = {}
+        self._keyboard = None
+        self._invoice_params = {}
+
+    def invalidate(self):
+        """Помечает каталог устаревшим: при следующем обращении он будет перезагружен"""
+        self.version += 1
+        logging.info(f"[PLANS] Каталог тарифов помечен устаревшим, версия {self.version}")
+
+    async def load(self):
+        """Загружает все тарифы из базы и перестраивает производные данные"""
+        async with self._lock:
+            await self._load()
+
+    async def _load(self):
+        version = self.version
+        async with self.async_session_maker() as session:
+            result = await session.execute(select(SubscriptionPlan).order_by(SubscriptionPlan.id))
+            plans = result.scalars().all()
+        self._apply(plans)
+        self._loaded_version = version
+        logging.info(f"[PLANS] Загружено тарифов в каталог: {len(plans)} (версия {version})")
+
+    async def ensure_loaded(self):
+        if self._loaded_version != self.version:
+            async with self._lock:
+                # Пока ждали блокировку, каталог мог загрузить другой запрос
+                if self._loaded_version != self.version:
+                    await self._load()
+
+    def _apply(self, plans):
+        self._plans = list(plans)
+        self._plans_by_id = {plan.id: plan for plan in self._plans}
+        self._plans_by_name = {plan.name: plan for plan in self._plans}
+        self._keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text=plan.name, callback_data=f'plan_{plan.id}')]
+                for plan in self._plans
+            ]
+        )
+        self._invoice_params = {}
+        for plan in self._plans:
+            for is_extension in (False, True):
+                self._invoice_params[(plan.id, is_extension)] = self._build_invoice_params(plan, is_extension)
+
+    @staticmethod
+    def _build_invoice_params(plan, is_extension):
+        """Собирает неизменяемую часть параметров инвойса для тарифа"""
+        # Данные для чека (provider_data)
+        provider_data = {
+            "receipt": {
+                "items": [
+                    {
+                        "description": f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name} на {plan.duration_days} дней",
+                        "quantity": 1.0,
+                        "amount": {
+                            "value": plan.price / 100,  # В рублях, а не копейках
+                            "currency": "RUB"
+                        },
+                        "vat_code": 1,  # НДС 20%
+                        "payment_mode": "full_payment",
+                        "payment_subject": "service"  # Услуга
+                    }
+                ],
+                "tax_system_code": 1  # Общая система налогообложения
+            }
+        }
+        return {
+            'preview_text': (
+                f"Вы выбрали {'продление подписки' if is_extension else 'подписку'}: {plan.name}\n"
+                f"Описание: {plan.description or '-'}\n"
+                f"Длительность: {plan.duration_days} дней\n"
+                f"Стоимость: {plan.price/100:.2f} руб.\n\n"
+                f"Нажмите кнопку ниже для оплаты:"
+            ),
+            'title': f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name}",
+            'description': f"Оплата {'продления доступа' if is_extension else 'доступа'} к тарифу {plan.name}, продолжительность - {plan.duration_days} дней",
+            'payload': f"extend_{plan.id}" if is_extension else f"plan_{plan.id}",
+            'currency': "RUB",
+            'prices': [LabeledPrice(label=plan.name, amount=plan.price)],
+            'provider_data': json.dumps(provider_data),
+        }
+
+    async def get_plans(self):
+        await self.ensure_loaded()
+        return self._plans
+
+    async def get_plan(self, plan_id):
+        """Тариф по ID или None"""
+        await self.ensure_loaded()
+        return self._plans_by_id.get(int(plan_id))
+
+    async def get_plan_by_name(self, name):
+        """Тариф по названию или None"""
+        await self.ensure_loaded()
+        return self._plans_by_name.get(name)
+
+    async def get_plan_keyboard(self):
+        """Готовая клавиатура выбора тарифа"""
+        await self.ensure_loaded()
+        return self._keyboard
+
+    async def get_invoice_params(self, plan_id, is_extension=False):
+        """Готовые параметры инвойса для тарифа или None, если тариф не найден"""
+        await self.ensure_loaded()
+        return self._invoice_params.get((int(plan_id), is_extension))
+
+    async def listen_for_changes(self, engine):
+        """
+        Держит отдельное соединение с LISTEN на канал изменений тарифов.
+        При получении уведомления каталог помечается устаревшим.
+        При обрыве соединения подписка восстанавливается, а каталог сбрасывается,
+        так как уведомления за время простоя могли быть потеряны.
+        """
+        def on_notify(connection, pid, channel, payload):
+            self.invalidate()
+
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    raw_connection = await conn.get_raw_connection()
+                    driver_connection = raw_connection.driver_connection
+                    await driver_connection.add_listener(PLANS_NOTIFY_CHANNEL, on_notify)
+                    logging.info(f"[PLANS] Подписка на канал {PLANS_NOTIFY_CHANNEL} установлена")
+                    try:
+                        while not driver_connection.is_closed():
+                            await asyncio.sleep(30)
+                    finally:
+                        if not driver_connection.is_closed():
+                            await driver_connection.remove_listener(PLANS_NOTIFY_CHANNEL, on_notify)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"[PLANS] Ошибка подписки на изменения тарифов: {e}")
+            self.invalidate()
+            await asyncio.sleep(5)
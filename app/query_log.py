@@ -0,0 +1,203 @@
+from aiogram import BaseMiddleware
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+# Запросы дольше порога попадают в журнал медленных запросов (0 - журнал отключен)
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '200'))
+# Сколько запросов к базе может выполнить обработка одного обновления, если для хэндлера не задан свой бюджет
+DB_QUERY_BUDGET = int(os.getenv('DB_QUERY_BUDGET', '10'))
+# Сколько различных запросов хранить в статистике по отпечаткам
+QUERY_STATS_MAXSIZE = 1000
+
+_NORMALIZE_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\$\d+|%\(\w+\)s|(?<!:):\w+\b'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\bIN \((?:\?,\s*)*\?\)', re.IGNORECASE), 'IN (...)'),
+    (re.compile(r'(\((?:\?,\s*)*\?\))(?:,\s*\((?:\?,\s*)*\?\))+'), r'\1, ...'),
+    (re.compile(r'\s+'), ' '),
+]
+
+_current_scope = ContextVar('query_scope', default=None)
+# Получатели замера каждого запроса (statement, elapsed): один замер времени на запрос для журнала и метрик
+_query_observers = []
+
+
+def normalize_statement(statement):
+    """Текст запроса без значений: литералы и параметры заменены на ?, списки IN и VALUES свернуты"""
+    for pattern, replacement in _NORMALIZE_RULES:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def fingerprint(statement):
+    """Короткий отпечаток запроса: одинаков для запросов, отличающихся только значениями"""
+    return hashlib.md5(normalize_statement(statement).encode()).hexdigest()[:12]
+
+
+def parameters_shape(parameters, executemany=False):
+    """Типы параметров без значений (значения могут содержать персональные данные)"""
+    if executemany and isinstance(parameters, (list, tuple)) and parameters:
+        return {'rows': len(parameters), 'row': parameters_shape(parameters[0])}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class QueryStats:
+    """Количество и время выполнения запросов по отпечаткам"""
+
+    def __init__(self, maxsize=QUERY_STATS_MAXSIZE):
+        self.maxsize = maxsize
+        self._stats = {}
+
+    def record(self, statement, elapsed):
+        key = fingerprint(statement)
+        entry = self._stats.get(key)
+        if entry is None:
+            if len(self._stats) >= self.maxsize:
+                return key
+            entry = self._stats[key] = {'statement': normalize_statement(statement)[:500], 'count': 0, 'total': 0.0, 'max': 0.0}
+        entry['count'] += 1
+        entry['total'] += elapsed
+        entry['max'] = max(entry['max'], elapsed)
+        return key
+
+    def top(self, limit=20):
+        """Запросы с наибольшим суммарным временем"""
+        ordered = sorted(self._stats.items(), key=lambda item: item[1]['total'], reverse=True)
+        return [{'fingerprint': key, **entry} for key, entry in ordered[:limit]]
+
+    def clear(self):
+        self._stats.clear()
+
+
+query_stats = QueryStats()
+
+
+class QueryScope:
+    """Счетчик запросов, выполненных внутри query_scope (включая вложенные области)"""
+
+    def __init__(self, name, budget, parent=None):
+        self.name = name
+        self.budget = budget
+        self.parent = parent
+        self.count = 0
+        self.elapsed = 0.0
+        self.fingerprints = {}
+
+    def record(self, key, elapsed):
+        scope = self
+        while scope is not None:
+            scope.count += 1
+            scope.elapsed += elapsed
+            scope.fingerprints[key] = scope.fingerprints.get(key, 0) + 1
+            scope = scope.parent
+
+    @property
+    def exceeded(self):
+        return self.budget is not None and self.count > self.budget
+
+
+@contextmanager
+def query_scope(name, budget=None):
+    """Считает запросы внутри блока и пишет предупреждение, если их больше budget"""
+    scope = QueryScope(name, budget, parent=_current_scope.get())
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        if scope.exceeded:
+            repeated = {key: count for key, count in scope.fingerprints.items() if count > 1}
+            logging.warning(
+                f"[QUERY_BUDGET] {name}: {scope.count} запросов при бюджете {budget} ({scope.elapsed * 1000:.1f} ms), "
+                f"повторяющиеся запросы: {repeated or '-'}"
+            )
+
+
+def query_budget(budget, name=None):
+    """Декоратор корутины: предупреждение, если один вызов выполняет больше budget запросов"""
+    def decorator(func):
+        scope_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with query_scope(scope_name, budget):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_log_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_log_started'].pop()
+    for observer in _query_observers:
+        observer(statement, elapsed)
+    key = query_stats.record(statement, elapsed)
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.record(key, elapsed)
+    if DB_SLOW_QUERY_MS and elapsed * 1000 >= DB_SLOW_QUERY_MS:
+        logging.warning("[SLOW_QUERY] " + json.dumps({
+            'fingerprint': key,
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'scope': scope.name if scope is not None else None,
+            'statement': normalize_statement(statement)[:1000],
+            'parameters': parameters_shape(parameters, executemany),
+        }, ensure_ascii=False))
+
+
+def _handle_error(context):
+    started = context.connection.info.get('query_log_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def add_query_observer(observer):
+    """Подписывает observer(statement, elapsed) на замер времени каждого запроса"""
+    if observer not in _query_observers:
+        _query_observers.append(observer)
+
+
+def install_query_log(engine):
+    """Подписывается на события движка: журнал медленных запросов, статистика и бюджеты запросов"""
+    sync_engine = engine.sync_engine
+    event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(sync_engine, 'handle_error', _handle_error)
+
+
+class QueryBudgetMiddleware(BaseMiddleware):
+    """Считает запросы к базе при обработке обновления и предупреждает о превышении бюджета хэндлера"""
+
+    def __init__(self, budgets=None, default_budget=DB_QUERY_BUDGET):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        with query_scope(name, self.budgets.get(name, self.default_budget)):
+            return await handler(event, data)
+
+
+def setup_query_budget(dp, budgets=None, default_budget=DB_QUERY_BUDGET):
+    """Подключает QueryBudgetMiddleware ко всем типам обновлений; budgets - {имя хэндлера: бюджет}"""
+    middleware = QueryBudgetMiddleware(budgets, default_budget)
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(middleware)
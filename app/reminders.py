@@ -0,0 +1,156 @@
+from app.database import get_async_session_maker, User, UserSubscription
+from app.expiry_sweeper import id_range_filter
+from app.leader import leader_fence
+from app.message_dispatcher import message_dispatcher, PRIORITY_BULK
+from app.metrics import SWEEP_DURATION, SWEEP_PROCESSED
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+import asyncio
+import logging
+import os
+import time
+
+# За сколько часов до окончания подписки отправляется напоминание
+REMINDER_HOURS = float(os.getenv('REMINDER_HOURS', '24'))
+# Сколько напоминаний забирается за раз и сколько секунд дается на отправку пачки
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', '500'))
+REMINDER_SEND_DEADLINE = float(os.getenv('REMINDER_SEND_DEADLINE', '60'))
+
+
+def hours_phrase(hours):
+    """24 -> '24 часа', 1 -> '1 час', 1.5 -> '1.5 ч'"""
+    if hours != int(hours):
+        return f"{hours:g} ч"
+    hours = int(hours)
+    if hours % 10 == 1 and hours % 100 != 11:
+        word = 'час'
+    elif hours % 10 in (2, 3, 4) and hours % 100 not in (12, 13, 14):
+        word = 'часа'
+    else:
+        word = 'часов'
+    return f"{hours} {word}"
+
+
+def reminder_text(hours=REMINDER_HOURS):
+    return f"⏰ Ваша подписка истекает через {hours_phrase(hours)}! Продлите её, чтобы не потерять доступ к каналу."
+
+
+class ReminderSender:
+    """
+    Напоминания об окончании подписки.
+
+    Пачка забирается одним UPDATE ... SET reminder_sent = true WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED LIMIT n)
+    RETURNING, поэтому любое число реплик бота и воркеров Celery делят работу без повторных напоминаний.
+    Напоминания, которые не удалось отправить до дедлайна пачки или из-за временной ошибки,
+    возвращаются (reminder_sent = false) и будут отправлены при следующем проходе. На дедлайне
+    отменяются только вызовы, которые очередь отправки ещё не начала; уже начатые дожидаются результата,
+    поэтому отправленное напоминание никогда не возвращается в очередь.
+    """
+
+    def __init__(self, async_session_maker=None, dispatcher=message_dispatcher, batch_size=REMINDER_BATCH_SIZE,
+                 deadline=REMINDER_SEND_DEADLINE, hours=REMINDER_HOURS, text=None):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.window = timedelta(hours=hours)
+        self.text = text or reminder_text(hours)
+
+    async def claim(self, limit, now=None, id_range=None):
+        """Помечает до limit подписок, которым пора напомнить, и возвращает их (id, telegram_user_id, end_date)"""
+        now = now or datetime.utcnow()
+        due = (
+            select(UserSubscription.id)
+            .where(
+                UserSubscription.is_active == True,
+                UserSubscription.reminder_sent == False,
+                UserSubscription.end_date > now,
+                UserSubscription.end_date <= now + self.window,
+                *id_range_filter(UserSubscription.id, id_range)
+            )
+            .order_by(UserSubscription.end_date)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(UserSubscription)
+                    .where(UserSubscription.id.in_(due), User.id == UserSubscription.user_id, *leader_fence())
+                    .values(reminder_sent=True)
+                    .returning(UserSubscription.id, User.telegram_user_id, UserSubscription.end_date)
+                    .execution_options(synchronize_session=False)
+                )
+                return result.all()
+
+    async def release(self, subscription_ids):
+        """Возвращает неотправленные напоминания в очередь"""
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                await session.execute(
+                    update(UserSubscription)
+                    .where(UserSubscription.id.in_(subscription_ids))
+                    .values(reminder_sent=False)
+                    .execution_options(synchronize_session=False)
+                )
+
+    async def _send_batch(self, rows):
+        """Отправляет пачку до дедлайна. Возвращает (отправлено, id подписок для повтора)"""
+        tasks = {}
+        for row in rows:
+            future = await self.dispatcher.send_message(row.telegram_user_id, self.text, priority=PRIORITY_BULK, wait=False)
+            tasks[future] = row
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        if pending:
+            # Ещё не начатые вызовы очередь отправки пропустит; начатые могли дойти до пользователя - ждем их результата
+            in_flight = self.dispatcher.withdraw(pending)
+            if in_flight:
+                finished, _ = await asyncio.wait(in_flight)
+                done |= finished
+                pending -= finished
+            logging.warning(f"[REMINDER] Не отправлено до дедлайна ({self.deadline} сек): {len(pending)}")
+        sent = 0
+        retry = [tasks[task].id for task in pending]
+        for task in done:
+            row = tasks[task]
+            error = task.exception()
+            if error is None:
+                sent += 1
+            elif isinstance(error, (TelegramBadRequest, TelegramForbiddenError)):
+                # Пользователь заблокировал бота или чат недоступен: повтор не поможет
+                logging.info(f"[REMINDER] Напоминание пользователю {row.telegram_user_id} не доставлено: {error}")
+            else:
+                logging.error(f"[REMINDER] Ошибка при отправке напоминания пользователю {row.telegram_user_id}: {error}")
+                retry.append(row.id)
+        return sent, retry
+
+    async def send_due(self, now=None, id_range=None):
+        """Отправляет все напоминания, которым пора (в диапазоне id_range, если задан). Возвращает статистику"""
+        now = now or datetime.utcnow()
+        started = time.monotonic()
+        stats = {'claimed': 0, 'sent': 0, 'released': 0}
+        while True:
+            rows = await self.claim(self.batch_size, now=now, id_range=id_range)
+            if not rows:
+                break
+            stats['claimed'] += len(rows)
+            sent, retry = await self._send_batch(rows)
+            stats['sent'] += sent
+            if retry:
+                await self.release(retry)
+                stats['released'] += len(retry)
+                # Повтор - при следующем проходе, чтобы не забирать те же подписки в цикле
+                break
+            if len(rows) < self.batch_size:
+                break
+        SWEEP_DURATION.labels('reminders').observe(time.monotonic() - started)
+        SWEEP_PROCESSED.labels('reminders').inc(stats['sent'])
+        if stats['claimed']:
+            logging.info(f"[REMINDER] Напоминаний отправлено: {stats['sent']} из {stats['claimed']}, возвращено в очередь: {stats['released']}")
+        return stats
+
+
+# Глобальный экземпляр отправки напоминаний
+reminder_sender = ReminderSender()
@@ -0,0 +1,207 @@
+from app.database import get_async_session_maker, SubscriptionStats, SubscriptionPlan
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import argparse
+import asyncio
+import logging
+import os
+import random
+
+# На сколько строк делится счетчик одного дня и тарифа: параллельные транзакции обновляют разные строки
+STATS_SLOTS = int(os.getenv('STATS_SLOTS', '8'))
+# Период для оттока и выручки и число дней в подневной таблице /stats
+STATS_PERIOD_DAYS = int(os.getenv('STATS_PERIOD_DAYS', '30'))
+STATS_DAILY_DAYS = int(os.getenv('STATS_DAILY_DAYS', '7'))
+
+STATS_FIELDS = (
+    'new_subscriptions', 'renewals', 'cancellations', 'expirations', 'active_delta', 'revenue', 'payment_errors'
+)
+
+
+class StatsDelta:
+    """Изменения счетчиков сводки, накопленные за одну транзакцию: {(день, тариф): {счетчик: приращение}}"""
+
+    def __init__(self):
+        self._rows = {}
+
+    def add(self, when, plan_id, **counters):
+        day = when.date() if isinstance(when, datetime) else when
+        row = self._rows.setdefault((day, plan_id or 0), dict.fromkeys(STATS_FIELDS, 0))
+        for name, value in counters.items():
+            row[name] += value
+        return self
+
+    def __bool__(self):
+        return any(any(row.values()) for row in self._rows.values())
+
+    def rows(self, slot=0):
+        # Порядок строк фиксирован, чтобы транзакции блокировали их в одном порядке
+        return [
+            {'day': day, 'plan_id': plan_id, 'slot': slot, **counters}
+            for (day, plan_id), counters in sorted(self._rows.items())
+            if any(counters.values())
+        ]
+
+
+async def record_stats(session, delta):
+    """Прибавляет delta к сводке в текущей транзакции (один INSERT ... ON CONFLICT DO UPDATE)"""
+    if not delta:
+        return
+    stmt = pg_insert(SubscriptionStats).values(delta.rows(slot=random.randrange(STATS_SLOTS)))
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[SubscriptionStats.day, SubscriptionStats.plan_id, SubscriptionStats.slot],
+        set_={name: getattr(SubscriptionStats, name) + stmt.excluded[name] for name in STATS_FIELDS}
+    ))
+
+
+# Восстановление сводки по текущему состоянию таблиц. Продления не восстанавливаются (история не хранится),
+# неактивная подписка с будущей датой окончания считается отмененной сегодня, с прошедшей - истекшей в день окончания
+_BACKFILL = """
+INSERT INTO subscription_stats_daily
+    (day, plan_id, slot, new_subscriptions, renewals, cancellations, expirations, active_delta, revenue, payment_errors)
+SELECT day, plan_id, 0, sum(new), 0, sum(cancelled), sum(expired), sum(active), sum(revenue), sum(errors)
+FROM (
+    SELECT s.start_date::date AS day, s.plan_id, 1 AS new, 0 AS cancelled, 0 AS expired, 1 AS active,
+           p.price AS revenue, 0 AS errors
+    FROM user_subscriptions s JOIN subscription_plans p ON p.id = s.plan_id
+    UNION ALL
+    SELECT CASE WHEN s.end_date <= :now THEN s.end_date::date ELSE :today END, s.plan_id, 0,
+           CASE WHEN s.end_date > :now THEN 1 ELSE 0 END, CASE WHEN s.end_date <= :now THEN 1 ELSE 0 END, -1, 0, 0
+    FROM user_subscriptions s WHERE s.is_active IS NOT TRUE
+    UNION ALL
+    SELECT payment_time::date, coalesce(plan_id, 0), 0, 0, 0, 0, 0, 1 FROM payment_errors
+) events
+GROUP BY day, plan_id
+"""
+
+
+class SubscriptionStatsReport:
+    """
+    Статистика для администраторов по дневной сводке subscription_stats_daily.
+
+    Сводка обновляется в транзакциях оплаты, продления, отмены и истечения подписок (record_stats),
+    поэтому отчет читает только её: число строк растет с числом дней и тарифов, а не с историей подписок.
+    """
+
+    def __init__(self, async_session_maker=None, period_days=STATS_PERIOD_DAYS, daily_days=STATS_DAILY_DAYS):
+        self.async_session_maker = async_session_maker or get_async_session_maker()
+        self.period_days = period_days
+        self.daily_days = daily_days
+
+    def plans_query(self, since):
+        """По тарифам: активные подписки (сумма active_delta за всё время) и счетчики за период"""
+        in_period = SubscriptionStats.day >= since
+        return (
+            select(
+                SubscriptionStats.plan_id,
+                SubscriptionPlan.name,
+                SubscriptionPlan.price,
+                SubscriptionPlan.duration_days,
+                func.sum(SubscriptionStats.active_delta).label('active'),
+                func.coalesce(func.sum(SubscriptionStats.active_delta).filter(in_period), 0).label('active_change'),
+                *[
+                    func.coalesce(func.sum(getattr(SubscriptionStats, name)).filter(in_period), 0).label(name)
+                    for name in ('new_subscriptions', 'renewals', 'cancellations', 'expirations', 'revenue', 'payment_errors')
+                ],
+            )
+            .outerjoin(SubscriptionPlan, SubscriptionPlan.id == SubscriptionStats.plan_id)
+            .group_by(SubscriptionStats.plan_id, SubscriptionPlan.name, SubscriptionPlan.price, SubscriptionPlan.duration_days)
+            .order_by(SubscriptionStats.plan_id)
+        )
+
+    def daily_query(self, since):
+        return (
+            select(
+                SubscriptionStats.day,
+                *[func.sum(getattr(SubscriptionStats, name)).label(name) for name in STATS_FIELDS],
+            )
+            .where(SubscriptionStats.day >= since)
+            .group_by(SubscriptionStats.day)
+            .order_by(SubscriptionStats.day.desc())
+        )
+
+    async def get_report(self, now=None):
+        today = (now or datetime.utcnow()).date()
+        async with self.async_session_maker() as session:
+            plans = (await session.execute(self.plans_query(today - timedelta(days=self.period_days - 1)))).all()
+            daily = (await session.execute(self.daily_query(today - timedelta(days=self.daily_days - 1)))).all()
+        return build_report(plans, daily, self.period_days)
+
+    async def backfill(self, now=None):
+        """Пересчитывает сводку по user_subscriptions и payment_errors. Изменения подписок ждут окончания пересчета"""
+        now = now or datetime.utcnow()
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                # Порядок блокировок тот же, что у транзакций подписок: сначала подписки, потом сводка
+                await session.execute(text('LOCK TABLE user_subscriptions, payment_errors IN SHARE MODE'))
+                await session.execute(text('LOCK TABLE subscription_stats_daily IN EXCLUSIVE MODE'))
+                await session.execute(text('DELETE FROM subscription_stats_daily'))
+                result = await session.execute(text(_BACKFILL), {'now': now, 'today': now.date()})
+        logging.info(f"[STATS] Сводка пересчитана, строк: {result.rowcount}")
+        return result.rowcount
+
+
+def build_report(plans, daily, period_days):
+    """Итоги отчета: активные подписки, MRR (в рублях) и отток за период"""
+    active = sum(plan.active or 0 for plan in plans)
+    churned = sum(plan.cancellations + plan.expirations for plan in plans)
+    active_at_start = active - sum(plan.active_change for plan in plans)
+    mrr = sum(
+        (plan.active or 0) * plan.price * 30 / plan.duration_days
+        for plan in plans if plan.price is not None and plan.duration_days
+    ) / 100
+    return {
+        'plans': [plan for plan in plans if plan.price is not None],
+        'daily': daily,
+        'period_days': period_days,
+        'active': active,
+        'mrr': mrr,
+        'churned': churned,
+        'churn_rate': churned / active_at_start if active_at_start > 0 else None,
+        'revenue': sum(plan.revenue for plan in plans) / 100,
+        'payment_errors': sum(plan.payment_errors for plan in plans),
+    }
+
+
+def format_report(report):
+    churn = f"{report['churn_rate'] * 100:.1f}%" if report['churn_rate'] is not None else 'N/A'
+    lines = [
+        "📈 Статистика подписок\n",
+        f"Активных подписок: {report['active']}",
+        f"MRR: {report['mrr']:.2f} ₽",
+        f"За {report['period_days']} дн.: выручка {report['revenue']:.2f} ₽, отток {report['churned']} ({churn}), "
+        f"ошибок платежей {report['payment_errors']}\n",
+        "По тарифам (активные / новые / продления / отток):",
+    ]
+    for plan in report['plans']:
+        lines.append(
+            f"{plan.name}: {plan.active} / {plan.new_subscriptions} / {plan.renewals} / "
+            f"{plan.cancellations + plan.expirations}"
+        )
+    lines.append("\nПо дням (новые / продления / отмены / истекли / выручка):")
+    for row in report['daily']:
+        lines.append(
+            f"{row.day.strftime('%d.%m')}: {row.new_subscriptions} / {row.renewals} / {row.cancellations} / "
+            f"{row.expirations} / {row.revenue / 100:.2f} ₽"
+        )
+    return '\n'.join(lines)
+
+
+# Глобальный экземпляр отчета
+subscription_stats = SubscriptionStatsReport()
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description='Сводка статистики подписок')
+    parser.add_argument('command', choices=['backfill', 'show'])
+    args = parser.parse_args()
+    if args.command == 'backfill':
+        await subscription_stats.backfill()
+    else:
+        print(format_report(await subscription_stats.get_report()))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,27 @@
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
+import logging
+import os
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+
+# Хранилище состояний FSM: memory (один процесс, теряется при перезапуске) или redis (общее для всех процессов бота)
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory').lower()
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', str(24 * 3600)))  # Время жизни состояния, сек
+FSM_DATA_TTL = int(os.getenv('FSM_DATA_TTL', str(24 * 3600)))  # Время жизни данных состояния, сек
+
+
+def create_fsm_storage():
+    """Создает хранилище состояний FSM согласно настройке FSM_STORAGE"""
+    if FSM_STORAGE == 'redis':
+        logging.info(f"[FSM] Хранилище состояний: Redis (state_ttl={FSM_STATE_TTL}, data_ttl={FSM_DATA_TTL})")
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_DATA_TTL)
+    if FSM_STORAGE != 'memory':
+        raise ValueError(f"Неизвестный тип хранилища состояний FSM_STORAGE={FSM_STORAGE}")
+    return MemoryStorage()
+
+
+def check_fsm_storage(workers):
+    """Несколько процессов бота видят общие состояния FSM только через Redis: иначе шаги диалога попадают в разные процессы"""
+    if workers > 1 and FSM_STORAGE != 'redis':
+        raise ValueError(f"Для {workers} процессов бота нужно FSM_STORAGE=redis (сейчас FSM_STORAGE={FSM_STORAGE})")
@@ -0,0 +1,84 @@
+from app.cache import TTLCache
+from sqlalchemy import select, func
+import asyncio
+import json
+import logging
+import os
+
+# Время жизни кэша информации о подписке пользователя, сек.
+# Изменения через сервис подписок сбрасывают кэш во всех процессах по NOTIFY; TTL ограничивает устаревание
+# для изменений без уведомления (импорт, SubscriptionManager) и на время переподключения LISTEN
+SUBSCRIPTION_INFO_TTL = float(os.getenv('SUBSCRIPTION_INFO_TTL', '30'))
+
+# Канал Postgres, в который отправляется NOTIFY с Telegram ID пользователей, чьи подписки изменились
+SUBSCRIPTION_INFO_NOTIFY_CHANNEL = 'subscription_info_changed'
+# Полезная нагрузка NOTIFY ограничена 8000 байт: длинный список делится на несколько уведомлений
+_NOTIFY_PAYLOAD_LIMIT = 7000
+
+
+async def notify_subscription_info_changed(session, telegram_user_ids):
+    """Сбрасывает кэш информации о подписках этих пользователей во всех процессах (доставляется после коммита)"""
+    ids = sorted({str(telegram_user_id) for telegram_user_id in telegram_user_ids if telegram_user_id is not None})
+    if not ids:
+        return
+    payloads, chunk, size = [], [], 2
+    for telegram_user_id in ids:
+        if chunk and size + len(telegram_user_id) + 4 > _NOTIFY_PAYLOAD_LIMIT:
+            payloads.append(json.dumps(chunk))
+            chunk, size = [], 2
+        chunk.append(telegram_user_id)
+        size += len(telegram_user_id) + 4
+    payloads.append(json.dumps(chunk))
+    await session.execute(select(*(func.pg_notify(SUBSCRIPTION_INFO_NOTIFY_CHANNEL, payload) for payload in payloads)))
+
+
+class SubscriptionInfoCache(TTLCache):
+    """
+    Кэш информации о подписке по Telegram ID (None - активной подписки нет) в памяти процесса.
+
+    Процесс, изменивший подписку, сбрасывает свою запись сразу, остальные - по LISTEN (listen_for_changes)
+    после коммита транзакции с notify_subscription_info_changed().
+    """
+
+    def __init__(self, ttl=SUBSCRIPTION_INFO_TTL, maxsize=10000):
+        super().__init__(ttl, maxsize=maxsize)
+
+    def invalidate(self, telegram_user_id):
+        self.pop(str(telegram_user_id))
+
+    def apply_notification(self, payload):
+        for telegram_user_id in json.loads(payload):
+            self.invalidate(telegram_user_id)
+
+    async def listen_for_changes(self, engine):
+        """
+        Держит отдельное соединение с LISTEN на канал изменений подписок (в каждом процессе).
+        При обрыве соединения кэш очищается целиком, так как уведомления за время простоя могли быть потеряны.
+        """
+        def on_notify(connection, pid, channel, payload):
+            try:
+                self.apply_notification(payload)
+            except Exception as e:
+                logging.error(f"[SUBSCRIPTION] Некорректное уведомление об изменении подписок {payload!r}: {e}")
+
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    raw_connection = await conn.get_raw_connection()
+                    driver_connection = raw_connection.driver_connection
+                    await driver_connection.add_listener(SUBSCRIPTION_INFO_NOTIFY_CHANNEL, on_notify)
+                    # Изменения до подписки на канал могли быть пропущены
+                    self.clear()
+                    logging.info(f"[SUBSCRIPTION] Подписка на канал {SUBSCRIPTION_INFO_NOTIFY_CHANNEL} установлена")
+                    try:
+                        while not driver_connection.is_closed():
+                            await asyncio.sleep(30)
+                    finally:
+                        if not driver_connection.is_closed():
+                            await driver_connection.remove_listener(SUBSCRIPTION_INFO_NOTIFY_CHANNEL, on_notify)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"[SUBSCRIPTION] Ошибка подписки на изменения подписок: {e}")
+            self.clear()
+            await asyncio.sleep(5)
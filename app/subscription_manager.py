@@ -2,6 +2,8 @@ from app.database import User, SubscriptionPlan, UserSubscription
 from datetime import datetime, timedelta
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import select, update
+from app.plan_catalog import notify_plans_changed
+from app.stats import StatsDelta, record_stats
 
 class SubscriptionManager:
     def __init__(self, session):
@@ -33,6 +35,8 @@ class SubscriptionManager:
                 duration_days=duration_days
             )
             self.session.add(plan)
+            # Сообщаем кэшам каталога тарифов об изменении
+            await notify_plans_changed(self.session)
             await self.session.commit()
             return plan
         except SQLAlchemyError as e:
@@ -68,6 +72,7 @@ class SubscriptionManager:
                 subscription.reminder_sent = reminder_sent
             
             self.session.add(subscription)
+            await record_stats(self.session, StatsDelta().add(start_date, plan_id, new_subscriptions=1, active_delta=1))
             if commit:
                 await self.session.commit()
             else:
@@ -87,6 +92,8 @@ class SubscriptionManager:
             if not subscription:
                 raise ValueError("Подписка не найдена")
             
+            if subscription.is_active:
+                await record_stats(self.session, StatsDelta().add(datetime.utcnow(), subscription.plan_id, cancellations=1, active_delta=-1))
             subscription.is_active = False
             await self.session.commit()
             return subscription
@@ -105,8 +112,11 @@ class SubscriptionManager:
             
             subscription.end_date = subscription.end_date + timedelta(days=days)
             
+            delta = StatsDelta().add(datetime.utcnow(), subscription.plan_id, renewals=1)
             if not subscription.is_active and subscription.end_date > datetime.utcnow():
                 subscription.is_active = True
+                delta.add(datetime.utcnow(), subscription.plan_id, active_delta=1)
+            await record_stats(self.session, delta)
             
             # Устанавливаем reminder_sent, если он передан
             if reminder_sent is not None:
@@ -131,6 +141,7 @@ class SubscriptionManager:
                 raise ValueError("У пользователя нет активной подписки")
             
             current_subscription.is_active = False
+            await record_stats(self.session, StatsDelta().add(datetime.utcnow(), current_subscription.plan_id, active_delta=-1))
             
             return await self.subscribe_user(user_id, new_plan_id)
         except SQLAlchemyError as e:
@@ -158,8 +169,11 @@ class SubscriptionManager:
             ))
             expired_subscriptions = result.scalars().all()
             
+            delta = StatsDelta()
             for subscription in expired_subscriptions:
                 subscription.is_active = False
+                delta.add(subscription.end_date, subscription.plan_id, expirations=1, active_delta=-1)
+            await record_stats(self.session, delta)
             
             if expired_subscriptions:
                 await self.session.commit()
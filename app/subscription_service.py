@@ -1,11 +1,22 @@
-from app.database import async_init_db, get_async_session_maker, User, SubscriptionPlan, UserSubscription
+from app.database import async_init_db, get_async_session_maker, User, SubscriptionPlan, UserSubscription, PaymentCharge
 from app.subscription_manager import SubscriptionManager
+from app.plan_catalog import PlanCatalog, notify_plans_changed
+from app.expiry_scheduler import notify_expiry_changed
+from app.subscription_info import SubscriptionInfoCache, notify_subscription_info_changed, SUBSCRIPTION_INFO_TTL
+from app.invite_links import invite_link_index, invite_link_revoker, InviteLinkEntry, INVITE_INDEX_FALLBACK_TTL
+from app.invite_link_pool import invite_link_pool
+from app.outbox import outbox_worker, enqueue, ban_intent, revoke_link_intent
+from app.query_log import query_budget
+from app.stats import StatsDelta, record_stats
 from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
 import os
 from dotenv import load_dotenv
 import logging
 import asyncio
-from sqlalchemy import select
+from sqlalchemy import select, update, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 import random
 
 # Загружаем переменные окружения
@@ -35,11 +46,58 @@ CHANNEL_IDS = {
     'premium_subscription': PREMIUM_CHANNEL_ID
 }
 
+class SubscriptionInfo(NamedTuple):
+    """Информация о текущей подписке пользователя для отображения в меню"""
+    subscription_id: int
+    plan_id: int
+    plan_name: str
+    start_date: datetime
+    end_date: datetime
+    days_left: int
+    is_active: bool
+    channel_id: Optional[str]
+    invite_link: Optional[str]
+
+
+class FulfillmentResult(NamedTuple):
+    """Результат обработки успешной оплаты"""
+    subscription_id: int
+    plan_id: int
+    plan_name: str
+    end_date: datetime
+    invite_link: Optional[str]
+    duplicate: bool  # Платеж с этим provider_payment_charge_id уже был обработан
+
+
+class DuplicateChargeError(Exception):
+    """Платеж с этим provider_payment_charge_id уже записан в payment_charges"""
+
+
+# Уникальные ограничения на ID транзакции: нарушение любого из них означает повторную доставку платежа
+CHARGE_KEY_CONSTRAINTS = ('uq_user_subscriptions_provider_payment_charge_id', 'payment_charges_provider_payment_charge_id_key')
+
+
+def is_duplicate_charge(error):
+    """IntegrityError вызван конфликтом по ID транзакции (а не другим ограничением)"""
+    orig = getattr(error, 'orig', None)
+    # asyncpg передает имя ограничения в исключении драйвера, обернутом адаптером SQLAlchemy
+    for candidate in (orig, getattr(orig, '__cause__', None)):
+        if getattr(candidate, 'constraint_name', None) in CHARGE_KEY_CONSTRAINTS:
+            return True
+    return False
+
+
 class SubscriptionService:
     def __init__(self, async_session_maker=None):
         self.engine = None
         self.async_session_maker = async_session_maker or get_async_session_maker()
         self.bot = None
+        self.plan_catalog = PlanCatalog(self.async_session_maker)
+        # Кэш информации о подписке по Telegram ID (None - активной подписки нет), сбрасывается во всех процессах по NOTIFY
+        self._info_cache = SubscriptionInfoCache(SUBSCRIPTION_INFO_TTL)
+        # Индекс ссылок-приглашений для проверки запросов на вступление без обращения к базе
+        self.invite_link_index = invite_link_index
+        invite_link_revoker.on_revoked = self.invalidate_subscription_info
         # self.manager = SubscriptionManager(self.session)  # manager будет переписан отдельно
         # Инициализация тарифных планов будет async
         # asyncio.create_task(self._init_subscription_plans())
@@ -48,12 +106,21 @@ class SubscriptionService:
         """Установка экземпляра бота для работы с API Telegram"""
         self.bot = bot
     
+    def invalidate_subscription_info(self, telegram_user_id):
+        """Сбрасывает кэш информации о подписке пользователя в этом процессе (другие получают NOTIFY из транзакции)"""
+        self._info_cache.invalidate(telegram_user_id)
+
+    async def listen_for_info_changes(self, engine):
+        """Сброс кэша информации о подписках по изменениям из других процессов"""
+        await self._info_cache.listen_for_changes(engine)
+    
     async def _init_subscription_plans(self):
         """Инициализация базовых тарифных планов при первом запуске"""
         async with self.async_session_maker() as session:
             result = await session.execute(select(SubscriptionPlan))
             existing_plans = result.scalars().all()
             if existing_plans:
+                await self.plan_catalog.load()
                 return
             
             # Базовый план на разные сроки
@@ -80,8 +147,11 @@ class SubscriptionService:
                 plan = SubscriptionPlan(**plan_data)
                 session.add(plan)
             
+            await notify_plans_changed(session)
             await session.commit()
             logging.info(f"Инициализированы планы подписки: {len(plans)} планов")
+        self.plan_catalog.invalidate()
+        await self.plan_catalog.load()
     
     async def get_user_by_telegram_id(self, telegram_user_id):
         """Получение пользователя по Telegram ID или создание нового"""
@@ -105,10 +175,8 @@ class SubscriptionService:
         else:
             plan_name = f"{SUBSCRIPTION_TYPE_MAP[subscription_type]} {DURATION_MAP[duration]} дней"
         
-        # Ищем план в базе данных
-        async with self.async_session_maker() as session:
-            result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.name == plan_name))
-            plan = result.scalar_one_or_none()
+        # Ищем план в каталоге тарифов
+        plan = await self.plan_catalog.get_plan_by_name(plan_name)
         
         if not plan:
             raise ValueError(f"План подписки {plan_name} не найден")
@@ -125,28 +193,33 @@ class SubscriptionService:
             raise ValueError("Бот не установлен в сервисе подписок")
         for attempt in range(max_retries):
             try:
+                # Соединение с базой не удерживается на время вызова Bot API
                 async with self.async_session_maker() as session:
-                    result = await session.execute(select(User).where(User.telegram_user_id == str(user_id)))
-                    user = result.scalar_one_or_none()
-                    if not user:
-                        raise ValueError(f"Пользователь с Telegram ID {user_id} не найден")
-                    # Находим активную подписку пользователя
-                    sub_result = await session.execute(select(UserSubscription).where(UserSubscription.user_id == user.id, UserSubscription.is_active == True))
-                    subscription = sub_result.scalar_one_or_none()
-                    if not subscription:
-                        raise ValueError(f"Активная подписка для пользователя {user_id} не найдена")
-                    invite_link_obj = await self.bot.create_chat_invite_link(
-                        chat_id=channel_id,
-                        name=f"Subscription_{user.telegram_user_id}",
-                        creates_join_request=True,
-                        expire_date=datetime.now() + timedelta(days=7),
-                        member_limit=1  # ссылка одноразовая
+                    result = await session.execute(
+                        select(UserSubscription.id, UserSubscription.end_date, User.telegram_user_id)
+                        .join(User, User.id == UserSubscription.user_id)
+                        .where(User.telegram_user_id == str(user_id), UserSubscription.is_active == True)
+                        .limit(1)
                     )
-                    # Сохраняем ссылку в подписке
-                    subscription.invite_link = invite_link_obj.invite_link
-                    session.add(subscription)
-                    await session.commit()
-                    return invite_link_obj.invite_link
+                    subscription = result.first()
+                if not subscription:
+                    raise ValueError(f"Активная подписка для пользователя {user_id} не найдена")
+                invite_link = await self._create_invite_link(channel_id, subscription.telegram_user_id)
+                # Сохраняем ссылку в подписке
+                async with self.async_session_maker() as session:
+                    async with session.begin():
+                        await session.execute(
+                            update(UserSubscription).where(UserSubscription.id == subscription.id).values(invite_link=invite_link)
+                        )
+                        await notify_subscription_info_changed(session, [user_id])
+                self.invalidate_subscription_info(user_id)
+                await self.invite_link_index.put(invite_link, InviteLinkEntry(
+                    telegram_user_id=str(subscription.telegram_user_id),
+                    subscription_id=subscription.id,
+                    channel_id=str(channel_id),
+                    expires_at=subscription.end_date
+                ))
+                return invite_link
             except Exception as e:
                 logging.error(f"Ошибка при создании ссылки-приглашения (попытка {attempt+1}): {str(e)}")
                 if attempt < max_retries - 1:
@@ -175,22 +248,40 @@ class SubscriptionService:
         except Exception as e:
             return False
     
-    async def is_valid_join_request(self, invite_link, user_id):
-        """Проверяет, валиден ли запрос на вступление от данного пользователя через базу"""
+    async def get_invite_link_entry(self, invite_link):
+        """
+        Кому выдана ссылка-приглашение: сначала из индекса ссылок, при промахе - одним запросом к базе.
+        Возвращает InviteLinkEntry или None, если ссылка не принадлежит активной подписке.
+        Запись из базы кладется в индекс ненадолго (INVITE_INDEX_FALLBACK_TTL) и только для не истекшей подписки.
+        """
+        entry = await self.invite_link_index.get(invite_link)
+        if entry is not None:
+            return entry
         async with self.async_session_maker() as session:
             result = await session.execute(
-                select(UserSubscription).where(
-                    UserSubscription.invite_link == invite_link,
-                    UserSubscription.is_active == True,
-                    UserSubscription.end_date > datetime.utcnow()
-                )
+                select(User.telegram_user_id, UserSubscription.id, SubscriptionPlan.channel_id, UserSubscription.end_date)
+                .join(User, User.id == UserSubscription.user_id)
+                .join(SubscriptionPlan, SubscriptionPlan.id == UserSubscription.plan_id)
+                .where(UserSubscription.invite_link == invite_link, UserSubscription.is_active == True)
+                .limit(1)
             )
-            sub = result.scalar_one_or_none()
-            if not sub:
-                return False
-            user_result = await session.execute(select(User).where(User.id == sub.user_id))
-            user = user_result.scalar_one_or_none()
-            return user and str(user.telegram_user_id) == str(user_id)
+            row = result.first()
+        if not row:
+            return None
+        entry = InviteLinkEntry(
+            telegram_user_id=str(row.telegram_user_id),
+            subscription_id=row.id,
+            channel_id=row.channel_id,
+            expires_at=row.end_date
+        )
+        if row.end_date > datetime.utcnow():
+            await self.invite_link_index.put(invite_link, entry, ttl=INVITE_INDEX_FALLBACK_TTL)
+        return entry
+    
+    async def is_valid_join_request(self, invite_link, user_id):
+        """Проверяет, валиден ли запрос на вступление от данного пользователя"""
+        entry = await self.get_invite_link_entry(invite_link)
+        return entry is not None and entry.allows(user_id)
     
     async def create_subscription(self, telegram_user_id, subscription_type=None, duration=None, plan_id=None):
         """Создание подписки для пользователя с полной транзакционностью"""
@@ -206,8 +297,7 @@ class SubscriptionService:
                 # Получаем план подписки
                 if plan_id is not None:
                     # Новый способ - по plan_id
-                    result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == plan_id))
-                    plan = result.scalar_one_or_none()
+                    plan = await self.plan_catalog.get_plan(plan_id)
                     if not plan:
                         raise ValueError(f"План подписки с ID {plan_id} не найден")
                 elif subscription_type and duration:
@@ -218,109 +308,352 @@ class SubscriptionService:
                 # Деактивируем существующие активные подписки
                 result = await session.execute(select(UserSubscription).where(UserSubscription.user_id == user.id))
                 active_subscriptions = result.scalars().all()
+                delta = StatsDelta()
+                expiry_changes = []
                 for subscription in active_subscriptions:
+                    if subscription.is_active:
+                        delta.add(datetime.utcnow(), subscription.plan_id, active_delta=-1)
+                        expiry_changes.append((subscription.id, None))
                     subscription.is_active = False
                     session.add(subscription)
+                await record_stats(session, delta)
                 
                 # Создаем новую подписку
                 subscription = await SubscriptionManager(session).subscribe_user(user.id, plan.id, reminder_sent=False, commit=False)
                 
-                # Генерируем ссылку и сохраняем её
-                if plan.channel_id and self.bot:
-                    try:
-                        invite_link_obj = await self.bot.create_chat_invite_link(
-                            chat_id=plan.channel_id,
-                            name=f"Subscription_{user.telegram_user_id}",
-                            creates_join_request=True,
-                            expire_date=datetime.now() + timedelta(days=7),
-                            member_limit=1  # ссылка одноразовая
-                        )
-                        subscription.invite_link = invite_link_obj.invite_link
-                    except Exception as e:
-                        logging.error(f"Ошибка при создании ссылки-приглашения: {str(e)}")
-                        raise
                 session.add(subscription)
                 await session.flush()
                 subscription_id = subscription.id
+                end_date = subscription.end_date
+                # Ведущему процессу: новый срок окончания и прежние подписки вне расписания
+                await notify_expiry_changed(session, expiry_changes + [(subscription_id, end_date)])
+                await notify_subscription_info_changed(session, [telegram_user_id])
+                # Ссылка из пула: соединение не держится открытым на время вызова Bot API
+                invite_link = None
+                if plan.channel_id:
+                    invite_link = await invite_link_pool.attach(session, subscription_id, plan.channel_id)
+            if plan.channel_id and not invite_link and self.bot:
+                invite_link = await self._create_invite_link(plan.channel_id, telegram_user_id)
+                async with session.begin():
+                    await session.execute(
+                        update(UserSubscription).where(UserSubscription.id == subscription_id).values(invite_link=invite_link)
+                    )
+                    await notify_subscription_info_changed(session, [telegram_user_id])
+            self.invalidate_subscription_info(telegram_user_id)
+            if invite_link:
+                await self.invite_link_index.put(invite_link, InviteLinkEntry(
+                    telegram_user_id=str(telegram_user_id),
+                    subscription_id=subscription_id,
+                    channel_id=plan.channel_id,
+                    expires_at=end_date
+                ))
             return subscription_id
     
-    async def get_subscription_info(self, telegram_user_id):
-        """Получение информации о текущей подписке пользователя"""
-        user = await self.get_user_by_telegram_id(telegram_user_id)
-        # Проверяем и обновляем истекшие подписки
-        async with self.async_session_maker() as session:
-            await SubscriptionManager(session).check_subscription_expiration()
-        # Получаем только активную подписку
+    async def _create_invite_link(self, channel_id, telegram_user_id):
+        invite_link_obj = await self.bot.create_chat_invite_link(
+            chat_id=channel_id,
+            name=f"Subscription_{telegram_user_id}",
+            creates_join_request=True,
+            expire_date=datetime.now() + timedelta(days=7),
+            member_limit=1  # ссылка одноразовая
+        )
+        return invite_link_obj.invite_link
+    
+    async def fulfill_payment(self, telegram_user_id, plan_id, provider_payment_charge_id, subscription_id=None):
+        """
+        Активация оплаченной подписки: новая подписка (subscription_id=None) или продление подписки subscription_id.
+        
+        Всё изменение базы выполняется одной транзакцией: новая подписка - upsert пользователя
+        с блокировкой строки, вставка и деактивация прежних; продление - один UPDATE с проверкой
+        владельца. Ссылка-приглашение забирается из пула invite_link_pool тем же соединением,
+        Bot API вызывается только если пул канала пуст. Каждый платеж записывается в payment_charges
+        в той же транзакции; повторная доставка любого прежнего платежа откатывает транзакцию и ничего не меняет.
+        Возвращает FulfillmentResult.
+        """
+        plan = await self.plan_catalog.get_plan(plan_id)
+        if not plan:
+            raise ValueError(f"План подписки с ID {plan_id} не найден")
+        key = str(telegram_user_id)
+        now = datetime.utcnow()
+        invite_link = None
+        try:
+            async with self.async_session_maker() as session:
+                async with session.begin():
+                    if subscription_id is None:
+                        fulfilled = await self._insert_paid_subscription(session, key, plan, provider_payment_charge_id, now)
+                    else:
+                        fulfilled = await self._extend_paid_subscription(session, key, subscription_id, plan, provider_payment_charge_id, now)
+                    if fulfilled:
+                        await self._record_charge(session, provider_payment_charge_id, fulfilled[0], now)
+                        new_id, end_date, replaced = fulfilled
+                        await notify_expiry_changed(session, [(new_id, end_date)] + [
+                            (old_id, None) for old_id, _, _ in replaced if old_id != new_id
+                        ])
+                        await notify_subscription_info_changed(session, [key])
+                    if fulfilled and plan.channel_id:
+                        invite_link = await invite_link_pool.attach(session, fulfilled[0], plan.channel_id, now)
+        except DuplicateChargeError:
+            # Платеж уже обработан: транзакция откатана вместе с вставкой или продлением
+            fulfilled = None
+        except IntegrityError as e:
+            # Конкурентная доставка того же платежа; остальные нарушения ограничений - настоящие ошибки
+            if not is_duplicate_charge(e):
+                raise
+            fulfilled = None
+        if fulfilled is None:
+            duplicate = await self._get_fulfilled_payment(provider_payment_charge_id)
+            if duplicate is None:
+                raise ValueError(f"Подписка ID={subscription_id} не найдена или не принадлежит пользователю {key}")
+            logging.info(f"[PAYMENT] Платеж {provider_payment_charge_id} уже обработан (подписка ID={duplicate.subscription_id})")
+            return duplicate
+        
+        if plan.channel_id and not invite_link and self.bot:
+            logging.warning(f"[PAYMENT] Пул ссылок канала {plan.channel_id} пуст, создаем ссылку через Bot API")
+            try:
+                invite_link = await self._create_invite_link(plan.channel_id, key)
+                async with self.async_session_maker() as session:
+                    async with session.begin():
+                        await session.execute(
+                            update(UserSubscription).where(UserSubscription.id == new_id).values(invite_link=invite_link)
+                        )
+                        await notify_subscription_info_changed(session, [key])
+            except Exception as e:
+                logging.error(f"[PAYMENT][ERROR] Ошибка при создании ссылки-приглашения для подписки ID={new_id}: {str(e)}")
+                invite_link = None
+        
+        # Сообщаем кэшам и индексу ссылок об изменениях (планировщик получил NOTIFY из транзакции)
+        self.invalidate_subscription_info(key)
+        for old_id, old_link, old_channel_id in replaced:
+            # Ссылка продлеваемой подписки отзывается, только если выдана новая
+            if old_link and (old_id != new_id or invite_link):
+                await invite_link_revoker.schedule(old_link, old_channel_id)
+        if invite_link:
+            await self.invite_link_index.put(invite_link, InviteLinkEntry(
+                telegram_user_id=key,
+                subscription_id=new_id,
+                channel_id=plan.channel_id,
+                expires_at=end_date
+            ))
+        return FulfillmentResult(
+            subscription_id=new_id,
+            plan_id=plan.id,
+            plan_name=plan.name,
+            end_date=end_date,
+            invite_link=invite_link,
+            duplicate=False
+        )
+    
+    async def _insert_paid_subscription(self, session, telegram_user_id, plan, provider_payment_charge_id, now):
+        """Новая подписка: (id, end_date, [(id, invite_link, channel_id) деактивированных]) или None для повторного платежа"""
+        # Upsert пользователя блокирует его строку до конца транзакции: оплаты одного пользователя выполняются по очереди
+        result = await session.execute(
+            pg_insert(User)
+            .values(telegram_user_id=telegram_user_id, is_active=True)
+            .on_conflict_do_update(index_elements=[User.telegram_user_id], set_={'is_active': True})
+            .returning(User.id)
+        )
+        user_id = result.scalar_one()
+        result = await session.execute(
+            pg_insert(UserSubscription)
+            .values(
+                user_id=user_id,
+                plan_id=plan.id,
+                start_date=now,
+                end_date=now + timedelta(days=plan.duration_days),
+                is_active=True,
+                reminder_sent=False,
+                provider_payment_charge_id=provider_payment_charge_id
+            )
+            .on_conflict_do_nothing(
+                index_elements=[UserSubscription.provider_payment_charge_id],
+                index_where=UserSubscription.provider_payment_charge_id.isnot(None)
+            )
+            .returning(UserSubscription.id, UserSubscription.end_date)
+        )
+        row = result.first()
+        if row is None:
+            return None
+        # Деактивируем прежние подписки пользователя
+        result = await session.execute(
+            update(UserSubscription)
+            .where(
+                UserSubscription.user_id == user_id,
+                UserSubscription.is_active == True,
+                UserSubscription.id != row.id,
+                SubscriptionPlan.id == UserSubscription.plan_id
+            )
+            .values(is_active=False)
+            .returning(UserSubscription.id, UserSubscription.invite_link, SubscriptionPlan.channel_id, UserSubscription.plan_id)
+            .execution_options(synchronize_session=False)
+        )
+        replaced = result.all()
+        delta = StatsDelta().add(now, plan.id, new_subscriptions=1, active_delta=1, revenue=plan.price)
+        for old in replaced:
+            # Смена тарифа: подписка перестает быть активной, но это не отток
+            delta.add(now, old.plan_id, active_delta=-1)
+        await record_stats(session, delta)
+        return row.id, row.end_date, [(old.id, old.invite_link, old.channel_id) for old in replaced]
+    
+    async def _extend_paid_subscription(self, session, telegram_user_id, subscription_id, plan, provider_payment_charge_id, now):
+        """Продление: (id, end_date, [(id, прежняя invite_link, channel_id)]) или None, если подписка чужая"""
+        # Подписка блокируется только если принадлежит плательщику; прежняя ссылка нужна для отзыва
+        target = (
+            select(UserSubscription.id, UserSubscription.invite_link, UserSubscription.is_active.label('was_active'))
+            .join(User, User.id == UserSubscription.user_id)
+            .where(UserSubscription.id == subscription_id, User.telegram_user_id == telegram_user_id)
+            .with_for_update(of=UserSubscription)
+            .cte('target')
+        )
+        end_date = UserSubscription.end_date + timedelta(days=plan.duration_days)
+        result = await session.execute(
+            update(UserSubscription)
+            .where(UserSubscription.id == target.c.id)
+            .values(
+                end_date=end_date,
+                is_active=or_(UserSubscription.is_active == True, end_date > now),
+                reminder_sent=False,
+                provider_payment_charge_id=provider_payment_charge_id
+            )
+            .returning(
+                UserSubscription.id, UserSubscription.end_date, target.c.invite_link,
+                UserSubscription.plan_id, UserSubscription.is_active, target.c.was_active
+            )
+            .execution_options(synchronize_session=False)
+        )
+        row = result.first()
+        if row is None:
+            return None
+        await record_stats(session, StatsDelta()
+                           .add(now, plan.id, renewals=1, revenue=plan.price)
+                           .add(now, row.plan_id, active_delta=int(bool(row.is_active)) - int(bool(row.was_active))))
+        return row.id, row.end_date, [(row.id, row.invite_link, plan.channel_id)]
+    
+    async def _record_charge(self, session, provider_payment_charge_id, subscription_id, now):
+        """Записывает платеж; уже записанный платеж - DuplicateChargeError, чтобы откатить транзакцию"""
+        # Конкурентная доставка того же платежа ждет здесь фиксации первой транзакции и получает конфликт
+        result = await session.execute(
+            pg_insert(PaymentCharge)
+            .values(provider_payment_charge_id=provider_payment_charge_id, subscription_id=subscription_id, created_at=now)
+            .on_conflict_do_nothing(index_elements=[PaymentCharge.provider_payment_charge_id])
+            .returning(PaymentCharge.id)
+        )
+        if result.scalar_one_or_none() is None:
+            raise DuplicateChargeError(provider_payment_charge_id)
+    
+    async def _get_fulfilled_payment(self, provider_payment_charge_id):
+        """Подписка, к которой уже привязан платеж, в виде FulfillmentResult или None"""
         async with self.async_session_maker() as session:
-            result = await session.execute(select(UserSubscription).where(UserSubscription.user_id == user.id, UserSubscription.is_active == True))
-            subscriptions = result.scalars().all()
-        if not subscriptions:
+            result = await session.execute(
+                select(UserSubscription.id, UserSubscription.plan_id, SubscriptionPlan.name, UserSubscription.end_date, UserSubscription.invite_link)
+                .join(PaymentCharge, PaymentCharge.subscription_id == UserSubscription.id)
+                .join(SubscriptionPlan, SubscriptionPlan.id == UserSubscription.plan_id)
+                .where(PaymentCharge.provider_payment_charge_id == provider_payment_charge_id)
+            )
+            row = result.first()
+        if not row:
             return None
-        subscription = subscriptions[0]
-        # Получаем план по plan_id
+        return FulfillmentResult(
+            subscription_id=row.id,
+            plan_id=row.plan_id,
+            plan_name=row.name,
+            end_date=row.end_date,
+            invite_link=row.invite_link,
+            duplicate=True
+        )
+    
+    @query_budget(2)
+    async def get_subscription_info(self, telegram_user_id):
+        """
+        Получение информации о текущей подписке пользователя одним запросом.
+        Учитываются только активные и не истекшие подписки; истекшие деактивирует expiry_sweeper.
+        """
+        key = str(telegram_user_id)
+        if key in self._info_cache:
+            return self._info_cache.get(key)
+        now = datetime.utcnow()
         async with self.async_session_maker() as session:
-            result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == subscription.plan_id))
-            plan = result.scalar_one_or_none()
-        days_left = (subscription.end_date - datetime.utcnow()).days
-        return {
-            'plan_name': plan.name if plan else 'Неизвестно',
-            'start_date': subscription.start_date,
-            'end_date': subscription.end_date,
-            'days_left': max(0, days_left),
-            'is_active': subscription.is_active,
-            'channel_id': plan.channel_id if plan else None,
-            'invite_link': subscription.invite_link
-        }
+            result = await session.execute(
+                select(
+                    UserSubscription.id,
+                    UserSubscription.plan_id,
+                    SubscriptionPlan.name,
+                    UserSubscription.start_date,
+                    UserSubscription.end_date,
+                    UserSubscription.invite_link,
+                    SubscriptionPlan.channel_id
+                )
+                .join(User, User.id == UserSubscription.user_id)
+                .join(SubscriptionPlan, SubscriptionPlan.id == UserSubscription.plan_id)
+                .where(
+                    User.telegram_user_id == key,
+                    UserSubscription.is_active == True,
+                    UserSubscription.end_date > now
+                )
+                .order_by(UserSubscription.end_date.desc())
+                .limit(1)
+            )
+            row = result.first()
+        info = None
+        if row:
+            info = SubscriptionInfo(
+                subscription_id=row.id,
+                plan_id=row.plan_id,
+                plan_name=row.name,
+                start_date=row.start_date,
+                end_date=row.end_date,
+                days_left=max(0, (row.end_date - now).days),
+                is_active=True,
+                channel_id=row.channel_id,
+                invite_link=row.invite_link
+            )
+        self._info_cache.set(key, info)
+        return info
     
-    async def remove_user_access(self, subscription: UserSubscription, max_retries=3):
+    async def remove_user_access(self, subscription: UserSubscription):
         """
-        Удаляет пользователя из канала, отзывает ссылку-приглашение, помечает подписку как неактивную и очищает ссылку в базе.
-        Все действия выполняются в одной транзакции.
-        Теперь подписка всегда деактивируется, даже если возникла ошибка при удалении пользователя из канала.
+        Отменяет подписку: деактивирует её, очищает ссылку и в той же транзакции записывает в outbox
+        удаление пользователя из канала и отзыв ссылки-приглашения. Транзакция не ждет Telegram -
+        действия выполняет outbox_worker с повторами при ошибках.
         """
-        if not self.bot:
-            logging.error("Бот не установлен в сервисе подписок")
-            return False
+        # Прежнее значение is_active нужно сводке: отменой считается только деактивация активной подписки
+        target = (
+            select(UserSubscription.id, UserSubscription.is_active.label('was_active'))
+            .where(UserSubscription.id == subscription.id)
+            .with_for_update()
+            .cte('target')
+        )
         async with self.async_session_maker() as session:
             async with session.begin():
-                result = await session.execute(select(User).where(User.id == int(subscription.user_id)))
-                user = result.scalar_one_or_none()
-                if not user:
-                    logging.error(f"Не найден пользователь для подписки {subscription.id}")
+                result = await session.execute(
+                    update(UserSubscription)
+                    .where(
+                        UserSubscription.id == target.c.id,
+                        User.id == UserSubscription.user_id,
+                        SubscriptionPlan.id == UserSubscription.plan_id
+                    )
+                    .values(is_active=False, invite_link=None)
+                    .returning(User.telegram_user_id, SubscriptionPlan.channel_id, UserSubscription.plan_id, target.c.was_active)
+                    .execution_options(synchronize_session=False)
+                )
+                row = result.first()
+                if not row:
+                    logging.error(f"Не найдена подписка {subscription.id} или её пользователь")
                     return False
-                # Пытаемся удалить пользователя из канала
-                removed = False
-                for attempt in range(max_retries):
-                    try:
-                        await self.bot.ban_chat_member(chat_id=subscription.channel_id, user_id=user.telegram_user_id)
-                        await self.bot.unban_chat_member(chat_id=subscription.channel_id, user_id=user.telegram_user_id, only_if_banned=True)
-                        removed = True
-                        break
-                    except Exception as e:
-                        if 'USER_NOT_PARTICIPANT' in str(e) or 'user not found' in str(e).lower() or 'chat not found' in str(e).lower():
-                            logging.info(f"[REMOVE] Пользователь {user.telegram_user_id} уже не состоит в канале {subscription.channel_id} или канал не найден.")
-                            break
-                        logging.error(f"Ошибка при удалении пользователя (попытка {attempt+1}): {e}")
-                        if attempt < max_retries - 1:
-                            await asyncio.sleep(2 ** attempt + random.uniform(0, 1))
-                # Пытаемся отозвать ссылку
-                if subscription.invite_link:
-                    for attempt in range(max_retries):
-                        try:
-                            await self.bot.revoke_chat_invite_link(chat_id=subscription.channel_id, invite_link=subscription.invite_link)
-                            break
-                        except Exception as e:
-                            if 'INVITE_HASH_EXPIRED' in str(e) or 'not found' in str(e).lower():
-                                logging.info(f"[REMOVE] Ссылка уже неактивна или не найдена: {subscription.invite_link}")
-                                break
-                            logging.error(f"Ошибка при отзыве ссылки (попытка {attempt+1}): {e}")
-                            if attempt < max_retries - 1:
-                                await asyncio.sleep(2 ** attempt + random.uniform(0, 1))
-                # ВСЕГДА деактивируем подписку и очищаем invite_link
-                subscription.is_active = False
-                subscription.invite_link = None
-                session.add(subscription)
-            return True
+                await notify_expiry_changed(session, [(subscription.id, None)])
+                await notify_subscription_info_changed(session, [row.telegram_user_id])
+                if row.was_active:
+                    await record_stats(session, StatsDelta().add(datetime.utcnow(), row.plan_id, cancellations=1, active_delta=-1))
+                intents = []
+                if row.channel_id:
+                    intents.append(ban_intent(row.channel_id, row.telegram_user_id))
+                    if subscription.invite_link:
+                        intents.append(revoke_link_intent(row.channel_id, subscription.invite_link))
+                await enqueue(session, intents)
+        outbox_worker.wake()
+        if subscription.invite_link:
+            await self.invite_link_index.evict(subscription.invite_link)
+        self.invalidate_subscription_info(row.telegram_user_id)
+        return True
 
     async def get_expiring_subscriptions(self, hours=24):
         """
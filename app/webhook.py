@@ -0,0 +1,145 @@
+from aiogram.types import Update
+from aiohttp import web
+import asyncio
+import hmac
+import logging
+import multiprocessing
+import os
+
+# Режим получения обновлений: polling (для разработки) или webhook (production)
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Публичный адрес, на который Telegram отправляет обновления (без пути), например https://bot.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Обязателен в режиме webhook: без него любой, кто знает адрес, может отправлять боту поддельные обновления
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Количество процессов, слушающих один порт (SO_REUSEPORT)
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))
+# Сколько обновлений один процесс обрабатывает одновременно
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100'))
+# Сколько одновременных соединений Telegram открывает к webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def check_webhook_secret(secret=WEBHOOK_SECRET):
+    """Webhook без секретного токена принимает обновления от кого угодно, поэтому запуск без него запрещен"""
+    if not secret:
+        raise ValueError('Не задан WEBHOOK_SECRET: в режиме webhook он обязателен (длинная случайная строка)')
+
+
+class WebhookHandler:
+    """
+    Прием обновлений от Telegram.
+
+    Проверяет секретный токен, сразу отвечает Telegram и обрабатывает обновление
+    в фоне через Dispatcher.feed_update. Одновременно обрабатывается не более
+    max_in_flight обновлений: при превышении ответ задерживается, и Telegram
+    сам снижает темп отправки.
+    """
+
+    def __init__(self, dp, bot, secret_token=WEBHOOK_SECRET, max_in_flight=WEBHOOK_MAX_IN_FLIGHT):
+        self.dp = dp
+        self.bot = bot
+        check_webhook_secret(secret_token)
+        self.secret_token = secret_token
+        self.max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+        self.received = 0
+        self.failed = 0
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    def _check_secret(self, request):
+        return hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token)
+
+    async def handle(self, request):
+        if not self._check_secret(request):
+            logging.warning(f"[WEBHOOK] Запрос с неверным секретным токеном от {request.remote}")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': self.bot})
+        except Exception as e:
+            logging.error(f"[WEBHOOK] Не удалось разобрать обновление: {e}")
+            return web.Response(status=400)
+        await self._semaphore.acquire()
+        self.received += 1
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"[WEBHOOK] Ошибка при обработке обновления {update.update_id}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def close(self):
+        """Дожидается обработки уже принятых обновлений"""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_webhook_app(handler, path=WEBHOOK_PATH):
+    app = web.Application()
+    app.router.add_post(path, handler.handle)
+    return app
+
+
+async def serve_webhook(dp, bot, worker_index=0, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH):
+    """Запускает HTTP-сервер webhook в текущем процессе. Webhook в Telegram регистрирует процесс с индексом 0"""
+    handler = WebhookHandler(dp, bot)
+    runner = web.AppRunner(create_webhook_app(handler, path))
+    await runner.setup()
+    # reuse_port позволяет нескольким процессам слушать один порт, ядро распределяет соединения между ними
+    site = web.TCPSite(runner, host, port, reuse_port=True)
+    await site.start()
+    logging.info(f"[WEBHOOK] Процесс {worker_index} слушает {host}:{port}{path} (max_in_flight={handler.max_in_flight})")
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    try:
+        if worker_index == 0:
+            if WEBHOOK_URL:
+                await bot.set_webhook(
+                    WEBHOOK_URL.rstrip('/') + path,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=dp.resolve_used_update_types(),
+                    max_connections=WEBHOOK_MAX_CONNECTIONS
+                )
+                logging.info(f"[WEBHOOK] Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{path}")
+            else:
+                logging.warning("[WEBHOOK] Не задан WEBHOOK_URL, webhook в Telegram не регистрируется")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await handler.close()
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+
+
+def run_worker_processes(target, workers=WEBHOOK_WORKERS):
+    """Запускает target(worker_index) в workers процессах и ждет их завершения"""
+    if workers <= 1:
+        target(0)
+        return
+    processes = [
+        multiprocessing.Process(target=target, args=(index,), name=f'bot-worker-{index}')
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"[WEBHOOK] Запущено процессов бота: {workers}")
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
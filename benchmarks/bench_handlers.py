@@ -0,0 +1,312 @@
+"""
+Бенчмарк задержки хэндлеров бота.
+
+Создает временную схему, заполняет её пользователями и подписками (по умолчанию 10k, 100k и 1M),
+прогоняет настоящие хэндлеры app/main.py через Dispatcher.feed_update с заглушкой сессии Bot
+(запросы в Telegram не уходят) и печатает p50/p99 задержки и количество SQL-запросов на обновление.
+Результаты сравниваются с сохраненной базовой линией: при регрессии скрипт завершается с кодом 1,
+без базовой линии или без сценария в ней - с кодом 2 (запишите её с --update-baseline).
+
+Запуск (нужна PostgreSQL из DATABASE_URL, данные пишутся только во временную схему):
+    PYTHONPATH=. python benchmarks/bench_handlers.py --sizes 10000,100000
+    PYTHONPATH=. python benchmarks/bench_handlers.py --update-baseline
+"""
+import os
+import sys
+import uuid
+
+# Схема и лимиты задаются до импорта модулей приложения: движок и очередь отправки читают их при импорте
+SCHEMA = f"bench_{uuid.uuid4().hex[:8]}"
+os.environ['DB_SCHEMA'] = SCHEMA
+os.environ.setdefault('BOT_RATE_LIMIT', '1000000')
+os.environ.setdefault('CHAT_RATE_LIMIT', '1000000')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+os.environ.setdefault('TELEGRAM_PAYMENT_TOKEN', '381764678:TEST:bench')
+os.environ.setdefault('BASIC_CHANNEL_ID', '-1001')
+os.environ.setdefault('PREMIUM_CHANNEL_ID', '-1002')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from app.database import DATABASE_URL, SubscriptionPlan, get_async_engine, dispose_async_engine
+from app.message_dispatcher import message_dispatcher
+from app.subscription_service import subscription_service
+from app.expiry_sweeper import expiry_sweeper
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update, Message, Chat, ChatInviteLink, User as TelegramUser
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import event, select, text
+from collections import Counter
+from datetime import datetime
+import argparse
+import asyncio
+import json
+import time
+import main
+
+DEFAULT_SIZES = '10000,100000,1000000'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_handlers.json')
+PAYMENT_USER_OFFSET = 10 ** 12  # telegram_user_id покупателей, которых нет среди заполненных пользователей
+
+
+class StubSession(BaseSession):
+    """Сессия Bot, отвечающая на вызовы Bot API без сети"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self._counter = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        self._counter += 1
+        returning = method.__returning__
+        if returning is Message:
+            return Message(
+                message_id=self._counter,
+                date=datetime.now(),
+                chat=Chat(id=int(getattr(method, 'chat_id', 0) or 0), type='private'),
+                text=getattr(method, 'text', None)
+            )
+        if returning is ChatInviteLink:
+            return ChatInviteLink(
+                invite_link=f'https://t.me/+stub_{self._counter}',
+                creator=TelegramUser(id=bot.id, is_bot=True, first_name='Bench'),
+                creates_join_request=True,
+                is_primary=False,
+                is_revoked=False
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class QueryCounter:
+    """Считает SQL-запросы, выполненные через движок приложения"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def tg_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+
+
+def manage_subscription_update(update_id, user_id):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+        'from': tg_user(user_id), 'text': 'Управление подпиской'
+    }}
+
+
+def join_request_update(update_id, user_id, channel_id, invite_link):
+    return {'update_id': update_id, 'chat_join_request': {
+        'chat': {'id': int(channel_id), 'type': 'channel', 'title': 'Bench'}, 'from': tg_user(user_id),
+        'user_chat_id': user_id, 'date': int(time.time()),
+        'invite_link': {'invite_link': invite_link, 'creator': {'id': 1, 'is_bot': True, 'first_name': 'Bench'},
+                        'creates_join_request': True, 'is_primary': False, 'is_revoked': False}
+    }}
+
+
+def pre_checkout_update(update_id, user_id, plan_id):
+    return {'update_id': update_id, 'pre_checkout_query': {
+        'id': str(update_id), 'from': tg_user(user_id), 'currency': 'RUB', 'total_amount': 10000,
+        'invoice_payload': f'plan_{plan_id}'
+    }}
+
+
+def successful_payment_update(update_id, user_id, plan_id, charge_id):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+        'from': tg_user(user_id),
+        'successful_payment': {'currency': 'RUB', 'total_amount': 10000, 'invoice_payload': f'plan_{plan_id}',
+                               'telegram_payment_charge_id': f'tg_{charge_id}', 'provider_payment_charge_id': charge_id}
+    }}
+
+
+async def seed(conn, rows, plan_id, channel_id, pool_links):
+    """
+    Заполняет таблицы: 10% подписок активны, из них часть истекает в ближайшие сутки или уже истекла.
+    Активные подписки с id, кратным 10, имеют ссылку-приглашение https://t.me/+link_<id>.
+    """
+    await conn.execute(text(
+        "TRUNCATE users, user_subscriptions, payment_errors, invite_link_pool, outbox RESTART IDENTITY CASCADE"
+    ))
+    await conn.execute(text(
+        "INSERT INTO users (id, telegram_user_id, is_active) "
+        "SELECT g, g::text, true FROM generate_series(1, :rows) g"
+    ), {'rows': rows})
+    await conn.execute(text("SELECT setval(pg_get_serial_sequence('users', 'id'), :rows)"), {'rows': rows})
+    await conn.execute(text(
+        """
+        INSERT INTO user_subscriptions
+            (user_id, plan_id, start_date, end_date, is_active, invite_link, reminder_sent, provider_payment_charge_id)
+        SELECT g, :plan_id, timezone('utc', now()) - interval '30 days',
+               CASE
+                   WHEN g % 100 = 0 THEN timezone('utc', now()) - interval '1 hour'
+                   WHEN g % 50 = 0 THEN timezone('utc', now()) + interval '12 hours'
+                   WHEN g % 10 = 0 THEN timezone('utc', now()) + interval '20 days'
+                   ELSE timezone('utc', now()) + (g % 365) * interval '1 day' - interval '400 days'
+               END,
+               g % 100 = 0 OR g % 50 = 0 OR g % 10 = 0,
+               CASE WHEN g % 10 = 0 THEN 'https://t.me/+link_' || g END,
+               false,
+               'charge_' || g
+        FROM generate_series(1, :rows) g
+        """
+    ), {'rows': rows, 'plan_id': plan_id})
+    await conn.execute(text(
+        "INSERT INTO invite_link_pool (channel_id, invite_link, expires_at, created_at) "
+        "SELECT :channel_id, 'https://t.me/+pool_' || g, timezone('utc', now()) + interval '7 days', timezone('utc', now()) "
+        "FROM generate_series(1, :count) g"
+    ), {'channel_id': str(channel_id), 'count': pool_links})
+    await conn.execute(text("ANALYZE"))
+
+
+def scenario_updates(rows, iterations, plan_id, channel_id, run_id):
+    """Обновления для каждого сценария; пользователи разные, чтобы кэш не скрывал запросы к базе"""
+    step = max(1, rows // iterations)
+    # Активные подписки со ссылкой, которые не истекают в ближайшие сутки
+    members = [g for g in range(10, rows + 1, 10) if g % 50][:iterations]
+    return {
+        'manage_subscription': [manage_subscription_update(i + 1, 1 + (i * step) % rows) for i in range(iterations)],
+        'process_join_request': [
+            join_request_update(i + 1, g, channel_id, f'https://t.me/+link_{g}') for i, g in enumerate(members)
+        ],
+        'process_pre_checkout_query': [pre_checkout_update(i + 1, 1 + (i * step) % rows, plan_id) for i in range(iterations)],
+        'process_successful_payment': [
+            successful_payment_update(i + 1, PAYMENT_USER_OFFSET + i, plan_id, f'bench_{run_id}_{rows}_{i}')
+            for i in range(iterations)
+        ],
+    }
+
+
+async def measure(name, calls, counter):
+    latencies = []
+    queries = 0
+    for call in calls:
+        before = counter.count
+        started = time.perf_counter()
+        await call()
+        latencies.append((time.perf_counter() - started) * 1000)
+        queries += counter.count - before
+    result = {
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'queries': round(queries / len(calls), 2),
+    }
+    print(f"  {name:30s} p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  запросов {result['queries']:7.2f}  (n={len(calls)})")
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Возвращает (регрессии, сценарии без базовой линии)"""
+    regressions = []
+    missing = []
+    for size, scenarios in results.items():
+        for name, current in scenarios.items():
+            expected = baseline.get(size, {}).get(name)
+            if not expected:
+                missing.append(f"{size}/{name}")
+                continue
+            if current['p99_ms'] > expected['p99_ms'] * (1 + tolerance):
+                regressions.append(f"{size}/{name}: p99 {current['p99_ms']} ms > {expected['p99_ms']} ms (+{tolerance:.0%})")
+            if current['queries'] > expected['queries']:
+                regressions.append(f"{size}/{name}: запросов {current['queries']} > {expected['queries']}")
+    return regressions, missing
+
+
+async def monitor_pass():
+    """Один проход фоновых циклов ведущего: отзыв доступа по истекшим подпискам и напоминания"""
+    await expiry_sweeper.sweep()
+    await main.remind_expiring_subscriptions()
+
+
+async def run(sizes, iterations, sweep_iterations):
+    admin_engine = create_async_engine(DATABASE_URL)
+    stub = StubSession()
+    main.bot.session = stub
+    run_id = uuid.uuid4().hex[:8]
+    results = {}
+    try:
+        async with admin_engine.begin() as conn:
+            await conn.execute(text(f'CREATE SCHEMA "{SCHEMA}"'))
+        await main.prepare_database()
+        engine = get_async_engine()
+        counter = QueryCounter(engine)
+        async with subscription_service.async_session_maker() as session:
+            plan = (await session.execute(select(SubscriptionPlan).order_by(SubscriptionPlan.id).limit(1))).scalar_one()
+        await message_dispatcher.start()
+        for rows in sizes:
+            print(f"Заполнение {rows} подписок в схеме {SCHEMA}...")
+            async with engine.begin() as conn:
+                await seed(conn, rows, plan.id, plan.channel_id, pool_links=iterations)
+            subscription_service._info_cache.clear()
+            print(f"Размер {rows}:")
+            size_results = {}
+            for name, updates in scenario_updates(rows, iterations, plan.id, plan.channel_id, run_id).items():
+                if not updates:
+                    continue
+                parsed = [Update.model_validate(data, context={'bot': main.bot}) for data in updates]
+                size_results[name] = await measure(
+                    name, [lambda update=update: main.dp.feed_update(main.bot, update) for update in parsed], counter
+                )
+            size_results['monitor_subscriptions'] = await measure(
+                'monitor_subscriptions', [monitor_pass] * sweep_iterations, counter
+            )
+            results[str(rows)] = size_results
+        print(f"Вызовы Bot API: {dict(stub.calls)}")
+    finally:
+        await message_dispatcher.stop()
+        await dispose_async_engine()
+        async with admin_engine.begin() as conn:
+            await conn.execute(text(f'DROP SCHEMA IF EXISTS "{SCHEMA}" CASCADE'))
+        await admin_engine.dispose()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Задержка хэндлеров бота на заполненной базе')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Количество пользователей и подписок через запятую')
+    parser.add_argument('--iterations', type=int, default=200, help='Обновлений на сценарий')
+    parser.add_argument('--sweep-iterations', type=int, default=3, help='Проходов monitor_subscriptions')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Файл базовой линии (JSON)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Допустимый рост p99 относительно базовой линии')
+    parser.add_argument('--update-baseline', action='store_true', help='Записать результаты как новую базовую линию')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    results = asyncio.run(run(sizes, args.iterations, args.sweep_iterations))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Базовая линия записана в {args.baseline}")
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print(f"Базовая линия {args.baseline} не найдена (запустите с --update-baseline)")
+        sys.exit(2)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions, missing = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("РЕГРЕССИЯ:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    if missing:
+        print(f"Нет в базовой линии: {', '.join(missing)} (обновите её с --update-baseline)")
+        sys.exit(2)
+    print("Регрессий относительно базовой линии нет")
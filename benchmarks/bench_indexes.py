@@ -0,0 +1,133 @@
+"""
+Бенчмарк индексов user_subscriptions.
+
+Создает временную схему, заполняет её большим количеством пользователей и подписок,
+выполняет горячие запросы через EXPLAIN ANALYZE и проверяет, что каждый из них
+использует индекс, а не последовательное сканирование user_subscriptions.
+
+Запуск (нужна PostgreSQL из DATABASE_URL, данные пишутся только во временную схему):
+    PYTHONPATH=. python benchmarks/bench_indexes.py --rows 500000
+"""
+from app.database import Base, async_ensure_indexes, DATABASE_URL
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import text
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import json
+import sys
+import uuid
+
+# Горячие запросы в том виде, в котором их выполняют сервис и хэндлеры
+HOT_QUERIES = {
+    'get_expiring_subscriptions': (
+        "SELECT * FROM user_subscriptions WHERE is_active = true AND end_date > :now AND end_date <= :soon",
+        lambda now: {'now': now, 'soon': now + timedelta(hours=24)}
+    ),
+    'get_expired_subscriptions': (
+        "SELECT * FROM user_subscriptions WHERE is_active = true AND end_date < :now",
+        lambda now: {'now': now}
+    ),
+    'get_recently_expired_subscriptions': (
+        "SELECT * FROM user_subscriptions WHERE is_active = false AND end_date >= :last_check AND end_date < :now",
+        lambda now: {'now': now, 'last_check': now - timedelta(minutes=2)}
+    ),
+    'is_valid_join_request': (
+        "SELECT * FROM user_subscriptions WHERE invite_link = :invite_link AND is_active = true AND end_date > :now",
+        lambda now: {'now': now, 'invite_link': 'https://t.me/+link_42'}
+    ),
+    'get_subscription_info': (
+        "SELECT * FROM user_subscriptions WHERE user_id = :user_id AND is_active = true",
+        lambda now: {'user_id': 42}
+    ),
+    'payment_by_charge_id': (
+        "SELECT * FROM user_subscriptions WHERE provider_payment_charge_id = :charge_id",
+        lambda now: {'charge_id': 'charge_42'}
+    ),
+}
+
+INDEX_NODES = {'Index Scan', 'Index Only Scan', 'Bitmap Index Scan'}
+
+
+def collect_nodes(plan, nodes):
+    nodes.append(plan)
+    for child in plan.get('Plans', []):
+        collect_nodes(child, nodes)
+    return nodes
+
+
+async def seed(conn, rows):
+    """Заполняет таблицы: 10% подписок активны, из них часть истекает в ближайшие сутки или уже истекла"""
+    await conn.execute(text(
+        "INSERT INTO subscription_plans (id, name, price, duration_days, channel_id) "
+        "VALUES (1, 'Bench', 10000, 30, '-100')"
+    ))
+    await conn.execute(text(
+        "INSERT INTO users (id, telegram_user_id, is_active) "
+        "SELECT g, g::text, true FROM generate_series(1, :rows) g"
+    ), {'rows': rows})
+    await conn.execute(text(
+        """
+        INSERT INTO user_subscriptions
+            (user_id, plan_id, start_date, end_date, is_active, invite_link, reminder_sent, provider_payment_charge_id)
+        SELECT g, 1, now() - interval '30 days',
+               CASE
+                   WHEN g % 100 = 0 THEN now() - interval '1 hour'
+                   WHEN g % 50 = 0 THEN now() + interval '12 hours'
+                   WHEN g % 10 = 0 THEN now() + interval '20 days'
+                   ELSE now() + (g % 365) * interval '1 day' - interval '400 days'
+               END,
+               g % 100 = 0 OR g % 50 = 0 OR g % 10 = 0,
+               CASE WHEN g % 10 = 0 THEN 'https://t.me/+link_' || g END,
+               false,
+               'charge_' || g
+        FROM generate_series(1, :rows) g
+        """
+    ), {'rows': rows})
+    await conn.execute(text("ANALYZE"))
+
+
+async def run(rows):
+    schema = f"bench_{uuid.uuid4().hex[:8]}"
+    engine = create_async_engine(DATABASE_URL, connect_args={'server_settings': {'search_path': schema}})
+    failed = []
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(f'CREATE SCHEMA "{schema}"'))
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await async_ensure_indexes(engine)
+        print(f"Заполнение {rows} подписок в схеме {schema}...")
+        async with engine.begin() as conn:
+            await seed(conn, rows)
+        now = datetime.utcnow()
+        async with engine.connect() as conn:
+            for name, (sql, params) in HOT_QUERIES.items():
+                result = await conn.execute(text("EXPLAIN (ANALYZE, FORMAT JSON) " + sql), params(now))
+                explain = result.scalar_one()
+                if isinstance(explain, str):
+                    explain = json.loads(explain)
+                plan = explain[0]
+                nodes = collect_nodes(plan['Plan'], [])
+                index_names = [node['Index Name'] for node in nodes if node['Node Type'] in INDEX_NODES]
+                seq_scans = [node for node in nodes if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == 'user_subscriptions']
+                ok = bool(index_names) and not seq_scans
+                status = 'OK ' if ok else 'FAIL'
+                print(f"[{status}] {name:38s} {plan['Execution Time']:9.3f} ms  индексы: {', '.join(index_names) or '-'}")
+                if not ok:
+                    failed.append(name)
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE'))
+        await engine.dispose()
+    if failed:
+        print(f"Запросы без индекса: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Проверка использования индексов горячими запросами')
+    parser.add_argument('--rows', type=int, default=500000, help='Количество пользователей и подписок')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.rows)))
@@ -0,0 +1,92 @@
+"""
+Микробенчмарк клавиатур.
+
+Сравнивает прежний способ (асинхронная функция собирает и валидирует новое дерево моделей
+ReplyKeyboardMarkup/InlineKeyboardMarkup на каждый вызов) с реестром app/keyboards.py
+(готовый объект по имени) и кэшем параметризованных клавиатур. Печатает время одного вызова
+и экономию на одно обновление. База данных не нужна.
+
+Запуск:
+    PYTHONPATH=. python benchmarks/bench_keyboards.py --iterations 100000 --per-update 2
+"""
+from app.keyboards import REPLY_KEYBOARDS, INLINE_KEYBOARDS, reply_keyboard, inline_keyboard, keyboard_cache
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+import argparse
+import asyncio
+import json
+import time
+
+
+def rebuild(markup):
+    """Новое дерево моделей с валидацией - то, что делали прежние get_*_keyboard на каждый вызов"""
+    return type(markup).model_validate(markup.model_dump(exclude_none=True))
+
+
+async def legacy_get_keyboard(registry, name):
+    return rebuild(registry[name])
+
+
+def build_details_keyboard(error_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='К списку', callback_data=f'perr:older:{error_id + 1}')]
+    ])
+
+
+cached_details_keyboard = keyboard_cache(build_details_keyboard)
+
+
+def measure(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+async def measure_async(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+async def run(iterations, per_update):
+    results = {}
+    for registry, lookup, names in ((REPLY_KEYBOARDS, reply_keyboard, ['start']),
+                                    (INLINE_KEYBOARDS, inline_keyboard, ['manage_existing_subscription', 'invoice'])):
+        for name in names:
+            results[name] = {
+                'legacy_us': await measure_async(lambda: legacy_get_keyboard(registry, name), iterations),
+                'registry_us': measure(lambda: lookup(name), iterations),
+            }
+    # Параметризованная клавиатура: администратор открывает одни и те же ошибки
+    error_ids = [i % 50 for i in range(iterations)]
+    ids = iter(error_ids)
+    legacy = measure(lambda: build_details_keyboard(next(ids)), iterations)
+    ids = iter(error_ids)
+    cached = measure(lambda: cached_details_keyboard(next(ids)), iterations)
+    results['details_keyboard(50 id)'] = {'legacy_us': legacy, 'registry_us': cached}
+    # Сериализация при отправке остается на каждый запрос и показана для сравнения
+    markup = INLINE_KEYBOARDS['manage_existing_subscription']
+    serialize_us = measure(lambda: json.dumps(markup.model_dump(exclude_none=True), ensure_ascii=False), iterations)
+
+    print(f"Итераций: {iterations}")
+    for name, result in results.items():
+        speedup = result['legacy_us'] / result['registry_us'] if result['registry_us'] else float('inf')
+        print(f"  {name:32s} сборка {result['legacy_us']:8.2f} us  реестр {result['registry_us']:6.3f} us  (x{speedup:.0f})")
+    static = [results[name] for name in ('start', 'manage_existing_subscription', 'invoice')]
+    saved = sum(r['legacy_us'] - r['registry_us'] for r in static) / len(static) * per_update
+    print(f"Экономия на обновление ({per_update} клавиатуры): {saved:.2f} us")
+    print(f"Сериализация клавиатуры при отправке (не меняется): {serialize_us:.2f} us")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Стоимость получения клавиатуры: сборка на каждый вызов и реестр')
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--per-update', type=int, default=2, help='сколько клавиатур получает хэндлер за одно обновление')
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations, args.per_update))
+
+
+if __name__ == '__main__':
+    main()
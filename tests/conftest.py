@@ -0,0 +1,8 @@
+import pytest_asyncio
+from app.database import dispose_async_engine
+
+@pytest_asyncio.fixture(autouse=True)
+async def dispose_engine():
+    # Каждый тест работает в своем event loop, поэтому соединения общего пула закрываются после теста
+    yield
+    await dispose_async_engine()
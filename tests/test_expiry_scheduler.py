@@ -0,0 +1,63 @@
+import pytest
+from app.expiry_scheduler import ExpiryScheduler
+from datetime import datetime, timedelta
+import asyncio
+import json
+
+def test_schedule_reschedule_and_cancel():
+    scheduler = ExpiryScheduler(async_session_maker=object())
+    now = datetime(2025, 1, 1, 12, 0)
+    scheduler.schedule(1, now + timedelta(minutes=5))
+    scheduler.schedule(2, now + timedelta(minutes=1))
+    scheduler.schedule(3, now + timedelta(minutes=3))
+    # Продление переносит срок, отмена убирает подписку из расписания
+    scheduler.schedule(2, now + timedelta(minutes=10))
+    scheduler.cancel(3)
+    assert scheduler.next_deadline() == now + timedelta(minutes=5)
+    assert scheduler.pop_due(now + timedelta(minutes=4)) == []
+    assert scheduler.pop_due(now + timedelta(minutes=6)) == [1]
+    assert scheduler.pop_due(now + timedelta(minutes=11)) == [2]
+    assert scheduler.next_deadline() is None
+
+@pytest.mark.asyncio
+async def test_run_wakes_up_at_deadline():
+    scheduler = ExpiryScheduler(async_session_maker=object(), reconcile_interval=3600)
+    async def load_window(now=None):
+        pass
+    scheduler.load_window = load_window
+    fired = asyncio.Event()
+    async def on_due(now):
+        fired.set()
+    task = asyncio.create_task(scheduler.run(on_due))
+    await asyncio.sleep(0.05)
+    assert not fired.is_set()
+    scheduler.schedule(42, datetime.utcnow() + timedelta(milliseconds=200))
+    await asyncio.wait_for(fired.wait(), timeout=2)
+    task.cancel()
+
+def test_notifications_from_other_processes_update_schedule():
+    scheduler = ExpiryScheduler(async_session_maker=object())
+    now = datetime(2025, 1, 1, 12, 0)
+    scheduler.schedule(1, now + timedelta(minutes=5))
+    # Оплата в другом процессе продлила подписку 1 и заменила её подпиской 2
+    scheduler.apply_notification(json.dumps([[1, None], [2, (now + timedelta(minutes=2)).isoformat()]]))
+    assert scheduler.pop_due(now + timedelta(minutes=10)) == [2]
+    assert len(scheduler) == 0
+
+@pytest.mark.asyncio
+async def test_initial_load_is_retried():
+    scheduler = ExpiryScheduler(async_session_maker=object(), reconcile_interval=3600, retry_delay=0.01)
+    attempts = []
+    async def load_window(now=None):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError('db down')
+        scheduler.schedule(7, datetime.utcnow())
+    scheduler.load_window = load_window
+    fired = asyncio.Event()
+    async def on_due(now):
+        fired.set()
+    task = asyncio.create_task(scheduler.run(on_due))
+    await asyncio.wait_for(fired.wait(), timeout=2)
+    assert len(attempts) == 3
+    task.cancel()
@@ -0,0 +1,37 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from types import SimpleNamespace
+from datetime import datetime
+from app.expiry_sweeper import ExpirySweeper, ranges_from_boundaries, expiry_intents
+
+@pytest.mark.asyncio
+async def test_sweep_claims_batches_and_wakes_outbox():
+    rows = [SimpleNamespace(id=i, user_id=i, telegram_user_id=str(i), channel_id='-100', invite_link=f'link_{i}') for i in range(25)]
+    batches = [rows[:10], rows[10:20], rows[20:]]
+    invalidated = []
+    service = SimpleNamespace(invalidate_subscription_info=invalidated.append, invite_link_index=AsyncMock())
+    outbox = MagicMock()
+    sweeper = ExpirySweeper(service, outbox=outbox, batch_size=10)
+    sweeper.claim_expired = AsyncMock(side_effect=batches)
+    stats = await sweeper.sweep()
+    assert stats['claimed'] == 25
+    assert len(invalidated) == 25
+    assert service.invite_link_index.evict.await_count == 25
+    # Последняя пачка неполная - повторного запроса к базе нет
+    assert sweeper.claim_expired.await_count == 3
+    assert outbox.wake.call_count == 3
+
+
+def test_expiry_intents():
+    row = SimpleNamespace(id=7, end_date=datetime(2024, 1, 2, 3, 4, 5), telegram_user_id='42', channel_id='-100', invite_link='link')
+    intents = expiry_intents(row)
+    assert [intent['kind'] for intent in intents] == ['ban', 'revoke_link', 'notify']
+    assert intents[0]['dedupe_key'] == 'ban:7:20240102030405'
+    no_channel = expiry_intents(SimpleNamespace(**{**vars(row), 'channel_id': None}))
+    assert [intent['kind'] for intent in no_channel] == ['notify']
+
+
+def test_ranges_from_boundaries():
+    assert ranges_from_boundaries([]) == []
+    assert ranges_from_boundaries([5]) == [(5, None)]
+    assert ranges_from_boundaries([1, 101, 250]) == [(1, 100), (101, 249), (250, None)]
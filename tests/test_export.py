@@ -0,0 +1,71 @@
+import gzip
+import io
+import json
+import pytest
+from datetime import datetime
+from sqlalchemy.dialects import postgresql
+from app.export import Exporter, parse_export_args
+
+
+class FakeStreamResult:
+    def __init__(self, columns, rows, chunk_size):
+        self.columns = columns
+        self.rows = rows
+        self.chunk_size = chunk_size
+
+    def keys(self):
+        return self.columns
+
+    async def partitions(self):
+        for start in range(0, len(self.rows), self.chunk_size):
+            yield self.rows[start:start + self.chunk_size]
+
+
+class FakeSession:
+    def __init__(self, rows, statements):
+        self.rows = rows
+        self.statements = statements
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def stream(self, statement):
+        self.statements.append(statement)
+        chunk_size = statement.get_execution_options()['yield_per']
+        return FakeStreamResult(['id', 'telegram_user_id', 'start_date'], self.rows, chunk_size)
+
+
+@pytest.mark.asyncio
+async def test_export_streams_chunks_to_gzip_csv_and_jsonl():
+    rows = [(i, str(1000 + i), datetime(2024, 5, 1, 12)) for i in range(5)]
+    statements = []
+    exporter = Exporter(async_session_maker=lambda: FakeSession(rows, statements), chunk_size=2)
+
+    buffer = io.BytesIO()
+    count = await exporter.export(buffer, 'subscriptions', 'csv', compress=True, since=datetime(2024, 5, 1), plan_id=2)
+    assert count == 5
+    lines = gzip.decompress(buffer.getvalue()).decode().splitlines()
+    assert lines[0] == 'id,telegram_user_id,start_date' and lines[1] == '0,1000,2024-05-01T12:00:00' and len(lines) == 6
+    sql = str(statements[0].compile(dialect=postgresql.dialect()))
+    assert 'user_subscriptions.start_date >= ' in sql and 'user_subscriptions.plan_id = ' in sql
+    assert 'stack_trace' not in sql
+
+    buffer = io.BytesIO()
+    await exporter.export(buffer, 'subscriptions', 'jsonl')
+    records = [json.loads(line) for line in buffer.getvalue().decode().splitlines()]
+    assert records[4] == {'id': 4, 'telegram_user_id': '1004', 'start_date': '2024-05-01T12:00:00'}
+
+
+def test_parse_export_args():
+    options = parse_export_args(['payment_errors', 'jsonl', 'gzip', '2024-05-01', '2024-05-31', 'plan=3'])
+    assert options == {
+        'dataset': 'payment_errors', 'fmt': 'jsonl', 'compress': True,
+        'since': datetime(2024, 5, 1), 'until': datetime(2024, 6, 1), 'plan_id': 3
+    }
+    with pytest.raises(ValueError):
+        parse_export_args(['users', '2024-05-01'])
+    with pytest.raises(ValueError):
+        parse_export_args(['orders'])
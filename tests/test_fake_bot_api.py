@@ -0,0 +1,52 @@
+import pytest
+from aiohttp.test_utils import TestServer
+from aiogram.exceptions import TelegramRetryAfter
+from app.bot_factory import create_bot
+from app.fake_bot_api import FakeBotAPI, UpdateGenerator, create_fake_bot_api_app
+
+
+@pytest.mark.asyncio
+async def test_bot_talks_to_fake_api_and_gets_retry_after():
+    api = FakeBotAPI(global_rate=0, chat_rate=1)
+    server = TestServer(create_fake_bot_api_app(api))
+    await server.start_server()
+    bot = create_bot('42:TEST', api_server=str(server.make_url('')))
+    try:
+        link = await bot.create_chat_invite_link(chat_id=-100, creates_join_request=True, member_limit=1)
+        message = await bot.send_message(7, f"Ссылка для входа в канал: {link.invite_link}")
+        assert message.chat.id == 7
+        assert api.links[link.invite_link] == (7, -100)
+
+        # Второе сообщение в тот же чат в ту же секунду превышает лимит чата
+        with pytest.raises(TelegramRetryAfter) as error:
+            await bot.send_message(7, 'again')
+        assert error.value.retry_after >= 1
+        assert api.rate_limited == 1
+        assert await bot.answer_pre_checkout_query('1', ok=True) is True
+    finally:
+        await bot.session.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_generated_updates_are_served_by_get_updates():
+    api = FakeBotAPI(seed=1)
+    api.links['https://t.me/+fake1'] = (7, -100)
+    generator = UpdateGenerator(api, plan_ids=[1], users=10)
+    generator.payment()
+    generator.join()
+    generator.menu()
+    server = TestServer(create_fake_bot_api_app(api))
+    await server.start_server()
+    bot = create_bot('42:TEST', api_server=str(server.make_url('')))
+    try:
+        updates = await bot.get_updates()
+        assert [u.update_id for u in updates] == [1, 2, 3, 4]
+        assert updates[0].pre_checkout_query.invoice_payload == 'plan_1'
+        assert updates[1].message.successful_payment.provider_payment_charge_id == 'fake_1'
+        assert updates[2].chat_join_request.invite_link.invite_link == 'https://t.me/+fake1'
+        # offset подтверждает полученные обновления
+        assert len(await bot.get_updates(offset=4)) == 1
+    finally:
+        await bot.session.close()
+        await server.close()
@@ -0,0 +1,66 @@
+import json
+import pytest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from app.importer import SubscriptionImporter, load_checkpoint
+
+
+def make_importer(batch_size=2):
+    importer = SubscriptionImporter(async_session_maker=object, batch_size=batch_size)
+    plans = [SimpleNamespace(id=1, name='Базовый', duration_days=30), SimpleNamespace(id=2, name='Премиум', duration_days=90)]
+    importer.plan_catalog = SimpleNamespace(get_plans=AsyncMock(return_value=plans))
+    return importer
+
+
+@pytest.mark.asyncio
+async def test_import_resumes_from_checkpoint(tmp_path):
+    path = tmp_path / 'subscribers.csv'
+    path.write_text(
+        'id,telegram_user_id,plan,start_date,end_date\n'
+        'a1,101,Базовый,2024-05-01T00:00:00,\n'
+        'a2,102,2,2024-05-01T00:00:00+03:00,2024-09-01\n'
+        'a3,103,Старый тариф,,\n'
+        'a4,104,премиум,2024-05-01,\n'
+        'a5,105,1,2024-05-01,\n',
+        encoding='utf-8'
+    )
+    importer = make_importer()
+    # Вторая пачка падает: контрольная точка остается после первой
+    importer.load_batch = AsyncMock(side_effect=[(2, 0, []), RuntimeError('connection lost')])
+    with pytest.raises(RuntimeError):
+        await importer.run(str(path))
+    first = importer.load_batch.await_args_list[0].args[0]
+    assert first[0] == ('101', None, 1, datetime(2024, 5, 1), datetime(2024, 5, 31), 'import:subscribers:a1')
+    # Время с часовым поясом приводится к UTC
+    assert first[1][2:5] == (2, datetime(2024, 4, 30, 21), datetime(2024, 9, 1))
+    assert load_checkpoint(f'{path}.checkpoint')['offset'] == 2
+
+    # Запись a5 пропущена базой (у пользователя более поздняя подписка) и попадает в файл отклоненных
+    importer.load_batch = AsyncMock(return_value=(1, 0, [('import:subscribers:a5', 'у пользователя есть активная подписка в боте')]))
+    state = await importer.run(str(path))
+    assert importer.load_batch.await_count == 1
+    assert [row[0] for row in importer.load_batch.await_args.args[0]] == ['104', '105']
+    assert state == {'offset': 5, 'created': 3, 'extended': 0, 'rejected': 1, 'skipped': 1, 'loaded': 4}
+    with open(f'{path}.rejects.jsonl', encoding='utf-8') as rejects:
+        rejects = [json.loads(line) for line in rejects]
+    assert [(reject['record'], reject.get('skipped', False)) for reject in rejects] == [(3, False), (5, True)]
+
+
+@pytest.mark.asyncio
+async def test_unreadable_jsonl_lines_are_rejected_without_aborting(tmp_path):
+    path = tmp_path / 'subscribers.jsonl'
+    path.write_text(
+        '{"id": "a1", "telegram_user_id": 101, "plan": 1}\n'
+        '{"id": "a2", "telegram_user_id": 102,\n'
+        '[1, 2]\n'
+        '{"id": "a4", "telegram_user_id": 104, "plan": 2}\n',
+        encoding='utf-8'
+    )
+    importer = make_importer(batch_size=10)
+    importer.load_batch = AsyncMock(return_value=(2, 0, []))
+    state = await importer.run(str(path))
+    assert [row[0] for row in importer.load_batch.await_args.args[0]] == ['101', '104']
+    assert state['offset'] == 4 and state['rejected'] == 2
+    with open(f'{path}.rejects.jsonl', encoding='utf-8') as rejects:
+        assert [json.loads(line)['record'] for line in rejects] == [2, 3]
@@ -0,0 +1,38 @@
+import pytest
+import uuid
+from datetime import datetime, timedelta
+from app.database import async_init_db, get_async_session_maker, SubscriptionPlan, InviteLinkPoolEntry
+from app.subscription_manager import SubscriptionManager
+from app.subscription_service import SubscriptionService
+from app.invite_link_pool import InviteLinkPool
+
+@pytest.mark.asyncio
+async def test_attach_claims_link_with_enough_time_left():
+    engine = await async_init_db()
+    session_maker = get_async_session_maker(engine)
+    service = SubscriptionService(session_maker)
+    pool = InviteLinkPool(session_maker, min_remaining_hours=24)
+    channel_id = f'pool_{uuid.uuid4().hex[:8]}'
+    now = datetime.utcnow()
+    user = await service.get_user_by_telegram_id('777010')
+    async with session_maker() as session:
+        plan = SubscriptionPlan(name='Пул тест', price=100, duration_days=30, channel_id=channel_id)
+        session.add(plan)
+        session.add_all([
+            InviteLinkPoolEntry(channel_id=channel_id, invite_link=f'https://t.me/+{channel_id}_old', expires_at=now + timedelta(hours=1)),
+            InviteLinkPoolEntry(channel_id=channel_id, invite_link=f'https://t.me/+{channel_id}_ok', expires_at=now + timedelta(days=7)),
+        ])
+        await session.commit()
+        sub = await SubscriptionManager(session).subscribe_user(user.id, plan.id)
+    # Несуществующая подписка не расходует ссылку пула
+    async with session_maker() as session:
+        async with session.begin():
+            assert await pool.attach(session, -1, channel_id) is None
+    async with session_maker() as session:
+        async with session.begin():
+            assert await pool.attach(session, sub.id, channel_id) == f'https://t.me/+{channel_id}_ok'
+    # Оставшаяся ссылка истекает слишком скоро и не выдается
+    async with session_maker() as session:
+        async with session.begin():
+            assert await pool.attach(session, sub.id, channel_id) is None
+    assert (await pool.available()).get(channel_id) is None
@@ -0,0 +1,62 @@
+import pytest
+from app.invite_links import InviteLinkIndex, InviteLinkEntry, InviteLinkRevoker, RevokeBuffer
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+@pytest.mark.asyncio
+async def test_index_lookup_and_eviction_on_revoke():
+    index = InviteLinkIndex()
+    entry = InviteLinkEntry(telegram_user_id='555', subscription_id=1, channel_id='-100', expires_at=datetime.utcnow() + timedelta(days=1))
+    await index.put('https://t.me/+abc', entry)
+    found = await index.get('https://t.me/+abc')
+    assert found.allows(555, -100)
+    # Чужой пользователь, другой канал или истекшая подписка
+    assert not found.allows(556, -100)
+    assert not found.allows(555, -200)
+    assert not found.allows(555, -100, now=datetime.utcnow() + timedelta(days=2))
+    statements = []
+    revoked = []
+    revoker = InviteLinkRevoker(index, async_session_maker=lambda: FakeSession(statements), worker=SimpleNamespace(wake=lambda: None),
+                                buffer=RevokeBuffer())
+    revoker.on_revoked = revoked.append
+    await revoker.schedule('https://t.me/+abc', -100, 555)
+    await revoker.schedule('https://t.me/+def', -100)
+    assert await index.get('https://t.me/+abc') is None
+    # Обработчик не обращается к базе: ссылки записываются пачкой
+    assert statements == [] and revoked == []
+    assert await revoker.flush() == 2
+    # Очистка ссылок в базе, отзыв в outbox и NOTIFY для кэшей других процессов - одна транзакция на всю пачку
+    assert [statement.table.name for statement in statements[:2]] == ['user_subscriptions', 'outbox']
+    assert 'pg_notify' in str(statements[2]) and len(statements) == 3
+    assert revoked == [555]
+    assert await revoker.flush() == 0
+
+
+@pytest.mark.asyncio
+async def test_fallback_entry_is_cached_briefly():
+    index = InviteLinkIndex()
+    clock = [0.0]
+    index._cache.clock = lambda: clock[0]
+    entry = InviteLinkEntry(telegram_user_id='555', subscription_id=1, channel_id='-100', expires_at=datetime.utcnow() + timedelta(days=1))
+    await index.put('https://t.me/+abc', entry, ttl=300)
+    clock[0] = 299
+    assert await index.get('https://t.me/+abc') == entry
+    clock[0] = 301
+    assert await index.get('https://t.me/+abc') is None
+
+
+class FakeSession:
+    def __init__(self, statements):
+        self.statements = statements
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def begin(self):
+        return self
+
+    async def execute(self, statement):
+        self.statements.append(statement)
@@ -0,0 +1,34 @@
+import pytest
+from pydantic import ValidationError
+from app.keyboards import reply_keyboard, inline_keyboard, get_inline_keyboard
+from app.payment_errors import details_keyboard
+
+
+@pytest.mark.asyncio
+async def test_keyboards_are_shared_instances():
+    assert reply_keyboard('start') is reply_keyboard('start')
+    assert await get_inline_keyboard('invoice') is inline_keyboard('invoice')
+    assert inline_keyboard('invoice').inline_keyboard[0][0].pay is True
+    with pytest.raises(ValueError):
+        inline_keyboard('unknown')
+    # Параметризованная клавиатура строится один раз на набор параметров
+    assert details_keyboard(7) is details_keyboard(7)
+    assert details_keyboard(7) is not details_keyboard(8)
+    assert details_keyboard(7).inline_keyboard[0][0].callback_data == 'perr:older:8'
+
+
+def test_shared_keyboards_cannot_be_mutated():
+    markup = inline_keyboard('invoice')
+    with pytest.raises(AttributeError):
+        markup.inline_keyboard.append([])
+    with pytest.raises(ValidationError):
+        markup.inline_keyboard[0][0].text = 'Бесплатно'
+    with pytest.raises(ValidationError):
+        details_keyboard(7).inline_keyboard = []
+    with pytest.raises(AttributeError):
+        reply_keyboard('start').keyboard[0].append(None)
+    # При отправке клавиатура сериализуется так же, как обычная InlineKeyboardMarkup
+    assert markup.model_dump(exclude_none=True) == {'inline_keyboard': [
+        [{'text': 'Оплатить', 'pay': True}],
+        [{'text': '↩️ Назад к выбору тарифа', 'callback_data': 'back_to_plan_selection'}],
+    ]}
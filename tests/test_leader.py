@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from app.leader import LeaderElection, LocalLease
+
+
+class FakeLease:
+    """Аренда, которую тест может «перехватить» у процесса"""
+
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self.available = True
+        self.held = False
+        self.tokens = 0
+        self.error = None
+
+    async def acquire(self):
+        if self.error:
+            raise self.error
+        if not self.available:
+            return None
+        self.available, self.held = False, True
+        self.tokens += 1
+        return self.tokens
+
+    async def renew(self):
+        if self.error:
+            raise self.error
+        return self.held
+
+    async def release(self):
+        if self.held:
+            self.available, self.held = True, False
+
+    def steal(self):
+        self.available, self.held = False, False
+
+
+@pytest.mark.asyncio
+async def test_loops_stop_when_lease_is_lost_and_restart_with_new_token():
+    lease = FakeLease()
+    election = LeaderElection(lease, name='test', heartbeat=0.05)
+    started = []
+
+    async def loop():
+        started.append(election.fencing_token)
+        await asyncio.Event().wait()
+
+    task = asyncio.create_task(election.run({'loop': loop}))
+    await asyncio.sleep(0.02)
+    assert election.is_leader and started == [1]
+
+    # Другой процесс перехватил аренду: циклы отменяются, процесс снова участвует в выборах
+    lease.steal()
+    await asyncio.sleep(0.1)
+    assert not election.is_leader
+    lease.available = True
+    await asyncio.sleep(0.1)
+    assert started == [1, 2]
+
+    # Redis недоступен: циклы останавливаются до истечения аренды
+    lease.error = ConnectionError('redis down')
+    await asyncio.sleep(lease.ttl)
+    assert not election.is_leader
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_local_lease_elects_only_first_process():
+    assert await LocalLease(is_leader=True).acquire() == 1
+    assert await LocalLease(is_leader=False).acquire() is None
+
+
+@pytest.mark.asyncio
+async def test_crashed_loop_is_restarted():
+    election = LeaderElection(LocalLease(), name='test', heartbeat=0.02)
+    runs = []
+
+    async def loop():
+        runs.append(election.fencing_token)
+        if len(runs) == 1:
+            raise RuntimeError('boom')
+        await asyncio.Event().wait()
+
+    task = asyncio.create_task(election.run({'loop': loop}))
+    await asyncio.sleep(0.1)
+    assert runs == [1, 1] and election.is_leader
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,64 @@
+import pytest
+from unittest.mock import MagicMock
+from aiogram.exceptions import TelegramRetryAfter
+from app.message_dispatcher import MessageDispatcher, TokenBucket, PRIORITY_HIGH, PRIORITY_BULK
+import asyncio
+
+def test_token_bucket_reserves_future_tokens():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, capacity=1, clock=lambda: now[0])
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    now[0] = 1.0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+@pytest.mark.asyncio
+async def test_high_priority_goes_first_and_retry_after_is_honored():
+    sent = []
+    attempts = {'n': 0}
+    gate = asyncio.Event()
+    async def send_message(chat_id, text, **kwargs):
+        if text == 'gate':
+            await gate.wait()
+        if text == 'flood' and attempts['n'] == 0:
+            attempts['n'] += 1
+            raise TelegramRetryAfter(method=MagicMock(), message='Flood', retry_after=0)
+        sent.append(text)
+        return text
+    bot = MagicMock()
+    bot.send_message = send_message
+    dispatcher = MessageDispatcher(bot, rate=1000, chat_rate=1000, workers=1)
+    # Единственный воркер занят, пока очередь наполняется
+    first = await dispatcher.send_message(0, 'gate', wait=False)
+    await asyncio.sleep(0)
+    bulk = [await dispatcher.send_message(i, f'bulk {i}', priority=PRIORITY_BULK, wait=False) for i in range(1, 4)]
+    high = await dispatcher.send_message(100, 'payment', priority=PRIORITY_HIGH, wait=False)
+    flood = await dispatcher.send_message(101, 'flood', priority=PRIORITY_HIGH, wait=False)
+    gate.set()
+    await asyncio.wait_for(asyncio.gather(first, *bulk, high, flood), timeout=5)
+    await dispatcher.stop()
+    assert sent[:3] == ['gate', 'payment', 'flood']
+    stats = dispatcher.get_stats()
+    assert stats['retry_after'] == 1
+    assert stats['lanes']['bulk']['sent'] == 3
+
+@pytest.mark.asyncio
+async def test_withdraw_cancels_only_calls_not_yet_started():
+    gate = asyncio.Event()
+    sent = []
+    async def send_message(chat_id, text, **kwargs):
+        await gate.wait()
+        sent.append(text)
+    bot = MagicMock()
+    bot.send_message = send_message
+    dispatcher = MessageDispatcher(bot, rate=1000, chat_rate=1000, workers=1)
+    started = await dispatcher.send_message(1, 'started', wait=False)
+    await asyncio.sleep(0)
+    queued = await dispatcher.send_message(2, 'queued', wait=False)
+    assert dispatcher.withdraw([started, queued]) == [started]
+    gate.set()
+    await asyncio.wait_for(started, timeout=5)
+    await asyncio.sleep(0.01)
+    await dispatcher.stop()
+    assert queued.cancelled() and sent == ['started']
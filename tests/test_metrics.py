@@ -0,0 +1,53 @@
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from prometheus_client import REGISTRY
+from types import SimpleNamespace
+from sqlalchemy import create_engine, text
+from app.metrics import statement_label, setup_handler_metrics, instrument_engine, register_backlog, update_backlog
+from app.query_log import install_query_log
+
+
+def test_statement_label_groups_queries_by_verb_and_table():
+    assert statement_label('SELECT users.id FROM users WHERE users.telegram_user_id = $1') == 'SELECT users'
+    assert statement_label('INSERT INTO outbox (kind) VALUES ($1)') == 'INSERT outbox'
+    assert statement_label(
+        'WITH due AS (SELECT id FROM user_subscriptions LIMIT 5 FOR UPDATE SKIP LOCKED) '
+        'UPDATE user_subscriptions SET is_active=false FROM due'
+    ) == 'UPDATE user_subscriptions'
+    assert statement_label('LISTEN subscription_plans_changed') == 'LISTEN'
+
+
+@pytest.mark.asyncio
+async def test_handler_middleware_records_latency_and_errors():
+    dp = Dispatcher()
+
+    @dp.message()
+    async def failing_handler(message):
+        raise RuntimeError('boom')
+
+    setup_handler_metrics(dp)
+    update = Update.model_validate({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'hi'
+    }})
+    with pytest.raises(RuntimeError):
+        await dp.feed_update(Bot('42:TEST'), update)
+    assert REGISTRY.get_sample_value('bot_handler_errors_total', {'handler': 'failing_handler', 'error': 'RuntimeError'}) == 1
+    assert REGISTRY.get_sample_value('bot_handler_duration_seconds_count', {'handler': 'failing_handler'}) == 1
+
+
+def test_pool_gauge_and_query_latency_share_engine_events():
+    engine = create_engine('sqlite://')
+    fake_engine = SimpleNamespace(sync_engine=engine)
+    install_query_log(fake_engine)
+    instrument_engine(fake_engine)
+    checked_out = REGISTRY.get_sample_value('bot_db_pool_checked_out')
+    observed = REGISTRY.get_sample_value('bot_db_query_duration_seconds_count', {'statement': 'SELECT'}) or 0
+    with engine.connect() as conn:
+        assert REGISTRY.get_sample_value('bot_db_pool_checked_out') == checked_out + 1
+        conn.execute(text('SELECT 1'))
+    assert REGISTRY.get_sample_value('bot_db_pool_checked_out') == checked_out
+    assert REGISTRY.get_sample_value('bot_db_query_duration_seconds_count', {'statement': 'SELECT'}) == observed + 1
+    register_backlog('test_queue', lambda: 7)
+    update_backlog()
+    assert REGISTRY.get_sample_value('bot_backlog_size', {'queue': 'test_queue'}) == 7
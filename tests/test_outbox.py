@@ -0,0 +1,30 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.methods import BanChatMember
+from app.outbox import OutboxWorker, OUTBOX_BAN, OUTBOX_NOTIFY, OUTBOX_REVOKE_LINK
+
+METHOD = BanChatMember(chat_id=-100, user_id=1)
+
+
+@pytest.mark.asyncio
+async def test_execute_classifies_telegram_errors():
+    dispatcher = AsyncMock()
+    worker = OutboxWorker(async_session_maker=lambda: None, dispatcher=dispatcher, max_attempts=3)
+    semaphore = asyncio.Semaphore(1)
+    ban = SimpleNamespace(id=1, kind=OUTBOX_BAN, payload={'channel_id': '-100', 'user_id': '1'}, attempts=1)
+    # Пользователь уже не в канале - действие выполнено
+    dispatcher.call.side_effect = TelegramBadRequest(METHOD, 'Bad Request: USER_NOT_PARTICIPANT')
+    assert await worker._execute(ban, semaphore) is None
+    # Пользователь заблокировал бота - повторять бессмысленно
+    notify = SimpleNamespace(id=2, kind=OUTBOX_NOTIFY, payload={'chat_id': '1', 'text': 'hi'}, attempts=1)
+    dispatcher.send_message.side_effect = TelegramForbiddenError(METHOD, 'Forbidden: bot was blocked by the user')
+    assert (await worker._execute(notify, semaphore))[1] is True
+    # Сетевая ошибка повторяется, пока не исчерпаны попытки
+    revoke = SimpleNamespace(id=3, kind=OUTBOX_REVOKE_LINK, payload={'channel_id': '-100', 'invite_link': 'link'}, attempts=1)
+    dispatcher.call.side_effect = ConnectionError('timeout')
+    assert await worker._execute(revoke, semaphore) == ('timeout', False)
+    revoke.attempts = 3
+    assert await worker._execute(revoke, semaphore) == ('timeout', True)
@@ -0,0 +1,62 @@
+import pytest
+from datetime import datetime
+from types import SimpleNamespace
+from sqlalchemy.dialects import postgresql
+from app.payment_errors import PaymentErrorConsole, page_keyboard, parse_callback
+
+
+class FakeSession:
+    def __init__(self, rows, statements):
+        self.rows = rows
+        self.statements = statements
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def execute(self, statement):
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect())))
+        return SimpleNamespace(all=lambda: self.rows)
+
+
+def make_console(rows, statements, page_size=3):
+    return PaymentErrorConsole(async_session_maker=lambda: FakeSession(rows, statements), page_size=page_size)
+
+
+def error_row(error_id):
+    return SimpleNamespace(id=error_id, telegram_user_id='1', plan_id=None, payment_amount=1000,
+                           payment_currency='RUB', payment_time=datetime(2024, 1, 1), error_message='boom')
+
+
+@pytest.mark.asyncio
+async def test_page_is_one_light_keyset_query():
+    statements = []
+    console = make_console([error_row(i) for i in (9, 8, 7, 6)], statements)
+    page = await console.get_page(older_than=10)
+    assert [row.id for row in page.rows] == [9, 8, 7]
+    assert page.has_newer and page.has_older
+    assert len(statements) == 1
+    # Тяжелые колонки не читаются, выборка ограничена страницей + 1
+    assert 'payment_info' not in statements[0] and 'stack_trace' not in statements[0]
+    assert 'payment_errors.id < ' in statements[0] and 'LIMIT' in statements[0]
+    keyboard = page_keyboard(page)
+    callbacks = [button.callback_data for row in keyboard.inline_keyboard for button in row]
+    assert 'perr:newer:9' in callbacks and 'perr:older:7' in callbacks and 'perr:open:8' in callbacks
+    assert parse_callback('perr:older:7') == ('older', 7) and parse_callback('plan_1') is None
+    # Подделанные или устаревшие данные кнопки не приводят к исключению в обработчике
+    assert parse_callback('perr:open:abc') is None
+    assert parse_callback('perr:summary:user') is None
+    assert parse_callback('perr:drop:1') is None
+    assert parse_callback('perr:summary:plan') == ('summary', 'plan')
+
+
+@pytest.mark.asyncio
+async def test_newer_page_is_returned_newest_first():
+    statements = []
+    console = make_console([error_row(i) for i in (11, 12)], statements)
+    page = await console.get_page(newer_than=10)
+    assert [row.id for row in page.rows] == [12, 11]
+    assert page.has_older and not page.has_newer
+    assert 'payment_errors.id > ' in statements[0] and 'ASC' in statements[0]
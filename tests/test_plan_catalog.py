@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from app.database import async_init_db, get_async_session_maker, SubscriptionPlan
+from app.plan_catalog import PlanCatalog
+
+@pytest.mark.asyncio
+async def test_catalog_loads_once_and_reloads_after_invalidate():
+    engine = await async_init_db()
+    session_maker = get_async_session_maker(engine)
+    async with session_maker() as session:
+        plan = SubscriptionPlan(name='Каталог тест', price=12300, duration_days=30, channel_id='test')
+        session.add(plan)
+        await session.commit()
+    catalog = PlanCatalog(session_maker)
+    cached = await catalog.get_plan(plan.id)
+    assert cached.name == 'Каталог тест'
+    # Повторное обращение берется из памяти
+    assert await catalog.get_plan_by_name('Каталог тест') is cached
+    params = await catalog.get_invoice_params(plan.id, is_extension=True)
+    assert params['payload'] == f'extend_{plan.id}'
+    assert params['prices'][0].amount == 12300
+    # Новый тариф виден только после инвалидации
+    async with session_maker() as session:
+        new_plan = SubscriptionPlan(name='Каталог тест 2', price=100, duration_days=1, channel_id='test')
+        session.add(new_plan)
+        await session.commit()
+    assert await catalog.get_plan(new_plan.id) is None
+    catalog.invalidate()
+    assert (await catalog.get_plan(new_plan.id)).name == 'Каталог тест 2'
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_load_catalog_once():
+    loads = []
+
+    class FakeSession:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def execute(self, statement):
+            loads.append(statement)
+            await asyncio.sleep(0.01)
+            return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: []))
+
+    catalog = PlanCatalog(FakeSession)
+    await asyncio.gather(*(catalog.get_plans() for _ in range(10)))
+    assert len(loads) == 1
+    catalog.invalidate()
+    await asyncio.gather(*(catalog.get_plans() for _ in range(10)))
+    assert len(loads) == 2
@@ -0,0 +1,28 @@
+import logging
+from types import SimpleNamespace
+from sqlalchemy import create_engine, text
+from app.query_log import fingerprint, normalize_statement, install_query_log, query_scope
+
+
+def test_fingerprint_ignores_values():
+    first = "SELECT * FROM users WHERE id IN ($1, $2, $3) AND telegram_user_id = 'abc' LIMIT 10"
+    second = "SELECT * FROM users WHERE id IN ($1) AND telegram_user_id = 'xyz' LIMIT 5"
+    assert normalize_statement(first) == "SELECT * FROM users WHERE id IN (...) AND telegram_user_id = ? LIMIT ?"
+    assert fingerprint(first) == fingerprint(second)
+    assert normalize_statement("SELECT g::text FROM t WHERE a = :a") == "SELECT g::text FROM t WHERE a = ?"
+
+
+def test_query_scope_counts_queries_and_warns_over_budget(caplog):
+    engine = create_engine('sqlite://')
+    install_query_log(SimpleNamespace(sync_engine=engine))
+    with engine.connect() as conn:
+        with caplog.at_level(logging.WARNING):
+            with query_scope('handler', budget=2) as outer:
+                with query_scope('get_subscription_info', budget=2) as inner:
+                    conn.execute(text('SELECT 1'))
+                for user_id in range(3):
+                    conn.execute(text('SELECT :id'), {'id': user_id})
+    assert inner.count == 1
+    assert outer.count == 4
+    warnings = [record.message for record in caplog.records if '[QUERY_BUDGET]' in record.message]
+    assert len(warnings) == 1 and warnings[0].startswith('[QUERY_BUDGET] handler: 4 запросов')
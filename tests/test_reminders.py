@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+from types import SimpleNamespace
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage
+from app.reminders import ReminderSender
+
+
+class FakeDispatcher:
+    """
+    Отправка: пользователь 1 - успех, 2 - заблокировал бота, 3 - временная ошибка, 4 - не успевает до дедлайна,
+    5 - запрос уже ушел в Telegram к дедлайну и завершается успешно после него
+    """
+
+    def __init__(self):
+        self.in_flight = set()
+
+    async def _send(self, chat_id, text):
+        if chat_id == '2':
+            raise TelegramForbiddenError(method=SendMessage(chat_id=2, text=text), message='bot was blocked by the user')
+        if chat_id == '3':
+            raise RuntimeError('timeout')
+        if chat_id == '4':
+            await asyncio.sleep(10)
+        if chat_id == '5':
+            await asyncio.sleep(0.3)
+
+    async def send_message(self, chat_id, text, priority=None, wait=True):
+        task = asyncio.create_task(self._send(chat_id, text))
+        if chat_id == '5':
+            self.in_flight.add(task)
+        return task if not wait else await task
+
+    def withdraw(self, futures):
+        for future in futures:
+            if future not in self.in_flight:
+                future.cancel()
+        return [future for future in futures if future in self.in_flight]
+
+
+@pytest.mark.asyncio
+async def test_send_due_releases_only_retryable_reminders():
+    rows = [SimpleNamespace(id=i * 10, telegram_user_id=str(i)) for i in range(1, 6)]
+    sender = ReminderSender(async_session_maker=object, dispatcher=FakeDispatcher(), batch_size=5, deadline=0.2)
+    sender.claim = AsyncMock(side_effect=[rows, []])
+    sender.release = AsyncMock()
+    stats = await sender.send_due()
+    # Начатая до дедлайна отправка засчитывается и не возвращается в очередь
+    assert stats == {'claimed': 5, 'sent': 2, 'released': 2}
+    # Временная ошибка и дедлайн - повтор в следующем проходе, заблокированный бот - нет
+    assert sorted(sender.release.await_args.args[0]) == [30, 40]
+    # После возврата напоминаний проход завершается, не забирая их снова
+    assert sender.claim.await_count == 1
+
+
+def test_reminder_text_follows_reminder_hours():
+    assert 'через 24 часа' in ReminderSender(async_session_maker=object, hours=24).text
+    assert 'через 48 часов' in ReminderSender(async_session_maker=object, hours=48).text
+    assert 'через 1 час!' in ReminderSender(async_session_maker=object, hours=1).text
+
+
+@pytest.mark.asyncio
+async def test_send_due_claims_until_batch_is_not_full():
+    batches = [[SimpleNamespace(id=i, telegram_user_id='1') for i in range(2)], [SimpleNamespace(id=5, telegram_user_id='1')]]
+    sender = ReminderSender(async_session_maker=object, dispatcher=FakeDispatcher(), batch_size=2)
+    sender.claim = AsyncMock(side_effect=batches)
+    stats = await sender.send_due()
+    assert stats['sent'] == 3
+    assert sender.claim.await_count == 2
@@ -0,0 +1,54 @@
+import pytest
+from datetime import datetime, date
+from types import SimpleNamespace
+from sqlalchemy.dialects import postgresql
+from app.stats import StatsDelta, record_stats, build_report
+
+
+class FakeSession:
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+
+
+@pytest.mark.asyncio
+async def test_record_stats_merges_delta_into_one_upsert():
+    delta = (
+        StatsDelta()
+        .add(datetime(2024, 5, 2, 12), 2, new_subscriptions=1, active_delta=1, revenue=19900)
+        .add(datetime(2024, 5, 2, 13), 1, active_delta=-1)
+        .add(datetime(2024, 5, 2, 14), 2, renewals=1, revenue=19900)
+        .add(date(2024, 5, 1), None, payment_errors=1)
+    )
+    rows = delta.rows()
+    assert [(row['day'], row['plan_id']) for row in rows] == [(date(2024, 5, 1), 0), (date(2024, 5, 2), 1), (date(2024, 5, 2), 2)]
+    assert rows[2]['revenue'] == 39800 and rows[2]['renewals'] == 1 and rows[2]['active_delta'] == 1
+
+    session = FakeSession()
+    await record_stats(session, delta)
+    await record_stats(session, StatsDelta().add(date(2024, 5, 1), 1, active_delta=0))
+    # Пустые изменения не пишутся, остальные - одним запросом
+    assert len(session.statements) == 1
+    sql = str(session.statements[0].compile(dialect=postgresql.dialect()))
+    assert 'ON CONFLICT (day, plan_id, slot) DO UPDATE' in sql
+    assert 'revenue = (subscription_stats_daily.revenue + excluded.revenue)' in sql
+
+
+def test_build_report_computes_mrr_and_churn():
+    plan = dict(new_subscriptions=0, renewals=0, revenue=0, payment_errors=0)
+    plans = [
+        SimpleNamespace(plan_id=1, name='Месяц', price=30000, duration_days=30, active=10, active_change=-2,
+                        cancellations=1, expirations=3, **plan),
+        SimpleNamespace(plan_id=2, name='Год', price=360000, duration_days=360, active=5, active_change=5,
+                        cancellations=0, expirations=0, **plan),
+        SimpleNamespace(plan_id=0, name=None, price=None, duration_days=None, active=None, active_change=0,
+                        cancellations=0, expirations=0, **{**plan, 'payment_errors': 2}),
+    ]
+    report = build_report(plans, [], 30)
+    assert report['active'] == 15
+    assert report['mrr'] == 10 * 300 + 5 * 300
+    # Отток 4 при 12 активных подписках на начало периода
+    assert report['churned'] == 4 and report['churn_rate'] == pytest.approx(4 / 12)
+    assert report['payment_errors'] == 2 and [plan.plan_id for plan in report['plans']] == [1, 2]
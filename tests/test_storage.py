@@ -0,0 +1,34 @@
+import pytest
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
+import app.storage as storage
+
+
+def test_create_fsm_storage_memory(monkeypatch):
+    monkeypatch.setattr(storage, 'FSM_STORAGE', 'memory')
+    assert isinstance(storage.create_fsm_storage(), MemoryStorage)
+
+
+def test_create_fsm_storage_redis_uses_ttl(monkeypatch):
+    monkeypatch.setattr(storage, 'FSM_STORAGE', 'redis')
+    monkeypatch.setattr(storage, 'FSM_STATE_TTL', 60)
+    monkeypatch.setattr(storage, 'FSM_DATA_TTL', 120)
+    fsm_storage = storage.create_fsm_storage()
+    assert isinstance(fsm_storage, RedisStorage)
+    assert fsm_storage.state_ttl == 60
+    assert fsm_storage.data_ttl == 120
+
+
+def test_create_fsm_storage_unknown(monkeypatch):
+    monkeypatch.setattr(storage, 'FSM_STORAGE', 'sqlite')
+    with pytest.raises(ValueError):
+        storage.create_fsm_storage()
+
+
+def test_several_workers_require_redis(monkeypatch):
+    monkeypatch.setattr(storage, 'FSM_STORAGE', 'memory')
+    storage.check_fsm_storage(1)
+    with pytest.raises(ValueError):
+        storage.check_fsm_storage(4)
+    monkeypatch.setattr(storage, 'FSM_STORAGE', 'redis')
+    storage.check_fsm_storage(4)
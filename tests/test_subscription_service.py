@@ -1,7 +1,9 @@
 import pytest
-from app.database import async_init_db, get_async_session_maker, User
+from app.database import async_init_db, get_async_session_maker, User, SubscriptionPlan
+from app.subscription_manager import SubscriptionManager
 from app.subscription_service import SubscriptionService
 import asyncio
+import uuid
 
 @pytest.mark.asyncio
 async def test_create_and_get_user():
@@ -11,4 +13,82 @@ async def test_create_and_get_user():
     user = await service.get_user_by_telegram_id('12345')
     assert isinstance(user, User)
     user2 = await service.get_user_by_telegram_id('12345')
-    assert user.id == user2.id 
\ No newline at end of file
+    assert user.id == user2.id 
+
+@pytest.mark.asyncio
+async def test_subscription_info_is_cached_until_invalidated():
+    engine = await async_init_db()
+    session_maker = get_async_session_maker(engine)
+    service = SubscriptionService(session_maker)
+    user = await service.get_user_by_telegram_id('777001')
+    async with session_maker() as session:
+        plan = SubscriptionPlan(name='Инфо тест', price=100, duration_days=30, channel_id='test')
+        session.add(plan)
+        await session.commit()
+        sub = await SubscriptionManager(session).subscribe_user(user.id, plan.id)
+    info = await service.get_subscription_info('777001')
+    assert info.subscription_id == sub.id
+    assert info.plan_name == 'Инфо тест'
+    assert await service.get_subscription_info('777001') is info
+    async with session_maker() as session:
+        await SubscriptionManager(session).cancel_subscription(sub.id)
+    service.invalidate_subscription_info('777001')
+    assert await service.get_subscription_info('777001') is None
+
+@pytest.mark.asyncio
+async def test_fulfill_payment_is_idempotent_on_charge_id():
+    engine = await async_init_db()
+    session_maker = get_async_session_maker(engine)
+    service = SubscriptionService(session_maker)
+    async with session_maker() as session:
+        plan = SubscriptionPlan(name='Оплата тест', price=100, duration_days=30, channel_id=None)
+        session.add(plan)
+        await session.commit()
+    # Уникальные ID платежей, чтобы тест проходил на уже заполненной базе
+    charge_1, charge_2, charge_3 = (f'charge_fulfill_{n}_{uuid.uuid4().hex}' for n in (1, 2, 3))
+    first = await service.fulfill_payment('777002', plan.id, charge_1)
+    assert not first.duplicate
+    again = await service.fulfill_payment('777002', plan.id, charge_1)
+    assert again.duplicate
+    assert again.subscription_id == first.subscription_id
+    extended = await service.fulfill_payment('777002', plan.id, charge_2, subscription_id=first.subscription_id)
+    assert extended.subscription_id == first.subscription_id
+    assert (extended.end_date - first.end_date).days == 30
+    # Повторная доставка прежних платежей после продления ничего не меняет
+    for charge, subscription_id in ((charge_1, None), (charge_2, first.subscription_id), (charge_1, first.subscription_id)):
+        redelivered = await service.fulfill_payment('777002', plan.id, charge, subscription_id=subscription_id)
+        assert redelivered.duplicate
+        assert redelivered.subscription_id == first.subscription_id
+        assert redelivered.end_date == extended.end_date
+    info = await service.get_subscription_info('777002')
+    assert info.subscription_id == first.subscription_id
+    # Чужую подписку продлить нельзя
+    with pytest.raises(ValueError):
+        await service.fulfill_payment('777003', plan.id, charge_3, subscription_id=first.subscription_id)
+
+
+def test_only_charge_key_conflicts_count_as_duplicates():
+    from sqlalchemy.exc import IntegrityError
+    from app.subscription_service import is_duplicate_charge
+
+    class DriverError(Exception):
+        def __init__(self, constraint_name):
+            self.constraint_name = constraint_name
+
+    def integrity_error(constraint_name):
+        orig = Exception('adapted')
+        orig.__cause__ = DriverError(constraint_name)
+        return IntegrityError('INSERT', {}, orig)
+
+    assert is_duplicate_charge(integrity_error('uq_user_subscriptions_provider_payment_charge_id'))
+    assert not is_duplicate_charge(integrity_error('user_subscriptions_plan_id_fkey'))
+
+
+def test_info_cache_is_invalidated_by_notifications():
+    from app.subscription_info import SubscriptionInfoCache
+    cache = SubscriptionInfoCache(ttl=60)
+    cache.set('101', {'plan': 'basic'})
+    cache.set('102', None)
+    # Подписка пользователя 101 изменена в другом процессе
+    cache.apply_notification('["101"]')
+    assert '101' not in cache and '102' in cache
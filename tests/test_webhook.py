@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from app.webhook import WebhookHandler, create_webhook_app, SECRET_HEADER
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 42, 'type': 'private'}, 'text': '/start'}}
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.active = 0
+        self.max_active = 0
+        self.handled = []
+
+    async def feed_update(self, bot, update):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await self.gate.wait()
+        self.active -= 1
+        self.handled.append(update.update_id)
+
+
+@pytest.mark.asyncio
+async def test_webhook_checks_secret_and_limits_in_flight():
+    dp = FakeDispatcher()
+    handler = WebhookHandler(dp, bot=None, secret_token='s3cret', max_in_flight=2)
+    client = TestClient(TestServer(create_webhook_app(handler, '/webhook')))
+    await client.start_server()
+    try:
+        response = await client.post('/webhook', json=UPDATE, headers={SECRET_HEADER: 'wrong'})
+        assert response.status == 401
+        response = await client.post('/webhook', json=UPDATE)
+        assert response.status == 401
+
+        requests = [
+            asyncio.create_task(client.post('/webhook', json={**UPDATE, 'update_id': i}, headers={SECRET_HEADER: 's3cret'}))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0.2)
+        # Третий запрос ждет, пока освободится место
+        assert handler.in_flight == 2
+        assert sum(task.done() for task in requests) == 2
+        dp.gate.set()
+        responses = await asyncio.gather(*requests)
+        await handler.close()
+        assert [response.status for response in responses] == [200, 200, 200]
+        assert sorted(dp.handled) == [0, 1, 2]
+        assert dp.max_active == 2
+    finally:
+        await client.close()
+
+
+def test_webhook_requires_secret():
+    with pytest.raises(ValueError):
+        WebhookHandler(FakeDispatcher(), bot=None, secret_token='')